@@ -0,0 +1,127 @@
+﻿# benchmarks/bench_classifier.py - So sánh DocumentClassifier (automaton từ khoá) với cách quét cũ
+#
+#   python benchmarks/bench_classifier.py
+#   python benchmarks/bench_classifier.py --sizes 1K 100K 10M --repeat 5
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from document_classifier import DocumentClassifier
+
+FILLER = (
+    "công ty trách nhiệm hữu hạn văn bản điều kiện người mua hàng giá trị gia tăng "
+    "thuế số lượng địa chỉ điện thoại mã số ngân hàng tài khoản ghi chú trang"
+).split()
+
+
+def legacy_features(classifier, text):
+    """Cách tính đặc trưng trước đây: một lần quét cho mỗi từ khoá, regex không biên dịch sẵn"""
+    text_lower = text.lower()
+    features = {}
+    for category, keywords in classifier.category_keywords.items():
+        features[f"kw_{category}"] = sum(1 for keyword in keywords if keyword in text_lower)
+    features["length"] = len(text)
+    features["line_count"] = text.count("\n")
+    features["has_dates"] = bool(re.search(r"\d{1,2}/\d{1,2}/\d{4}", text))
+    features["has_numbers"] = bool(re.search(r"\d+", text))
+    features["has_money"] = bool(re.search(r"\d+[.,]\d+", text))
+    features["word_count"] = len(text.split())
+    return features
+
+
+def legacy_classify(classifier, text):
+    if not text or len(text.strip()) < 10:
+        return "unknown", 0.0, {}
+    features = legacy_features(classifier, text)
+    scores = {}
+    for category in classifier.category_keywords:
+        structure_score = 0
+        if category == "invoice" and features["has_money"]:
+            structure_score += 2
+        if category == "id_card" and features["has_dates"]:
+            structure_score += 1
+        if category == "contract" and features["length"] > 500:
+            structure_score += 1
+        scores[category] = features[f"kw_{category}"] + structure_score
+    best_category = max(scores, key=scores.get)
+    total_possible = max(len(classifier.category_keywords[best_category]) + 2, 1)
+    confidence = min(scores[best_category] / total_possible, 1.0)
+    if confidence > 0.3:
+        # extract_metadata cũ lowercase lại toàn bộ văn bản
+        text.lower()
+        return best_category, round(confidence, 3), classifier.extract_metadata(text, best_category)
+    return "unknown", 0.0, {}
+
+
+def make_text(size, seed=0):
+    """Văn bản giống kết quả OCR hợp đồng nhiều trang: chủ yếu là chữ thường, rải rác từ khoá"""
+    rng = random.Random(seed)
+    keywords = ["hợp đồng", "điều khoản", "bên a", "bên b", "ký kết", "ngày 15/01/2024"]
+    parts, length = [], 0
+    while length < size:
+        word = rng.choice(keywords) if rng.random() < 0.002 else rng.choice(FILLER)
+        if rng.random() < 0.08:
+            word += "\n"
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)[:size]
+
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 * 1024}
+    value = value.upper()
+    return int(value[:-1]) * units[value[-1]] if value[-1] in units else int(value)
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DocumentClassifier")
+    parser.add_argument("--sizes", nargs="+", default=["1K", "100K", "10M"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=20000, help="Số văn bản ngắn cho so sánh classify_batch")
+    parser.add_argument("--batch-size", default="300", help="Độ dài mỗi văn bản trong batch")
+    args = parser.parse_args()
+
+    classifier = DocumentClassifier()
+    print(f"{'size':>8} {'op':>10} {'legacy ms':>11} {'new ms':>9} {'speedup':>8}")
+    for label in args.sizes:
+        text = make_text(parse_size(label))
+        assert legacy_features(classifier, text) == classifier.extract_features(text), "features khác nhau"
+        assert legacy_classify(classifier, text) == classifier.classify(text), "classify khác nhau"
+
+        # Văn bản lớn chạy ít lần hơn để benchmark không kéo dài
+        repeat = args.repeat if len(text) < 1024 * 1024 else max(1, args.repeat // 3)
+        if len(text) < 10 * 1024:
+            repeat *= 200
+        for op, legacy, new in (
+            ("features", lambda: legacy_features(classifier, text), lambda: classifier.extract_features(text)),
+            ("classify", lambda: legacy_classify(classifier, text), lambda: classifier.classify(text)),
+        ):
+            old_s = best_time(legacy, repeat)
+            new_s = best_time(new, repeat)
+            print(f"{label:>8} {op:>10} {old_s * 1000:>11.3f} {new_s * 1000:>9.3f} {old_s / new_s:>7.2f}x")
+
+    # Lưu trữ nhiều văn bản ngắn: classify từng cái vs classify_batch
+    if args.batch:
+        texts = [make_text(parse_size(args.batch_size), seed=i) for i in range(args.batch)]
+        assert [classifier.classify(text) for text in texts] == classifier.classify_batch(texts), "classify_batch khác nhau"
+        old_s = best_time(lambda: [classifier.classify(text) for text in texts], args.repeat)
+        new_s = best_time(lambda: classifier.classify_batch(texts), args.repeat)
+        label = f"{args.batch}x{args.batch_size}"
+        print(f"{label:>8} {'batch':>10} {old_s * 1000:>11.3f} {new_s * 1000:>9.3f} {old_s / new_s:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+﻿# benchmarks/bench_cpu_inference.py - Báo cáo độ chính xác / độ trễ của các chế độ suy luận CPU trên bộ ảnh mẫu
+#
+#   python benchmarks/bench_cpu_inference.py --json report.json --markdown report.md   # tài liệu tổng hợp
+#   python benchmarks/bench_cpu_inference.py --images samples/ --workers 4 --json report.json
+#
+# Mặc định chạy trên tài liệu sinh bằng synthetic_docs.py (cố định theo --seed, CER theo văn bản chuẩn).
+# Với --images: ảnh có file <tên>.txt cùng thư mục thì CER tính theo văn bản đó, ngược lại so với chế độ fp32.
+# int8 (quantize=True) là mặc định của easyocr trên CPU; fp32 chỉ để so sánh.
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import threading
+
+import numpy as np
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+from synthetic_docs import generate
+from services.cpu_tuning import configure_torch_threads, default_threads, reader_options, trace_recognizer, tune_reader
+from services.smart_ocr import normalize_vietnamese
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def load_samples(folder):
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        with Image.open(os.path.join(folder, name)) as image:
+            array = np.asarray(image.convert("RGB"))
+        truth_path = os.path.join(folder, stem + ".txt")
+        truth = None
+        if os.path.exists(truth_path):
+            with open(truth_path, encoding="utf-8") as f:
+                truth = normalize_vietnamese(f.read())
+        samples.append({"name": name, "image": array, "truth": truth})
+    return samples
+
+
+def load_synthetic(count, seed):
+    """Tài liệu tổng hợp cùng dạng với load_samples (văn bản chuẩn đã chuẩn hoá)"""
+    return [{"name": document["name"], "image": document["image"], "truth": normalize_vietnamese(document["truth"])}
+            for document in generate(count, seed=seed)]
+
+
+def to_markdown(report):
+    """Bảng báo cáo dạng markdown (để commit cùng thay đổi cấu hình CPU)"""
+    lines = [
+        "# Báo cáo suy luận CPU",
+        "",
+        f"- Dữ liệu: {report['source']} ({report['samples']} ảnh)",
+        f"- CPU: {report['cpu_count']} core, {report['workers']} worker",
+        f"- CER so với: {report['reference']}",
+        "",
+        "| mode | quantize | threads | torchscript | load s | p50 ms | p95 ms | img/s | CER |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for entry in report["modes"]:
+        lines.append(f"| {entry['mode']} | {entry['quantize']} | {entry['threads']} | {entry['torchscript']} | "
+                     f"{entry['load_s']} | {entry['p50_ms']} | {entry['p95_ms']} | {entry['images_per_s']} | {entry['cer']} |")
+    return "\n".join(lines) + "\n"
+
+
+def cer(reference, hypothesis):
+    """Character error rate: khoảng cách Levenshtein / độ dài chuẩn"""
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_char in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_char in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_char != hyp_char)))
+        previous = current
+    return previous[-1] / len(reference)
+
+
+def read_text(reader, image):
+    return normalize_vietnamese("\n".join(result[1] for result in reader.readtext(image)))
+
+
+def measure(reader, samples, repeat):
+    """Độ trễ từng ảnh (chạy tuần tự), lấy lần nhanh nhất trong repeat"""
+    texts, latencies = [], []
+    for sample in samples:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            text = read_text(reader, sample["image"])
+            best = min(best, time.perf_counter() - start)
+        texts.append(text)
+        latencies.append(best)
+    return texts, latencies
+
+
+def throughput(reader, samples, workers, rounds=2):
+    """Ảnh/giây khi workers thread cùng OCR (mô phỏng nhiều worker tranh CPU)"""
+    jobs = [sample["image"] for sample in samples] * rounds
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                image = jobs.pop()
+            reader.readtext(image)
+
+    total = len(samples) * rounds
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Báo cáo chế độ suy luận CPU (int8, thread, TorchScript)")
+    parser.add_argument("--images", help="Thư mục ảnh mẫu (kèm <tên>.txt nếu có văn bản chuẩn) thay cho tài liệu tổng hợp")
+    parser.add_argument("--count", type=int, default=9, help="Số tài liệu tổng hợp")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--languages", default="vi,en")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("OCR_WORKERS", 1)),
+                        help="Số worker dùng để chia thread và đo throughput")
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--json", help="Ghi báo cáo JSON ra file")
+    parser.add_argument("--markdown", help="Ghi báo cáo markdown ra file")
+    args = parser.parse_args()
+
+    import easyocr
+
+    samples = load_samples(args.images) if args.images else load_synthetic(args.count, args.seed)
+    if not samples:
+        parser.error(f"Không có ảnh trong {args.images}")
+    source = args.images or f"synthetic_docs seed={args.seed}"
+    with_truth = sum(1 for sample in samples if sample["truth"] is not None)
+    languages = [lang.strip() for lang in args.languages.split(",") if lang.strip()]
+    all_cores = os.cpu_count() or 1
+    pinned = default_threads(args.workers)
+
+    # (tên, quantize, số thread intra-op, torchscript)
+    modes = [
+        ("fp32/all-cores", False, all_cores, False),
+        ("int8/all-cores", True, all_cores, False),
+        (f"int8/{pinned}-threads", True, pinned, False),
+        (f"int8/{pinned}-threads/torchscript", True, pinned, True),
+    ]
+
+    report = {"source": source, "samples": len(samples), "workers": args.workers, "cpu_count": all_cores,
+              "reference": f"văn bản chuẩn ({with_truth} ảnh), còn lại kết quả fp32", "modes": []}
+    baseline = None
+    print(f"{len(samples)} ảnh, {args.workers} worker, {all_cores} core")
+    print(f"{'mode':>32} {'load s':>7} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>7} {'CER':>7}")
+    for name, quantize, threads, torchscript in modes:
+        configure_torch_threads(threads)
+        start = time.perf_counter()
+        reader = tune_reader(easyocr.Reader(languages, verbose=False, **reader_options(quantize)), torchscript=False)
+        # Trace thất bại hoặc lệch kết quả thì chế độ này chạy model gốc, báo cáo ghi rõ
+        traced = trace_recognizer(reader) if torchscript else False
+        load_s = time.perf_counter() - start
+
+        read_text(reader, samples[0]["image"])  # làm nóng
+        texts, latencies = measure(reader, samples, args.repeat)
+        if baseline is None:
+            baseline = texts
+        errors = [cer(sample["truth"] if sample["truth"] is not None else reference, text)
+                  for sample, reference, text in zip(samples, baseline, texts)]
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        entry = {
+            "mode": name,
+            "quantize": quantize,
+            "threads": threads,
+            "torchscript": traced,
+            "load_s": round(load_s, 2),
+            "p50_ms": round(statistics.median(latencies_ms), 1),
+            "p95_ms": round(latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.95))], 1),
+            "images_per_s": round(throughput(reader, samples, args.workers), 2),
+            "cer": round(statistics.mean(errors), 4),
+        }
+        report["modes"].append(entry)
+        print(f"{name:>32} {entry['load_s']:>7.1f} {entry['p50_ms']:>8.1f} {entry['p95_ms']:>8.1f} "
+              f"{entry['images_per_s']:>7.2f} {entry['cer']:>7.4f}")
+        del reader
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ Đã ghi {args.json}")
+    if args.markdown:
+        with open(args.markdown, "w", encoding="utf-8") as f:
+            f.write(to_markdown(report))
+        print(f"✅ Đã ghi {args.markdown}")
+
+
+if __name__ == "__main__":
+    main()
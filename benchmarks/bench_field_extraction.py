@@ -0,0 +1,88 @@
+﻿# benchmarks/bench_field_extraction.py - Thời gian trích xuất trường theo vị trí box trên trang nhiều token
+#
+#   python benchmarks/bench_field_extraction.py
+#   python benchmarks/bench_field_extraction.py --tokens 1000 5000 20000
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.columnar import Detections
+from services.field_extraction import FieldExtractor, GridIndex
+
+WORDS = ["Tên hàng", "Số lượng", "Đơn giá", "Thành tiền", "cái", "hộp", "12", "150.000", "Ghi chú", "VND"]
+# Nhãn và giá trị cần tìm, đặt rải trong trang: (nhãn, giá trị, hướng)
+FIELDS = [
+    ("Số HD: HD-2024-001", None, "inline"),
+    ("Ngày", "15/01/2024", "right"),
+    ("Khách hàng", "Công ty TNHH Minh Phát", "below"),
+    ("Mã số thuế", "0101234567", "right"),
+    ("Tổng cộng:", "12.500.000", "right"),
+]
+EXPECTED = {
+    "invoice_number": "HD-2024-001",
+    "date": "15/01/2024",
+    "customer": "Công ty TNHH Minh Phát",
+    "tax_code": "0101234567",
+    "total_amount": "12.500.000",
+}
+
+
+def _box(x, y, w, h=24):
+    return [[x, y], [x + w, y], [x + w, y + h], [x, y + h]]
+
+
+def synthetic_page(tokens, seed=0):
+    """Trang hoá đơn: phần đầu có các nhãn + giá trị, bên dưới là bảng token ngẫu nhiên"""
+    rng = random.Random(seed)
+    per_row = max(10, int(tokens ** 0.5))
+    results = []
+    for i, (label, value, direction) in enumerate(FIELDS):
+        x, y = 40 + (i % 2) * 600, 40 + (i // 2) * 90
+        results.append((_box(x, y, 130), label, 0.95))
+        if direction == "right":
+            results.append((_box(x + 140, y, 150), value, 0.9))
+        elif direction == "below":
+            results.append((_box(x, y + 32, 260), value, 0.9))
+
+    top = 40 + (len(FIELDS) // 2 + 1) * 90
+    for i in range(tokens):
+        row, col = divmod(i, per_row)
+        results.append((_box(40 + col * 160, top + row * 36, 120), rng.choice(WORDS), rng.uniform(0.5, 1.0)))
+    rng.shuffle(results)
+    return Detections.from_readtext(results)
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark trích xuất trường theo box")
+    parser.add_argument("--tokens", nargs="+", type=int, default=[500, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    extractor = FieldExtractor()
+    print(f"{'tokens':>8} {'index ms':>9} {'extract ms':>11} {'us/token':>9} {'fields':>7}")
+    for tokens in args.tokens:
+        page = synthetic_page(tokens)
+        bounds = page.bounds().astype("float32")
+        fields = extractor.extract(page, "invoice")
+        found = sum(1 for name, value in EXPECTED.items() if fields.get(name, {}).get("value") == value)
+
+        index_s = best_time(lambda: GridIndex(bounds), args.repeat)
+        extract_s = best_time(lambda: extractor.extract(page, "invoice"), args.repeat)
+        print(f"{len(page):>8} {index_s * 1000:>9.2f} {extract_s * 1000:>11.2f} "
+              f"{extract_s / len(page) * 1e6:>9.2f} {found:>4}/{len(EXPECTED)}")
+
+
+if __name__ == "__main__":
+    main()
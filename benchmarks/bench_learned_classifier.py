@@ -0,0 +1,113 @@
+﻿# benchmarks/bench_learned_classifier.py - So sánh engine rules và learned: độ chính xác, tốc độ, thời gian nạp
+#
+#   python benchmarks/bench_learned_classifier.py                 # dữ liệu tổng hợp
+#   python benchmarks/bench_learned_classifier.py --data labelled.jsonl
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from document_classifier import DocumentClassifier
+from learned_classifier import LearnedClassifier, evaluate, load_dataset
+
+TEMPLATES = {
+    "invoice": [
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG\nSố HD: HD-{n}\nNgày {d}\nKhách hàng: Công ty {name}\nĐơn giá: {m}\nThành tiền: {m}\nTổng cộng: {m} VND",
+        "INVOICE\nMã số thuế: {n}\nTên hàng hóa dịch vụ\nSố lượng {n}\nThuế suất GTGT 10%\nTổng tiền thanh toán: {m}",
+    ],
+    "contract": [
+        "HỢP ĐỒNG MUA BÁN\nBên A: Công ty {name}\nBên B: Ông {name}\nĐiều 1: Điều khoản chung\nHai bên thỏa thuận ký kết hợp đồng ngày {d}",
+        "HỢP ĐỒNG LAO ĐỘNG\nĐiều 2: Thời hạn và công việc\nNgười sử dụng lao động và người lao động cam kết thực hiện đúng các điều khoản",
+    ],
+    "id_card": [
+        "CĂN CƯỚC CÔNG DÂN\nSố: {n}\nHọ và tên: {name}\nNgày sinh: {d}\nQuốc tịch: Việt Nam\nQuê quán: {name}",
+        "CHỨNG MINH NHÂN DÂN\nSố: {n}\nHọ tên: {name}\nSinh ngày {d}\nNguyên quán: {name}\nNơi ĐKHK thường trú",
+    ],
+    "driver_license": [
+        "GIẤY PHÉP LÁI XE\nDRIVER'S LICENSE\nSố/No: {n}\nHọ tên: {name}\nHạng: B2\nNgày cấp {d}\nNơi cấp: Sở GTVT",
+        "BẰNG LÁI XE\nHạng A1\nCó giá trị đến {d}\nĐiều khiển xe mô tô hai bánh\nNgười cấp: {name}",
+    ],
+    "receipt": [
+        "BIÊN LAI THU TIỀN\nNgười nộp: {name}\nSố tiền: {m}\nLý do nộp: học phí\nĐã nhận đủ ngày {d}",
+        "PHIẾU THU\nQuyển số {n}\nHọ tên người nộp tiền: {name}\nViết bằng chữ: {name} đồng\nThủ quỹ",
+    ],
+    "resume": [
+        "SƠ YẾU LÝ LỊCH\nHọ và tên: {name}\nHọc vấn: Đại học {name}\nKinh nghiệm làm việc: {n} năm\nKỹ năng: giao tiếp",
+        "CURRICULUM VITAE\nMục tiêu nghề nghiệp\nKinh nghiệm: lập trình viên tại {name}\nKỹ năng chuyên môn\nSở thích",
+    ],
+    "certificate": [
+        "CHỨNG CHỈ\nChứng nhận ông/bà {name}\nĐã hoàn thành khóa học {name}\nXếp loại: Giỏi\nNgày {d}",
+        "BẰNG TỐT NGHIỆP ĐẠI HỌC\nHiệu trưởng trường {name}\nCấp bằng tốt nghiệp cho {name}\nNgành đào tạo\nSố hiệu bằng {n}",
+    ],
+}
+NAMES = ["Nguyễn Văn An", "Trần Thị Bình", "ABC", "Minh Phát", "Lê Hoàng", "Hà Nội", "Sài Gòn", "Phạm Thu"]
+
+
+def _strip_accents(text, rng, rate):
+    """Giả lập lỗi OCR: mất dấu ngẫu nhiên"""
+    out = []
+    for ch in text:
+        if rng.random() < rate:
+            ch = unicodedata.normalize("NFD", ch)[0]
+        out.append(ch)
+    return "".join(out)
+
+
+def synthetic_dataset(per_label=300, noise=0.15, seed=0):
+    rng = random.Random(seed)
+    texts, labels = [], []
+    for label, templates in TEMPLATES.items():
+        for _ in range(per_label):
+            text = rng.choice(templates).format(
+                n=rng.randint(1000, 999999999),
+                d=f"{rng.randint(1, 28)}/{rng.randint(1, 12)}/{rng.randint(1990, 2025)}",
+                m=f"{rng.randint(1, 999)}.{rng.randint(100, 999)}.000",
+                name=rng.choice(NAMES),
+            )
+            lines = text.split("\n")
+            # Bỏ bớt dòng và làm nhiễu như kết quả OCR thật
+            lines = [line for line in lines if rng.random() > 0.2] or lines[:1]
+            texts.append(_strip_accents("\n".join(lines), rng, noise))
+            labels.append(label)
+    order = list(range(len(texts)))
+    rng.shuffle(order)
+    return [texts[i] for i in order], [labels[i] for i in order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark engine rules vs learned")
+    parser.add_argument("--data", help="Dữ liệu có nhãn (.jsonl hoặc thư mục); mặc định sinh dữ liệu tổng hợp")
+    parser.add_argument("--test-ratio", type=float, default=0.3)
+    parser.add_argument("--features", type=int, default=2 ** 16)
+    args = parser.parse_args()
+
+    texts, labels = load_dataset(args.data) if args.data else synthetic_dataset()
+    split = int(len(texts) * (1 - args.test_ratio))
+    train_x, train_y, test_x, test_y = texts[:split], labels[:split], texts[split:], labels[split:]
+
+    start = time.perf_counter()
+    model = LearnedClassifier.train(train_x, train_y, n_features=args.features)
+    train_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "classifier.npz")
+        model.save(path)
+        size_kb = os.path.getsize(path) / 1024
+        start = time.perf_counter()
+        learned = DocumentClassifier(engine="learned", model_path=path)
+        load_ms = (time.perf_counter() - start) * 1000
+
+    rules = DocumentClassifier(engine="rules")
+    print(f"train: {len(train_x)} mẫu, {train_s:.2f}s | test: {len(test_x)} mẫu | model: {size_kb:.1f} KB, nạp {load_ms:.1f} ms")
+    print(f"{'engine':>8} {'accuracy':>9} {'docs/s':>10} {'us/doc':>8}")
+    for name, classifier in (("rules", rules), ("learned", learned)):
+        result = evaluate(lambda text: classifier.classify(text)[0], test_x, test_y)
+        print(f"{name:>8} {result['accuracy']:>9.3f} {result['docs_per_second']:>10.1f} {result['us_per_doc']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+﻿# benchmarks/bench_normalizer.py - So sánh normalize_vietnamese một lượt với cách thay thế 22 lần trước đây
+#
+#   python benchmarks/bench_normalizer.py                      # văn bản tổng hợp
+#   python benchmarks/bench_normalizer.py --input ocr_out/*.txt # kết quả OCR thật
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.smart_ocr import ENCODING_FIXES, normalize_vietnamese, normalize_vietnamese_stream
+
+SAMPLE = (
+    "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM\nĐộc lập - Tự do - Hạnh phúc\n"
+    "HỢP ĐỒNG MUA BÁN HÀNG HÓA   Số: 12/2024/HĐMB\n"
+    "Bên A: Công ty TNHH Thương mại Dịch vụ Minh Phát, địa chỉ: 123 Nguyễn Trãi, Quận 1\n"
+    "Bên B: Ông Trần Văn Bình   Điện thoại: 0901 234 567\n"
+    "Điều 1. Hai bên thỏa thuận ký kết hợp đồng với các điều khoản sau đây.\n"
+)
+
+
+def legacy_normalize(text):
+    """Cách cũ: 22 lần str.replace, NFC và re.sub không biên dịch sẵn"""
+    if not text:
+        return text
+    for wrong, correct in ENCODING_FIXES.items():
+        text = text.replace(wrong, correct)
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_variants(size, seed=0):
+    """Các dạng văn bản OCR hay gặp: ASCII, tiếng Việt NFC sạch, NFD, có lỗi mã hoá"""
+    rng = random.Random(seed)
+    base = (SAMPLE * (size // len(SAMPLE) + 1))[:size]
+    mojibake = base.encode("utf-8").decode("cp1252", errors="replace")
+    broken = "".join(m if rng.random() < 0.05 else b for b, m in zip(base, mojibake))
+    return {
+        "ascii": unicodedata.normalize("NFKD", base).encode("ascii", "ignore").decode(),
+        "clean": base,
+        "nfd": unicodedata.normalize("NFD", base),
+        "mojibake": broken,
+    }
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def chunked(text, size=64 * 1024):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark normalize_vietnamese")
+    parser.add_argument("--input", nargs="*", help="File văn bản OCR thật (UTF-8)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1024, 100 * 1024, 10 * 1024 * 1024])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = []
+    if args.input:
+        for path in args.input:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                cases.append((os.path.basename(path), f.read()))
+    else:
+        for size in args.sizes:
+            for name, text in make_variants(size).items():
+                cases.append((f"{name}/{size // 1024}K", text))
+
+    print(f"{'case':>18} {'legacy ms':>11} {'new ms':>9} {'speedup':>8} {'stream ms':>10}")
+    for name, text in cases:
+        expected = legacy_normalize(text)
+        assert normalize_vietnamese(text) == expected, f"{name}: kết quả khác nhau"
+        assert "".join(normalize_vietnamese_stream(chunked(text))) == (expected or ""), f"{name}: stream khác nhau"
+
+        repeat = args.repeat * (100 if len(text) < 10 * 1024 else 1)
+        old_s = best_time(lambda: legacy_normalize(text), repeat)
+        new_s = best_time(lambda: normalize_vietnamese(text), repeat)
+        stream_s = best_time(lambda: "".join(normalize_vietnamese_stream(chunked(text))), repeat)
+        print(f"{name:>18} {old_s * 1000:>11.3f} {new_s * 1000:>9.3f} {old_s / new_s:>7.2f}x {stream_s * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+﻿# benchmarks/bench_ocr.py - Benchmark / load test OCR trên tài liệu tổng hợp: độ trễ, throughput, RAM, HTTP /ocr
+#
+#   python benchmarks/bench_ocr.py --json before.json                       # latency, throughput, memory
+#   python benchmarks/bench_ocr.py --suites http --concurrency 8 --requests 64 --json http.json
+#   python benchmarks/bench_ocr.py --suites http --url http://127.0.0.1:8000   # server đang chạy sẵn
+#   python benchmarks/bench_ocr.py --compare before.json after.json --tolerance 0.1
+#
+# Tài liệu sinh bằng synthetic_docs.py (cố định theo --seed), hoặc --images <thư mục> như bench_cpu_inference.py.
+# Suite http tự chạy uvicorn main:app trên cổng trống (cache kết quả tắt, trừ khi --cache).
+# --compare in chênh lệch từng chỉ số và thoát mã 1 khi có chỉ số xấu đi quá --tolerance.
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+from synthetic_docs import KINDS, encode_png, generate
+from bench_cpu_inference import cer, load_samples
+from services.metrics import readtext_staged, stage_totals
+from services.smart_ocr import normalize_vietnamese
+
+SUITES = ("latency", "throughput", "memory", "http")
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+def latency_summary(seconds):
+    ms = [value * 1000 for value in seconds]
+    return {
+        "p50_ms": round(statistics.median(ms), 1) if ms else 0.0,
+        "p95_ms": round(percentile(ms, 0.95), 1),
+        "p99_ms": round(percentile(ms, 0.99), 1),
+        "mean_ms": round(statistics.mean(ms), 1) if ms else 0.0,
+    }
+
+
+def rss_mb(pid="self"):
+    """(RSS hiện tại, RSS cao nhất) MB; đọc /proc trên Linux, nơi khác dùng getrusage (chỉ tiến trình này)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        if pid != "self":
+            return None, None
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả KB, macOS trả byte
+        peak_mb = peak / 1048576 if sys.platform == "darwin" else peak / 1024
+        return None, peak_mb
+
+
+def load_documents(args):
+    if args.images:
+        return [{"name": sample["name"], "image": sample["image"], "truth": sample["truth"],
+                 "kind": "sample"} for sample in load_samples(args.images)]
+    documents = generate(args.count, args.kinds, args.seed, noise=args.noise, skew=args.skew, font_path=args.font)
+    for document in documents:
+        document["truth"] = normalize_vietnamese(document["truth"])
+    return documents
+
+
+def read_text(reader, image):
+    # readtext_staged để báo cáo được thời gian detection / recognition
+    return normalize_vietnamese("\n".join(result[1] for result in readtext_staged(reader, image)))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_latency(reader, documents, repeat):
+    """Độ trễ từng ảnh chạy tuần tự (lấy lần nhanh nhất trong repeat), CER theo văn bản chuẩn, thời gian từng bước"""
+    before = stage_totals()
+    seconds, errors, by_kind = [], [], {}
+    for document in documents:
+        best, text = float("inf"), ""
+        for _ in range(repeat):
+            start = time.perf_counter()
+            text = read_text(reader, document["image"])
+            best = min(best, time.perf_counter() - start)
+        error = cer(document["truth"], text) if document["truth"] is not None else None
+        seconds.append(best)
+        kind = by_kind.setdefault(document["kind"], {"seconds": [], "cer": []})
+        kind["seconds"].append(best)
+        if error is not None:
+            errors.append(error)
+            kind["cer"].append(error)
+
+    stages = {}
+    for name, totals in stage_totals().items():
+        count = totals["count"] - before.get(name, {}).get("count", 0)
+        if count:
+            stages[name] = round((totals["seconds"] - before.get(name, {}).get("seconds", 0.0)) / count * 1000, 2)
+    return {
+        "images": len(documents),
+        **latency_summary(seconds),
+        "cer": round(statistics.mean(errors), 4) if errors else None,
+        "by_kind": {kind: {**latency_summary(values["seconds"]),
+                           "cer": round(statistics.mean(values["cer"]), 4) if values["cer"] else None}
+                    for kind, values in by_kind.items()},
+        # Trung bình mỗi lần gọi (ms); rỗng khi OCR_METRICS=0
+        "stages_ms": stages,
+    }
+
+
+def run_throughput(reader, documents, workers, rounds):
+    """Ảnh/giây qua OCRExecutor với workers worker (OCR_BACKEND quyết định thread hay process)"""
+    from services.ocr_executor import OCRExecutor
+
+    executor = OCRExecutor(lambda: reader, workers=workers)
+    images = [document["image"] for document in documents] * rounds
+
+    async def run():
+        # Giữ số việc gửi đi trong sức chứa của executor để không bị từ chối vì hàng đợi đầy
+        window = asyncio.Semaphore(executor.capacity)
+
+        async def one(image):
+            async with window:
+                await executor.readtext(image)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(image) for image in images))
+        return time.perf_counter() - start
+
+    try:
+        executor.warm_up()
+        wall = asyncio.run(run())
+    finally:
+        executor.shutdown()
+    return {"workers": workers, "backend": executor.backend, "images": len(images),
+            "wall_s": round(wall, 2), "images_per_s": round(len(images) / wall, 2)}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, cache, ready_timeout):
+    """uvicorn main:app trên cổng trống; chờ /ready trả 200"""
+    import httpx
+
+    port = _free_port()
+    env = dict(os.environ, OCR_WORKERS=str(workers), PORT=str(port))
+    if not cache:
+        env["OCR_CACHE_MAX_BYTES"] = "0"
+        env["OCR_CACHE_DIR"] = ""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + ready_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn thoát với mã {process.returncode}")
+        try:
+            if httpx.get(f"{url}/ready", timeout=2).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Server chưa sẵn sàng sau {ready_timeout}s")
+
+
+async def http_load(url, payloads, concurrency, requests, timeout):
+    """requests lần POST /ocr với tối đa concurrency request đồng thời"""
+    import logging
+    import httpx
+
+    # httpx log từng request ở mức INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    semaphore = asyncio.Semaphore(concurrency)
+    seconds, statuses = [], {}
+
+    async def one(client, index):
+        name, data = payloads[index % len(payloads)]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{url}/ocr", files={"file": (name, data, "image/png")})
+                status = str(response.status_code)
+                if response.status_code == 200 and not response.json().get("success", False):
+                    status = "200-error"
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+        statuses[status] = statuses.get(status, 0) + 1
+        if status == "200":
+            seconds.append(elapsed)
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        # Một request làm nóng (không tính)
+        name, data = payloads[0]
+        await client.post(f"{url}/ocr", files={"file": (name, data, "image/png")})
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client, index) for index in range(requests)))
+        wall = time.perf_counter() - start
+    return seconds, statuses, wall
+
+
+def run_http(documents, args):
+    payloads = [(document["name"], encode_png(document["image"])) for document in documents]
+    process = None
+    url = args.url
+    if url is None:
+        process, url = start_server(args.workers, args.cache, args.ready_timeout)
+    try:
+        seconds, statuses, wall = asyncio.run(http_load(url, payloads, args.concurrency, args.requests, args.timeout))
+        server_rss = rss_mb(process.pid) if process is not None else (None, None)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+    ok = statuses.get("200", 0)
+    return {
+        "url": url if process is None else "local",
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "ok": ok,
+        "statuses": statuses,
+        "wall_s": round(wall, 2),
+        "requests_per_s": round(ok / wall, 2) if wall else 0.0,
+        **latency_summary(seconds),
+        "server_rss_mb": round(server_rss[0], 1) if server_rss[0] else None,
+        "server_peak_mb": round(server_rss[1], 1) if server_rss[1] else None,
+    }
+
+
+def run(args):
+    documents = load_documents(args)
+    if not documents:
+        raise SystemExit("Không có tài liệu để benchmark")
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "documents": len(documents),
+            "seed": args.seed,
+            "env": {key: value for key, value in sorted(os.environ.items()) if key.startswith("OCR_")},
+        }
+    }
+    print(f"📄 {len(documents)} tài liệu ({', '.join(sorted({document['kind'] for document in documents}))})")
+
+    local = [suite for suite in args.suites if suite != "http"]
+    if local:
+        from services.reader_registry import get_reader_registry
+
+        before_mb, _ = rss_mb()
+        start = time.perf_counter()
+        reader = get_reader_registry().get(args.languages.split(","))
+        load_s = time.perf_counter() - start
+        read_text(reader, documents[0]["image"])  # làm nóng
+        loaded_mb, _ = rss_mb()
+        print(f"✅ Reader sẵn sàng sau {load_s:.1f}s")
+
+        if "latency" in args.suites:
+            report["latency"] = {"load_s": round(load_s, 2), **run_latency(reader, documents, args.repeat)}
+            latency = report["latency"]
+            print(f"⏱️  latency: p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, CER {latency['cer']}")
+        if "throughput" in args.suites:
+            report["throughput"] = run_throughput(reader, documents, args.workers, args.rounds)
+            print(f"⚡ throughput: {report['throughput']['images_per_s']} ảnh/s với {args.workers} worker")
+        if "memory" in args.suites:
+            current_mb, peak_mb = rss_mb()
+            report["memory"] = {
+                "rss_before_load_mb": round(before_mb, 1) if before_mb else None,
+                "rss_after_load_mb": round(loaded_mb, 1) if loaded_mb else None,
+                "rss_mb": round(current_mb, 1) if current_mb else None,
+                "peak_mb": round(peak_mb, 1) if peak_mb else None,
+            }
+            print(f"💾 memory: peak {report['memory']['peak_mb']} MB")
+
+    if "http" in args.suites:
+        report["http"] = run_http(documents, args)
+        http = report["http"]
+        print(f"🌐 http: {http['requests_per_s']} req/s, p50 {http['p50_ms']} ms, p95 {http['p95_ms']} ms, "
+              f"trạng thái {http['statuses']}")
+    return report
+
+
+# Hướng tốt của chỉ số theo hậu tố tên: True = càng cao càng tốt
+_DIRECTIONS = (("per_s", True), ("_ms", False), ("_mb", False), ("load_s", False), ("cer", False))
+
+
+def _flatten(report, prefix=""):
+    for key, value in report.items():
+        if key in ("meta", "statuses"):
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def _direction(name):
+    leaf = name.rsplit(".", 1)[-1]
+    for suffix, higher_better in _DIRECTIONS:
+        if leaf.endswith(suffix):
+            return higher_better
+    return None
+
+
+def compare(base_path, new_path, tolerance):
+    """In chênh lệch các chỉ số; trả về số chỉ số xấu đi quá tolerance"""
+    with open(base_path, encoding="utf-8") as f:
+        base = dict(_flatten(json.load(f)))
+    with open(new_path, encoding="utf-8") as f:
+        new_report = json.load(f)
+    regressions = 0
+    print(f"{'chỉ số':<40} {'trước':>10} {'sau':>10} {'thay đổi':>9}")
+    for name, value in _flatten(new_report):
+        higher_better = _direction(name)
+        if higher_better is None or name not in base:
+            continue
+        old = base[name]
+        change = (value - old) / old if old else 0.0
+        worse = -change if higher_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = " ❌"
+            regressions += 1
+        elif worse < -tolerance:
+            flag = " ✅"
+        print(f"{name:<40} {old:>10} {value:>10} {change:>+8.1%}{flag}")
+    print(f"{'⚠️' if regressions else '✅'} {regressions} chỉ số xấu đi quá {tolerance:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark / load test OCR trên tài liệu tổng hợp")
+    parser.add_argument("--suites", nargs="+", default=["latency", "throughput", "memory"], choices=SUITES)
+    parser.add_argument("--json", help="Ghi báo cáo JSON ra file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="So sánh hai báo cáo JSON, không chạy benchmark")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Mức xấu đi cho phép khi --compare (0.1 = 10%%)")
+    parser.add_argument("--images", help="Thư mục ảnh mẫu thay cho tài liệu tổng hợp")
+    parser.add_argument("--count", type=int, default=9)
+    parser.add_argument("--kinds", nargs="+", default=list(KINDS), choices=KINDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=0.04)
+    parser.add_argument("--skew", type=float, default=1.5)
+    parser.add_argument("--font", help="Font .ttf có dấu tiếng Việt (mặc định tìm font hệ thống)")
+    parser.add_argument("--languages", default="vi,en")
+    parser.add_argument("--repeat", type=int, default=1, help="Số lần đo mỗi ảnh ở suite latency (lấy nhanh nhất)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("OCR_WORKERS", 1)))
+    parser.add_argument("--rounds", type=int, default=2, help="Số vòng qua bộ ảnh ở suite throughput")
+    parser.add_argument("--url", help="Suite http: server có sẵn thay vì tự chạy uvicorn")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Timeout mỗi request HTTP, giây")
+    parser.add_argument("--ready-timeout", type=float, default=600.0, help="Thời gian chờ server nạp model, giây")
+    parser.add_argument("--cache", action="store_true", help="Suite http: giữ cache kết quả của server")
+    args = parser.parse_args()
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.tolerance) else 0
+
+    report = run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ Đã ghi {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
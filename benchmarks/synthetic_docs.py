@@ -0,0 +1,204 @@
+﻿# benchmarks/synthetic_docs.py - Sinh ảnh tài liệu tiếng Việt/Anh tổng hợp (hoá đơn, CCCD, hợp đồng) kèm văn bản chuẩn
+#
+#   python benchmarks/synthetic_docs.py --out samples/ --count 12
+#   python benchmarks/synthetic_docs.py --out samples/ --kinds id_card --noise 0 --skew 0
+#
+# Mỗi ảnh <tên>.png có <tên>.txt (văn bản chuẩn, mỗi dòng một dòng chữ) cùng thư mục, dùng được
+# trực tiếp cho bench_cpu_inference.py. Font: --font / OCR_BENCH_FONT, ngược lại tìm font hệ thống
+# có dấu tiếng Việt (DejaVu, Noto, Liberation, Arial).
+import os
+import sys
+import random
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+KINDS = ("invoice", "id_card", "contract")
+
+FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+)
+
+SURNAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Võ", "Đặng", "Bùi"]
+MIDDLE = ["Văn", "Thị", "Minh", "Hữu", "Ngọc", "Đức", "Thanh"]
+GIVEN = ["An", "Bình", "Châu", "Dũng", "Hà", "Hương", "Khánh", "Lộc", "Phúc", "Tâm", "Việt"]
+COMPANIES = ["Minh Phát", "Sao Việt", "Hoàng Long", "Đại Dương", "Phú Thịnh", "Green Leaf"]
+PROVINCES = ["Hà Nội", "Hải Phòng", "Đà Nẵng", "Thừa Thiên Huế", "Cần Thơ", "TP. Hồ Chí Minh", "Nghệ An"]
+GOODS = ["Giấy in A4", "Mực máy in", "Bàn phím", "Màn hình 24 inch", "Dịch vụ bảo trì", "Cáp mạng Cat6", "Chuột không dây"]
+CLAUSES = [
+    "Bên A đồng ý cung cấp hàng hóa theo đúng chủng loại và số lượng nêu tại Phụ lục.",
+    "Bên B thanh toán trong vòng 30 ngày kể từ ngày nhận hóa đơn hợp lệ.",
+    "Hai bên cam kết thực hiện đúng các điều khoản đã thỏa thuận trong hợp đồng.",
+    "Mọi tranh chấp được giải quyết bằng thương lượng, hòa giải tại Tòa án có thẩm quyền.",
+    "The parties agree that this contract is governed by the laws of Vietnam.",
+    "Hợp đồng có hiệu lực kể từ ngày ký và được lập thành hai bản có giá trị như nhau.",
+]
+
+
+def find_font(path: Optional[str] = None) -> str:
+    """Font TrueType có dấu tiếng Việt; không có thì báo lỗi thay vì vẽ bằng font bitmap mất dấu"""
+    for candidate in (path, os.getenv("OCR_BENCH_FONT")) + FONT_CANDIDATES:
+        if candidate and os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError("Không tìm thấy font có dấu tiếng Việt; chỉ định bằng --font hoặc OCR_BENCH_FONT")
+
+
+def _name(rng) -> str:
+    return f"{rng.choice(SURNAMES)} {rng.choice(MIDDLE)} {rng.choice(GIVEN)}"
+
+
+def _date(rng, start=1960, end=2024) -> str:
+    return f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(start, end)}"
+
+
+def _money(value: int) -> str:
+    return f"{value:,}".replace(",", ".")
+
+
+def _invoice(rng) -> Tuple[List[Tuple[str, int]], Dict[str, str]]:
+    fields = {
+        "invoice_number": f"HD-{rng.randint(2020, 2024)}-{rng.randint(1, 9999):04d}",
+        "date": _date(rng, 2020, 2024),
+        "customer": f"Công ty TNHH {rng.choice(COMPANIES)}",
+        "tax_code": str(rng.randint(10 ** 9, 10 ** 10 - 1)),
+    }
+    lines = [("HÓA ĐƠN GIÁ TRỊ GIA TĂNG", 2), (f"Số HD: {fields['invoice_number']}", 0),
+             (f"Ngày {fields['date']}", 0), (f"Khách hàng: {fields['customer']}", 0),
+             (f"Mã số thuế: {fields['tax_code']}", 0), ("Tên hàng    Số lượng    Đơn giá    Thành tiền", 1)]
+    total = 0
+    for _ in range(rng.randint(3, 7)):
+        quantity, price = rng.randint(1, 20), rng.randint(5, 500) * 1000
+        total += quantity * price
+        lines.append((f"{rng.choice(GOODS)}    {quantity}    {_money(price)}    {_money(quantity * price)}", 0))
+    fields["total_amount"] = _money(total)
+    lines.append((f"Tổng cộng: {fields['total_amount']} VND", 1))
+    return lines, fields
+
+
+def _id_card(rng) -> Tuple[List[Tuple[str, int]], Dict[str, str]]:
+    fields = {
+        "id_number": "0" + "".join(str(rng.randint(0, 9)) for _ in range(11)),
+        "name": _name(rng).upper(),
+        "birthday": _date(rng, 1960, 2005),
+        "nationality": "Việt Nam",
+        "hometown": rng.choice(PROVINCES),
+    }
+    lines = [("CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM", 1), ("CĂN CƯỚC CÔNG DÂN", 2),
+             (f"Số: {fields['id_number']}", 1), (f"Họ và tên: {fields['name']}", 0),
+             (f"Ngày sinh: {fields['birthday']}", 0), (f"Quốc tịch: {fields['nationality']}", 0),
+             (f"Quê quán: {fields['hometown']}", 0), (f"Có giá trị đến: {_date(rng, 2030, 2045)}", 0)]
+    return lines, fields
+
+
+def _contract(rng) -> Tuple[List[Tuple[str, int]], Dict[str, str]]:
+    fields = {"party_a": f"Công ty {rng.choice(COMPANIES)}", "party_b": _name(rng), "date": _date(rng, 2020, 2024)}
+    lines = [("HỢP ĐỒNG MUA BÁN", 2), (f"Số: {rng.randint(1, 999)}/{rng.randint(2020, 2024)}/HĐMB", 0),
+             (f"Hôm nay, ngày {fields['date']}, chúng tôi gồm:", 0),
+             (f"Bên A: {fields['party_a']}", 0), (f"Bên B: Ông/Bà {fields['party_b']}", 0)]
+    for number, clause in enumerate(rng.sample(CLAUSES, 4), 1):
+        lines.append((f"Điều {number}:", 1))
+        lines.append((clause, 0))
+    return lines, fields
+
+
+_BUILDERS = {"invoice": _invoice, "id_card": _id_card, "contract": _contract}
+# (cỡ trang, cỡ chữ thân văn bản) theo loại
+_LAYOUT = {"invoice": ((1240, 1754), 28), "id_card": ((1012, 638), 30), "contract": ((1240, 1754), 26)}
+
+
+def render_document(kind: str, seed: int = 0, noise: float = 0.04, skew: float = 1.5,
+                    font_path: Optional[str] = None) -> Tuple[np.ndarray, str, Dict[str, Any]]:
+    """
+    Vẽ một tài liệu tổng hợp.
+
+    Args:
+        kind: "invoice", "id_card" hoặc "contract"
+        noise: Độ lệch chuẩn nhiễu Gauss (tỷ lệ trên 255); 0 = ảnh sạch
+        skew: Góc nghiêng tối đa (độ), chọn ngẫu nhiên trong [-skew, skew]
+
+    Returns:
+        (ảnh RGB uint8, văn bản chuẩn, thông tin gồm kind, seed, fields, angle)
+    """
+    if kind not in _BUILDERS:
+        raise ValueError(f"Loại tài liệu không hỗ trợ: {kind} (hỗ trợ: {', '.join(KINDS)})")
+    rng = random.Random(f"{kind}:{seed}")
+    lines, fields = _BUILDERS[kind](rng)
+    size, body = _LAYOUT[kind]
+    font_path = find_font(font_path)
+    fonts = {level: ImageFont.truetype(font_path, int(body * scale)) for level, scale in ((0, 1.0), (1, 1.15), (2, 1.5))}
+
+    page = Image.new("RGB", size, (255, 255, 255) if kind != "id_card" else (232, 240, 236))
+    draw = ImageDraw.Draw(page)
+    margin = size[0] // 14
+    y = margin
+    for text, level in lines:
+        font = fonts[level]
+        width = draw.textlength(text, font=font)
+        # Tiêu đề căn giữa, thân văn bản căn trái
+        x = (size[0] - width) / 2 if level == 2 else margin
+        draw.text((x, y), text, fill=(20, 20, 20), font=font)
+        y += int(font.size * 1.8)
+
+    angle = rng.uniform(-skew, skew) if skew else 0.0
+    if angle:
+        page = page.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=(255, 255, 255))
+    page = page.filter(ImageFilter.GaussianBlur(0.6)) if noise else page
+    array = np.asarray(page, dtype=np.float32)
+    if noise:
+        array = array + np.random.default_rng(seed).normal(0, noise * 255, array.shape)
+    image = np.clip(array, 0, 255).astype(np.uint8)
+    truth = "\n".join(text for text, _ in lines)
+    return image, truth, {"kind": kind, "seed": seed, "fields": fields, "angle": round(angle, 2)}
+
+
+def generate(count: int, kinds=KINDS, seed: int = 0, **options) -> List[Dict[str, Any]]:
+    """count tài liệu, luân phiên các loại; mỗi phần tử gồm name, image, truth, kind, fields"""
+    documents = []
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        image, truth, info = render_document(kind, seed=seed + index, **options)
+        documents.append({"name": f"{kind}_{seed + index:04d}.png", "image": image, "truth": truth, **info})
+    return documents
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    import io
+
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sinh ảnh tài liệu tổng hợp kèm văn bản chuẩn")
+    parser.add_argument("--out", required=True, help="Thư mục ghi <tên>.png + <tên>.txt")
+    parser.add_argument("--count", type=int, default=12)
+    parser.add_argument("--kinds", nargs="+", default=list(KINDS), choices=KINDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=0.04)
+    parser.add_argument("--skew", type=float, default=1.5)
+    parser.add_argument("--font", help="Đường dẫn font .ttf có dấu tiếng Việt")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    documents = generate(args.count, args.kinds, args.seed, noise=args.noise, skew=args.skew, font_path=args.font)
+    for document in documents:
+        Image.fromarray(document["image"]).save(os.path.join(args.out, document["name"]))
+        with open(os.path.join(args.out, os.path.splitext(document["name"])[0] + ".txt"), "w", encoding="utf-8") as f:
+            f.write(document["truth"])
+    print(f"✅ Đã ghi {len(documents)} ảnh vào {args.out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,147 @@
-﻿import re
+﻿import os
+import re
 import numpy as np
-from typing import Dict, List, Tuple, Any
+from typing import Dict, Iterable, Iterator, List, Tuple, Any, Optional, Set
 import logging
 
+# Bảng regex biên dịch sẵn một lần khi import
+_DATE_RE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+_MONEY_RE = re.compile(r"\d+[.,]\d+")
+_DIGIT_RE = re.compile(r"\d")
+
+_METADATA_PATTERNS = {
+    "invoice": {
+        "invoice_number": re.compile(r"số\s*hd:\s*([a-z0-9-]+)"),
+        "date": re.compile(r"ngày\s*(\d{1,2}/\d{1,2}/\d{4})"),
+        "total_amount": re.compile(r"tổng\s*cộng:\s*([\d.,]+)"),
+        "customer": re.compile(r"khách\s*hàng:\s*([^\n]+)")
+    },
+    "id_card": {
+        "id_number": re.compile(r"số:\s*([\d]+)"),
+        "name": re.compile(r"họ\s*và\s*tên:\s*([^\n]+)"),
+        "birthday": re.compile(r"ngày\s*sinh:\s*(\d{1,2}/\d{1,2}/\d{4})")
+    }
+}
+
+
+def _trie_pattern(words: List[str]) -> str:
+    """Regex dạng trie (gộp tiền tố chung) khớp mọi từ trong words, ưu tiên từ dài nhất"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """
+    Khớp toàn bộ từ khoá của mọi danh mục trong một lượt quét văn bản.
+
+    Từ khoá được gộp thành một automaton dạng trie (biên dịch thành một regex)
+    khi khởi tạo; các từ khoá chồng lên nhau (hậu tố của từ này là tiền tố của
+    từ kia, hoặc nằm trong từ kia) được kiểm tra bổ sung tại chỗ nên kết quả
+    giống hệt việc chạy `keyword in text` cho từng từ khoá.
+    """
+
+    def __init__(self, category_keywords: Dict[str, List[str]]):
+        self.categories = list(category_keywords)
+        self.keywords = sorted({kw for keywords in category_keywords.values() for kw in keywords})
+        self._keyword_categories = {kw: [] for kw in self.keywords}
+        for category, keywords in category_keywords.items():
+            for kw in dict.fromkeys(keywords):
+                self._keyword_categories[kw].append(category)
+        self._pattern = re.compile(_trie_pattern(self.keywords)) if self.keywords else None
+        self._keyword_index = {kw: i for i, kw in enumerate(self.keywords)}
+        
+        # Ma trận từ khoá x danh mục để cộng số đếm bằng phép nhân ma trận
+        self.incidence = np.zeros((len(self.keywords), len(self.categories)), dtype=np.int64)
+        for kw, categories in self._keyword_categories.items():
+            for category in categories:
+                self.incidence[self._keyword_index[kw], self.categories.index(category)] = 1
+
+        # Từ khoá bắt đầu bên trong một từ khoá khác: (độ lệch, từ khoá)
+        self._overlaps = {}
+        for kw in self.keywords:
+            overlaps = []
+            for other in self.keywords:
+                for offset in range(0 if other != kw else 1, len(kw)):
+                    tail = kw[offset:]
+                    if other.startswith(tail) or tail.startswith(other):
+                        overlaps.append((offset, other))
+            self._overlaps[kw] = overlaps
+
+    def find(self, text_lower: str) -> Set[str]:
+        """Tập từ khoá xuất hiện trong văn bản (đã lowercase)"""
+        found = set()
+        if self._pattern is None:
+            return found
+        total = len(self.keywords)
+        for match in self._pattern.finditer(text_lower):
+            kw = match.group(0)
+            found.add(kw)
+            start = match.start()
+            for offset, other in self._overlaps[kw]:
+                if other not in found and text_lower.startswith(other, start + offset):
+                    found.add(other)
+            if len(found) == total:
+                break
+        return found
+
+    def spans(self, text_lower: str) -> Tuple[List[int], List[int]]:
+        """Mọi vị trí bắt đầu và chỉ số từ khoá khớp (kể cả chồng nhau), không dừng sớm"""
+        positions, ids = [], []
+        if self._pattern is None:
+            return positions, ids
+        for match in self._pattern.finditer(text_lower):
+            kw = match.group(0)
+            start = match.start()
+            positions.append(start)
+            ids.append(self._keyword_index[kw])
+            for offset, other in self._overlaps[kw]:
+                if text_lower.startswith(other, start + offset):
+                    positions.append(start + offset)
+                    ids.append(self._keyword_index[other])
+        return positions, ids
+
+    def count(self, text_lower: str) -> Dict[str, int]:
+        """Số từ khoá khác nhau xuất hiện theo từng danh mục"""
+        counts = dict.fromkeys(self.categories, 0)
+        for kw in self.find(text_lower):
+            for category in self._keyword_categories[kw]:
+                counts[category] += 1
+        return counts
+
+
+def _digit_features(text: str) -> Tuple[bool, bool, bool]:
+    """(has_dates, has_money, has_numbers); mẫu ngày/tiền chỉ tìm từ chữ số đầu tiên trở đi"""
+    first_digit = _DIGIT_RE.search(text)
+    if first_digit is None:
+        return False, False, False
+    start = first_digit.start()
+    return bool(_DATE_RE.search(text, start)), bool(_MONEY_RE.search(text, start)), True
+
+
 class DocumentClassifier:
-    def __init__(self):
+    """
+    Phân loại tài liệu từ văn bản OCR.
+    
+    Args:
+        engine: "rules" (điểm từ khoá + cấu trúc) hoặc "learned" (mô hình n-gram đã
+            huấn luyện, xem learned_classifier.py); mặc định OCR_CLASSIFIER_ENGINE
+        model_path: File .npz của engine learned (mặc định OCR_CLASSIFIER_MODEL)
+    """
+    
+    def __init__(self, engine: Optional[str] = None, model_path: Optional[str] = None):
         self.category_keywords = {
             "invoice": ["hóa đơn", "invoice", "số tiền", "thanh toán", "tổng cộng", "đơn giá", "thành tiền"],
             "contract": ["hợp đồng", "điều khoản", "bên a", "bên b", "ký kết", "thỏa thuận", "điều lệ"],
@@ -16,22 +153,45 @@ class DocumentClassifier:
         }
         
         self.logger = logging.getLogger(__name__)
+        
+        # Automaton từ khoá dựng một lần, dùng chung cho mọi lần phân loại
+        self.matcher = KeywordMatcher(self.category_keywords)
+        
+        self.engine = engine or os.getenv("OCR_CLASSIFIER_ENGINE", "rules")
+        self.model = None
+        if self.engine == "learned":
+            self._load_model(model_path or os.getenv("OCR_CLASSIFIER_MODEL", "models/classifier.npz"))
+        elif self.engine != "rules":
+            raise ValueError(f"Engine phân loại không hợp lệ: {self.engine}")
     
-    def extract_features(self, text: str) -> Dict[str, float]:
+    def _load_model(self, model_path: str):
+        """Nạp mô hình learned; lỗi thì quay về engine rules"""
+        from learned_classifier import LearnedClassifier
+        
+        try:
+            self.model = LearnedClassifier.load(model_path)
+            self.logger.info(f"✅ Đã nạp mô hình phân loại {model_path} ({len(self.model.categories)} nhãn)")
+        except (OSError, KeyError, ValueError) as e:
+            self.logger.warning(f"⚠️ Không nạp được mô hình phân loại {model_path}, dùng engine rules: {e}")
+            self.engine = "rules"
+    
+    def extract_features(self, text: str, text_lower: Optional[str] = None) -> Dict[str, float]:
         """Trích xuất đặc trưng từ văn bản"""
-        text_lower = text.lower()
+        if text_lower is None:
+            text_lower = text.lower()
         features = {}
         
-        # Đếm từ khóa theo danh mục
-        for category, keywords in self.category_keywords.items():
-            features[f"kw_{category}"] = sum(1 for keyword in keywords if keyword in text_lower)
+        # Đếm từ khóa theo danh mục (một lượt quét cho mọi danh mục)
+        for category, count in self.matcher.count(text_lower).items():
+            features[f"kw_{category}"] = count
         
         # Đặc trưng về độ dài và cấu trúc
+        has_dates, has_money, has_numbers = _digit_features(text)
         features["length"] = len(text)
         features["line_count"] = text.count("\n")
-        features["has_dates"] = bool(re.search(r"\d{1,2}/\d{1,2}/\d{4}", text))
-        features["has_numbers"] = bool(re.search(r"\d+", text))
-        features["has_money"] = bool(re.search(r"\d+[.,]\d+", text))
+        features["has_dates"] = has_dates
+        features["has_numbers"] = has_numbers
+        features["has_money"] = has_money
         features["word_count"] = len(text.split())
         
         return features
@@ -41,20 +201,30 @@ class DocumentClassifier:
         if not text or len(text.strip()) < 10:
             return "unknown", 0.0, {}
         
-        features = self.extract_features(text)
+        # Chỉ tính các đặc trưng dùng cho điểm số; lowercase một lần cho cả metadata
+        text_lower = text.lower()
+        
+        if self.model is not None:
+            category, confidence = self.model.predict(text_lower)
+            if category == "unknown":
+                return "unknown", 0.0, {}
+            return category, confidence, self.extract_metadata(text, category, text_lower)
+        
+        keyword_counts = self.matcher.count(text_lower)
+        has_dates, has_money, _ = _digit_features(text)
         
         # Rule-based classification với điểm số
         scores = {}
         for category in self.category_keywords.keys():
-            keyword_score = features.get(f"kw_{category}", 0)
+            keyword_score = keyword_counts.get(category, 0)
             structure_score = 0
             
             # Điểm cấu trúc dựa trên loại tài liệu
-            if category == "invoice" and features["has_money"]:
+            if category == "invoice" and has_money:
                 structure_score += 2
-            if category == "id_card" and features["has_dates"]:
+            if category == "id_card" and has_dates:
                 structure_score += 1
-            if category == "contract" and features["length"] > 500:
+            if category == "contract" and len(text) > 500:
                 structure_score += 1
             
             scores[category] = keyword_score + structure_score
@@ -70,35 +240,114 @@ class DocumentClassifier:
             
             # Ngưỡng confidence tối thiểu
             if confidence > 0.3:
-                metadata = self.extract_metadata(text, best_category)
+                metadata = self.extract_metadata(text, best_category, text_lower)
                 return best_category, round(confidence, 3), metadata
         
         return "unknown", 0.0, {}
     
-    def extract_metadata(self, text: str, doc_type: str) -> Dict[str, Any]:
+    def feature_matrix(self, texts: List[str], texts_lower: Optional[List[str]] = None) -> Tuple[np.ndarray, List[str]]:
+        """
+        Ma trận đặc trưng (n_texts x n_columns, int64) cho một nhóm văn bản.
+        Từ khoá của cả nhóm được quét một lượt trên các văn bản nối bằng ký tự NUL;
+        vị trí khớp được ánh xạ về từng văn bản bằng searchsorted.
+        
+        Returns:
+            (ma trận, tên cột): kw_<category>..., length, line_count, has_dates, has_money
+        """
+        if texts_lower is None:
+            texts_lower = [text.lower() for text in texts]
+        columns = [f"kw_{category}" for category in self.category_keywords] + ["length", "line_count", "has_dates", "has_money"]
+        n_texts = len(texts)
+        n_categories = len(self.category_keywords)
+        matrix = np.zeros((n_texts, len(columns)), dtype=np.int64)
+        if n_texts == 0:
+            return matrix, columns
+        
+        # Vị trí bắt đầu của từng văn bản trong chuỗi nối (NUL không khớp từ khoá hay chữ số)
+        lengths = np.fromiter(map(len, texts_lower), dtype=np.int64, count=n_texts)
+        starts = np.zeros(n_texts, dtype=np.int64)
+        np.cumsum(lengths[:-1] + 1, out=starts[1:])
+        joined = "\x00".join(texts_lower)
+        
+        def rows_of(positions):
+            return np.searchsorted(starts, np.asarray(positions, dtype=np.int64), side="right") - 1
+        
+        positions, ids = self.matcher.spans(joined)
+        presence = np.zeros((n_texts, len(self.matcher.keywords)), dtype=np.int64)
+        presence[rows_of(positions), np.asarray(ids, dtype=np.int64)] = 1
+        matrix[:, :n_categories] = presence @ self.matcher.incidence
+        
+        # Ngày/tiền tìm theo từng văn bản: dừng ở kết quả đầu tiên và bỏ qua văn bản không có chữ số
+        matrix[:, n_categories] = np.fromiter(map(len, texts), dtype=np.int64, count=n_texts)
+        matrix[:, n_categories + 1] = [text.count("\n") for text in texts]
+        matrix[:, n_categories + 2:] = [_digit_features(text)[:2] for text in texts]
+        return matrix, columns
+    
+    def iter_classify_batch(self, texts: Iterable[str], chunk_size: int = 4096) -> Iterator[Tuple[str, float, Dict[str, Any]]]:
+        """
+        Phân loại nhiều văn bản, tính điểm bằng phép toán mảng theo từng chunk
+        (chỉ giữ chunk_size văn bản trong bộ nhớ). Kết quả giống hệt classify.
+        """
+        if self.model is not None:
+            # Engine learned đã chấm điểm thưa theo từng văn bản
+            for text in texts:
+                yield self.classify(text)
+            return
+        
+        categories = list(self.category_keywords)
+        n_categories = len(categories)
+        category_index = {category: i for i, category in enumerate(categories)}
+        total_possible = np.array([max(len(self.category_keywords[c]) + 2, 1) for c in categories], dtype=np.float64)
+        
+        chunk = []
+        for text in texts:
+            chunk.append(text)
+            if len(chunk) >= chunk_size:
+                yield from self._classify_chunk(chunk, categories, n_categories, category_index, total_possible)
+                chunk = []
+        if chunk:
+            yield from self._classify_chunk(chunk, categories, n_categories, category_index, total_possible)
+    
+    def classify_batch(self, texts: Iterable[str], chunk_size: int = 4096) -> List[Tuple[str, float, Dict[str, Any]]]:
+        """Phân loại nhiều văn bản, trả về danh sách kết quả theo thứ tự đầu vào"""
+        return list(self.iter_classify_batch(texts, chunk_size=chunk_size))
+    
+    def _classify_chunk(self, texts, categories, n_categories, category_index, total_possible):
+        valid = [bool(text) and len(text.strip()) >= 10 for text in texts]
+        texts_lower = [text.lower() if ok else "" for text, ok in zip(texts, valid)]
+        matrix, _ = self.feature_matrix(texts, texts_lower)
+        
+        # Cùng quy tắc điểm cấu trúc như classify
+        scores = matrix[:, :n_categories].copy()
+        length, has_dates, has_money = matrix[:, n_categories], matrix[:, n_categories + 2], matrix[:, n_categories + 3]
+        scores[:, category_index["invoice"]] += 2 * has_money
+        scores[:, category_index["id_card"]] += has_dates
+        scores[:, category_index["contract"]] += length > 500
+        
+        # argmax lấy vị trí lớn nhất đầu tiên, giống max(dict) theo thứ tự danh mục
+        best = scores.argmax(axis=1)
+        rows = np.arange(len(texts))
+        confidence = np.minimum(scores[rows, best] / total_possible[best], 1.0)
+        
+        for row, text in enumerate(texts):
+            if not valid[row] or not confidence[row] > 0.3:
+                yield "unknown", 0.0, {}
+                continue
+            category = categories[best[row]]
+            metadata = self.extract_metadata(text, category, texts_lower[row])
+            yield category, round(float(confidence[row]), 3), metadata
+    
+    def extract_metadata(self, text: str, doc_type: str, text_lower: Optional[str] = None) -> Dict[str, Any]:
         """Trích xuất metadata dựa trên loại tài liệu"""
         metadata = {}
-        text_lower = text.lower()
+        if text_lower is None:
+            text_lower = text.lower()
         
         try:
-            if doc_type == "invoice":
-                patterns = {
-                    "invoice_number": r"số\s*hd:\s*([a-z0-9-]+)",
-                    "date": r"ngày\s*(\d{1,2}/\d{1,2}/\d{4})",
-                    "total_amount": r"tổng\s*cộng:\s*([\d.,]+)",
-                    "customer": r"khách\s*hàng:\s*([^\n]+)"
-                }
-            elif doc_type == "id_card":
-                patterns = {
-                    "id_number": r"số:\s*([\d]+)",
-                    "name": r"họ\s*và\s*tên:\s*([^\n]+)",
-                    "birthday": r"ngày\s*sinh:\s*(\d{1,2}/\d{1,2}/\d{4})"
-                }
-            else:
-                patterns = {}
+            patterns = _METADATA_PATTERNS.get(doc_type, {})
             
             for key, pattern in patterns.items():
-                match = re.search(pattern, text_lower)
+                match = pattern.search(text_lower)
                 if match:
                     metadata[key] = match.group(1).strip()
                     
@@ -0,0 +1,234 @@
+﻿import os
+import re
+import sys
+import json
+import zlib
+import time
+import logging
+import argparse
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+_DATE_RE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+_MONEY_RE = re.compile(r"\d+[.,]\d+")
+_DIGITS_RE = re.compile(r"\d")
+
+
+def hash_features(text_lower: str, n_features: int, ngram: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Đặc trưng thưa của văn bản: n-gram từ (1..ngram) băm vào n_features ô, cộng
+    vài token cấu trúc (ngày, tiền, độ dài). Giá trị là log(1 + số lần), chuẩn hoá L2.
+
+    Returns:
+        (chỉ số int32 không trùng, giá trị float32)
+    """
+    # Chữ số được gộp về 0 để các số khác nhau dùng chung đặc trưng
+    tokens = _TOKEN_RE.findall(_DIGITS_RE.sub("0", text_lower))
+    if _DATE_RE.search(text_lower):
+        tokens.append("__date__")
+    if _MONEY_RE.search(text_lower):
+        tokens.append("__money__")
+    tokens.append(f"__len{min(len(text_lower).bit_length(), 16)}__")
+
+    # crc32 ổn định giữa các tiến trình (khác hash()); n-gram ghép từ hash của từng từ
+    crc32 = zlib.crc32
+    hashes = [crc32(token.encode("utf-8")) for token in tokens]
+    counts = {}
+    grams = hashes
+    for n in range(1, ngram + 1):
+        if n > 1:
+            grams = [(prev * 1000003 + h) & 0xFFFFFFFFFFFF for prev, h in zip(grams, hashes[n - 1:])]
+        for h in grams:
+            bucket = h % n_features
+            counts[bucket] = counts.get(bucket, 0) + 1
+
+    indices = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    values /= np.sqrt(values @ values) or 1.0
+    return indices, values
+
+
+class LearnedClassifier:
+    """
+    Mô hình tuyến tính (softmax) trên n-gram băm, lưu gọn trong một file .npz.
+
+    Args:
+        categories: Danh sách nhãn
+        weights: Ma trận trọng số (n_features x n_categories, float32)
+        bias: Vector bias (n_categories,)
+        ngram: Độ dài n-gram từ tối đa
+        min_confidence: Xác suất tối thiểu để trả về nhãn, thấp hơn -> "unknown"
+    """
+
+    def __init__(self, categories: List[str], weights: np.ndarray, bias: np.ndarray,
+                 ngram: int = 2, min_confidence: float = 0.4):
+        self.categories = list(categories)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.n_features = self.weights.shape[0]
+        self.ngram = ngram
+        self.min_confidence = min_confidence
+
+    def predict_proba(self, text_lower: str) -> np.ndarray:
+        indices, values = hash_features(text_lower, self.n_features, self.ngram)
+        # Chỉ gom các hàng trọng số của đặc trưng có mặt
+        logits = values @ self.weights.take(indices, axis=0) + self.bias
+        probs = np.exp(logits - logits.max())
+        return probs / probs.sum()
+
+    def predict(self, text_lower: str) -> Tuple[str, float]:
+        probs = self.predict_proba(text_lower)
+        best = int(probs.argmax())
+        confidence = float(probs[best])
+        if confidence < self.min_confidence:
+            return "unknown", 0.0
+        return self.categories[best], round(confidence, 3)
+
+    def save(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Trọng số lưu float16: nhỏ gọn, sai số không đáng kể với mô hình tuyến tính
+        np.savez_compressed(
+            path,
+            categories=np.array(self.categories),
+            weights=self.weights.astype(np.float16),
+            bias=self.bias,
+            ngram=np.array(self.ngram),
+            min_confidence=np.array(self.min_confidence),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LearnedClassifier":
+        with np.load(path) as data:
+            return cls(
+                categories=[str(c) for c in data["categories"]],
+                weights=data["weights"].astype(np.float32),
+                bias=data["bias"],
+                ngram=int(data["ngram"]),
+                min_confidence=float(data["min_confidence"]),
+            )
+
+    @classmethod
+    def train(cls, texts: List[str], labels: List[str], n_features: int = 2 ** 16, ngram: int = 2,
+              epochs: int = 20, learning_rate: float = 2.0, l2: float = 1e-5, batch_size: int = 32,
+              min_confidence: float = 0.4, seed: int = 0) -> "LearnedClassifier":
+        """Huấn luyện softmax regression bằng mini-batch SGD trên đặc trưng thưa (chỉ CPU)"""
+        categories = sorted(set(labels))
+        label_index = {category: i for i, category in enumerate(categories)}
+        y = np.array([label_index[label] for label in labels], dtype=np.int64)
+        features = [hash_features(text.lower(), n_features, ngram) for text in texts]
+
+        weights = np.zeros((n_features, len(categories)), dtype=np.float32)
+        bias = np.zeros(len(categories), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        for epoch in range(epochs):
+            order = rng.permutation(len(features))
+            lr = learning_rate / (1 + epoch * 0.2)
+            loss = 0.0
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                rows = np.concatenate([np.full(len(features[i][0]), k) for k, i in enumerate(batch)])
+                cols = np.concatenate([features[i][0] for i in batch])
+                vals = np.concatenate([features[i][1] for i in batch])
+
+                # Logits của cả batch từ các phần tử thưa
+                logits = np.zeros((len(batch), len(categories)), dtype=np.float32)
+                np.add.at(logits, rows, vals[:, None] * weights[cols])
+                logits += bias
+                logits -= logits.max(axis=1, keepdims=True)
+                probs = np.exp(logits)
+                probs /= probs.sum(axis=1, keepdims=True)
+                loss -= float(np.log(probs[np.arange(len(batch)), y[batch]] + 1e-12).sum())
+
+                grad = probs
+                grad[np.arange(len(batch)), y[batch]] -= 1.0
+                grad /= len(batch)
+                touched = np.unique(cols)
+                weights[touched] *= (1 - lr * l2)
+                np.add.at(weights, cols, -lr * vals[:, None] * grad[rows])
+                bias -= lr * grad.sum(axis=0)
+            logger.info(f"🔄 Epoch {epoch + 1}/{epochs}: loss={loss / len(features):.4f}")
+
+        return cls(categories, weights, bias, ngram=ngram, min_confidence=min_confidence)
+
+
+def load_dataset(path: str) -> Tuple[List[str], List[str]]:
+    """
+    Đọc dữ liệu có nhãn: file .jsonl (mỗi dòng {"text": ..., "label": ...})
+    hoặc thư mục có mỗi thư mục con là một nhãn chứa các file .txt.
+    """
+    texts, labels = [], []
+    if os.path.isdir(path):
+        for label in sorted(os.listdir(path)):
+            folder = os.path.join(path, label)
+            if not os.path.isdir(folder):
+                continue
+            for name in sorted(os.listdir(folder)):
+                if name.endswith(".txt"):
+                    with open(os.path.join(folder, name), encoding="utf-8") as f:
+                        texts.append(f.read())
+                    labels.append(label)
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    texts.append(record["text"])
+                    labels.append(record["label"])
+    return texts, labels
+
+
+def evaluate(predict, texts: Iterable[str], labels: Iterable[str]) -> Dict[str, float]:
+    """Độ chính xác và tốc độ của một hàm predict(text) -> category"""
+    texts, labels = list(texts), list(labels)
+    start = time.perf_counter()
+    predictions = [predict(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    correct = sum(1 for p, label in zip(predictions, labels) if p == label)
+    return {
+        "accuracy": round(correct / len(labels), 4) if labels else 0.0,
+        "docs_per_second": round(len(texts) / elapsed, 1) if elapsed else 0.0,
+        "us_per_doc": round(elapsed / len(texts) * 1e6, 1) if texts else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Huấn luyện / đánh giá bộ phân loại tài liệu học máy")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = sub.add_parser("train", help="Huấn luyện và lưu mô hình .npz")
+    train_parser.add_argument("--data", required=True, help="File .jsonl hoặc thư mục <nhãn>/*.txt")
+    train_parser.add_argument("--out", default=os.getenv("OCR_CLASSIFIER_MODEL", "models/classifier.npz"))
+    train_parser.add_argument("--features", type=int, default=2 ** 16)
+    train_parser.add_argument("--ngram", type=int, default=2)
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--min-confidence", type=float, default=0.4)
+
+    eval_parser = sub.add_parser("evaluate", help="Đánh giá mô hình trên dữ liệu có nhãn")
+    eval_parser.add_argument("--data", required=True)
+    eval_parser.add_argument("--model", default=os.getenv("OCR_CLASSIFIER_MODEL", "models/classifier.npz"))
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    texts, labels = load_dataset(args.data)
+    if args.command == "train":
+        model = LearnedClassifier.train(texts, labels, n_features=args.features, ngram=args.ngram,
+                                        epochs=args.epochs, min_confidence=args.min_confidence)
+        model.save(args.out)
+        size = os.path.getsize(args.out)
+        print(f"✅ Đã lưu mô hình {args.out} ({size / 1024:.1f} KB, {len(model.categories)} nhãn, {len(texts)} mẫu)")
+    else:
+        start = time.perf_counter()
+        model = LearnedClassifier.load(args.model)
+        load_ms = (time.perf_counter() - start) * 1000
+        result = evaluate(lambda text: model.predict(text.lower())[0], texts, labels)
+        print(json.dumps({"load_ms": round(load_ms, 2), **result}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,11 @@
-﻿from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+﻿# main.py - Entry point triển khai (Procfile): app OCR dùng chung, profile theo OCR_APP_PROFILE (light/full/railway)
 import os
+import sys
 
-app = FastAPI(title="Smart OCR System", version="1.0.0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.app import create_app, run
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-@app.get("/")
-async def root():
-    return {"message": "Smart OCR System API", "status": "running", "version": "1.0.0"}
-
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy", "service": "smart-ocr"}
-
-@app.post("/ocr")
-async def ocr_placeholder():
-    return {"message": "OCR functionality coming soon", "status": "development"}
+app = create_app()
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    run(app)
@@ -0,0 +1,487 @@
+﻿# services/app.py - App FastAPI dùng chung cho mọi entry point; profile light/full/railway chọn tính năng theo cấu hình
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+
+from services import metrics, profiler
+from services.ocr_executor import OCRExecutor, ExecutorError
+from services.result_cache import get_result_cache
+from services.columnar import MEDIA_TYPE, Detections
+from services.tiered_ocr import TIER_STATS, cache_params, tiering_enabled
+from services.reader_registry import (ALLOWED_LANGUAGES, LanguageView, get_reader_registry, language_key,
+                                      parse_languages, readtext_languages)
+from services.cpu_tuning import cpu_settings
+from services.preprocessing import get_preprocessor, preprocess_upload, server_timing
+from services.image_io import read_upload, read_uploads, UploadError
+
+logger = logging.getLogger(__name__)
+
+# Tính năng theo profile; module của tính năng tắt không được import
+#   languages: bộ ngôn ngữ mặc định; allowed_languages: được chọn qua ?lang= (None = OCR_LANGUAGES_ALLOWED)
+#   classifier: ?fields=true, ?mode=roi, phân loại tài liệu
+#   documents: /ocr/document (PDF/TIFF nhiều trang)
+#   jobs: /jobs (hàng đợi SQLite + webhook)
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "light": {"title": "Light OCR System", "languages": ["en"], "allowed_languages": ["en"],
+              "classifier": False, "documents": False, "jobs": False},
+    "full": {"title": "Smart OCR System", "languages": ["vi", "en"], "allowed_languages": None,
+             "classifier": True, "documents": True, "jobs": False},
+    "railway": {"title": "Smart OCR System - Railway", "languages": ["vi", "en"], "allowed_languages": None,
+                "classifier": True, "documents": True, "jobs": True},
+}
+DEFAULT_PROFILE = os.getenv("OCR_APP_PROFILE", "railway")
+BATCH_MAX_FILES = int(os.getenv("OCR_BATCH_MAX_FILES", 50))
+# Tổng dung lượng các file của một /ocr/batch (được giữ trong RAM đến khi xử lý xong)
+BATCH_MAX_BYTES = int(os.getenv("OCR_BATCH_MAX_BYTES", 100 * 1024 * 1024))
+
+HOME_PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+    <title>{title}</title>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+        body {{ font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }}
+        .upload-area {{ border: 2px dashed #ccc; padding: 40px; text-align: center; margin: 20px 0; }}
+        button {{ background: #007bff; color: white; padding: 10px 20px; border: none; border-radius: 5px; cursor: pointer; }}
+        pre {{ background: #f5f5f5; padding: 15px; border-radius: 5px; white-space: pre-wrap; }}
+    </style>
+</head>
+<body>
+    <h1>🔍 {title}</h1>
+    <p>Tải lên hình ảnh để nhận dạng văn bản</p>
+    <div class="upload-area">
+        <form id="uploadForm">
+            <input type="file" id="fileInput" accept="image/*" required>
+            <br><br>
+            <button type="submit">Nhận dạng văn bản</button>
+        </form>
+    </div>
+    <div id="result"></div>
+    <script>
+        document.getElementById('uploadForm').addEventListener('submit', async function (e) {{
+            e.preventDefault();
+            const formData = new FormData();
+            formData.append('file', document.getElementById('fileInput').files[0]);
+            const result = await (await fetch('/ocr', {{ method: 'POST', body: formData }})).json();
+            const area = document.getElementById('result');
+            if (!result.success) {{ area.textContent = 'Lỗi: ' + result.error; return; }}
+            area.innerHTML = '<p><strong>Độ tin cậy:</strong> ' + (result.confidence * 100).toFixed(2) + '%</p>' +
+                '<p><strong>Số dòng:</strong> ' + result.total_lines + '</p><pre></pre>';
+            area.querySelector('pre').textContent = result.text;
+        }});
+    </script>
+</body>
+</html>'''
+
+
+def summarize_results(results: List[Any], filename: Optional[str]) -> Dict[str, Any]:
+    """Dạng kết quả chung của mọi profile: confidence 0-1, total_lines"""
+    text_lines = [result[1] for result in results]
+    confidence_scores = [result[2] for result in results]
+    return {
+        "success": True,
+        "filename": filename,
+        "text": '\n'.join(text_lines),
+        "confidence": float(np.mean(confidence_scores)) if confidence_scores else 0.0,
+        "total_lines": len(text_lines),
+        "engine": "EasyOCR",
+    }
+
+
+def _error(message: str, status_code: int, headers: Optional[Dict[str, str]] = None, **extra) -> JSONResponse:
+    return JSONResponse({"success": False, "error": message, **extra}, status_code=status_code, headers=headers)
+
+
+def create_app(profile: Optional[str] = None) -> FastAPI:
+    """
+    Tạo app OCR theo profile (mặc định OCR_APP_PROFILE).
+
+    - light: model tiếng Anh, /ocr, /ocr/batch
+    - full: thêm tiếng Việt, phân loại + trích xuất trường, OCR theo vùng, /ocr/document
+    - railway: full + /jobs chạy nền
+
+    Mọi profile có /health, /ready, /metrics và /admin/profiles. Reader, cache kết quả là
+    đối tượng dùng chung của tiến trình (services.reader_registry, services.result_cache).
+    """
+    name = (profile or DEFAULT_PROFILE).lower()
+    if name not in PROFILES:
+        raise ValueError(f"Profile app không hợp lệ: {name} (hỗ trợ: {', '.join(PROFILES)})")
+    # Cấu hình riêng của app: nhiều app trong cùng tiến trình không ảnh hưởng nhau
+    config = dict(PROFILES[name])
+    config["languages"] = languages = list(language_key(config["languages"]))
+    config["allowed_languages"] = tuple(config["allowed_languages"] or ALLOWED_LANGUAGES)
+
+    app = FastAPI(title=config["title"])
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Reader theo bộ ngôn ngữ (?lang=), dùng chung detector, giới hạn RAM bằng OCR_READER_BUDGET_MB.
+    # Registry dùng chung cả tiến trình; bộ ngôn ngữ mặc định của app nằm trong view riêng
+    reader_registry = get_reader_registry()
+    reader_view = LanguageView(reader_registry, languages)
+
+    def create_reader():
+        # Nạp sẵn reader mặc định (easyocr kéo theo torch, import trong worker để tiến trình web mở cổng ngay);
+        # mọi worker dùng chung view, view dùng được như reader của bộ ngôn ngữ mặc định của app
+        reader_view.get()
+        return reader_view
+
+    executor = OCRExecutor(create_reader)
+    result_cache = get_result_cache()
+
+    classifier = None
+    if config["classifier"]:
+        from document_classifier import DocumentClassifier
+        from services.field_extraction import extract_fields
+        from services.roi_ocr import roi_readtext
+        classifier = DocumentClassifier()
+
+    job_store = job_runner = None
+    if config["jobs"]:
+        from services.documents import ocr_document
+        from services.job_queue import JobRunner, JobStore
+
+        async def process_job(payload, filename):
+            # Mỗi job chạy lần lượt từng trang để các job khác vẫn có worker
+            result = await ocr_document(executor, payload, classifier, window=1)
+            result["filename"] = filename
+            return result
+
+        job_store = JobStore()
+        job_runner = JobRunner(job_store, process_job)
+
+    app.state.profile = name
+    app.state.executor = executor
+    app.state.reader_registry = reader_registry
+    app.state.result_cache = result_cache
+    app.state.classifier = classifier
+
+    # /metrics: hàng đợi, cache, RAM reader đọc tại thời điểm scrape
+    metrics.register_executor(executor)
+    metrics.register_cache(result_cache)
+    metrics.register_reader_registry(reader_registry)
+
+    async def cached_readtext(image_np, wait_if_busy=False, roi=False, request_languages=None):
+        """readtext (hoặc roi_readtext khi roi=True) qua cache kết quả; trả về (results, "HIT"/"MISS"/None)"""
+        request_languages = request_languages or languages
+        cache_key = None
+        if result_cache.enabled:
+            params = {"mode": "roi"} if roi else {}
+            if tiering_enabled():
+                params["tier"] = cache_params()
+            cache_key = await asyncio.to_thread(result_cache.make_key, image_np, request_languages, params or None)
+            results = result_cache.get(cache_key)
+            if results is not None:
+                return results, "HIT"
+        if roi:
+            results = await executor.run(roi_readtext, image_np)
+        elif request_languages != languages:
+            results = await executor.run(readtext_languages, image_np, request_languages)
+        elif wait_if_busy:
+            results = await executor.readtext_when_free(image_np)
+        else:
+            results = await executor.readtext(image_np)
+        if cache_key is not None:
+            result_cache.put(cache_key, results)
+        return results, "MISS" if cache_key is not None else None
+
+    @app.middleware("http")
+    async def track_requests(request: Request, call_next):
+        if not metrics.ENABLED:
+            return await call_next(request)
+        metrics.IN_FLIGHT.inc()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.IN_FLIGHT.dec()
+            # Nhãn theo route khai báo (/jobs/{job_id}) để số series không tăng theo id
+            route = request.scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            metrics.REQUESTS.inc(path=path, status=status)
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, path=path)
+
+    @app.middleware("http")
+    async def profile_requests(request: Request, call_next):
+        # Profile lấy mẫu cho /ocr: header X-OCR-Profiling: 1 + X-Admin-Token, hoặc theo OCR_PROFILE_RATE
+        if request.url.path != "/ocr" or not profiler.should_profile(request.headers):
+            return await call_next(request)
+        with profiler.profile_request(f"{request.method} {request.url.path}") as profile:
+            response = await call_next(request)
+        response.headers["X-OCR-Profile-Id"] = profile.id
+        return response
+
+    @app.on_event("startup")
+    async def load_models():
+        # Nạp model ở nền, /health trả lời ngay còn /ready báo khi model đã sẵn sàng
+        executor.start_warm_up()
+        if job_runner is not None:
+            job_runner.start()
+
+    @app.on_event("shutdown")
+    async def stop_jobs():
+        # Job đang chạy dở được trả về hàng đợi cho tiến trình khác (hoặc lần khởi động sau)
+        if job_runner is not None:
+            await job_runner.stop()
+
+    @app.get('/')
+    async def home():
+        return HTMLResponse(HOME_PAGE.format(title=config["title"]))
+
+    @app.post('/ocr')
+    async def ocr_endpoint(request: Request, response: Response,
+                           detections: Optional[str] = Query(None, pattern="^(columnar|base64|binary)$"),
+                           fields: bool = Query(False),
+                           mode: str = Query("full", pattern="^(full|roi)$"),
+                           lang: Optional[str] = Query(None)):
+        filename = None
+        try:
+            request_languages = parse_languages(lang, languages, config["allowed_languages"])
+        except ValueError as e:
+            return _error(str(e), 400, filename=filename)
+        if classifier is None and (fields or mode == "roi"):
+            return _error(f"Profile {name} không hỗ trợ fields / mode=roi", 400, filename=filename)
+        try:
+            # Đọc multipart theo stream vào buffer dùng lại, giải mã + tiền xử lý theo profile (header X-OCR-Profile)
+            preprocessor = get_preprocessor(request.headers.get("X-OCR-Profile"))
+            upload = await read_upload(request)
+            filename = upload.filename
+            image_np, preprocessing = await asyncio.to_thread(preprocess_upload, upload, preprocessor)
+            response.headers["Server-Timing"] = server_timing(preprocessing)
+
+            # mode=roi: phân loại ở độ phân giải thấp, chỉ nhận dạng lại vùng trường (CCCD, bằng lái)
+            # mode=roi luôn dùng bộ ngôn ngữ mặc định (template trường là tiếng Việt)
+            results, cache_status = await cached_readtext(
+                image_np, roi=mode == "roi", request_languages=None if mode == "roi" else request_languages)
+            if cache_status:
+                response.headers["X-Cache"] = cache_status
+            roi_result = None
+            if mode == "roi":
+                roi_result, results = results, results["results"]
+
+            # Box + confidence từng vùng dạng cột (JSON hoặc nhị phân)
+            if detections == "binary":
+                headers = {key: value for key, value in response.headers.items() if key.lower() in ("x-cache", "server-timing")}
+                return Response(content=Detections.from_readtext(results).to_bytes(), media_type=MEDIA_TYPE, headers=headers)
+            output = summarize_results(results, filename)
+            if detections:
+                output["detections"] = Detections.from_readtext(results).to_json("base64" if detections == "base64" else "list")
+            if roi_result is not None:
+                output["mode"] = roi_result["mode"]
+                if "fallback" in roi_result:
+                    output["fallback"] = roi_result["fallback"]
+                output["document_type"] = roi_result["document_type"]
+                output["classification_confidence"] = roi_result["classification_confidence"]
+                output["fields"] = roi_result["fields"]
+            elif fields:
+                # Phân loại rồi trích xuất trường theo vị trí box của template loại tài liệu
+                with metrics.stage("classification"):
+                    doc_type, confidence, _ = classifier.classify(output["text"])
+                output["document_type"] = doc_type
+                output["classification_confidence"] = confidence
+                output["fields"] = extract_fields(Detections.from_readtext(results), doc_type)
+            return output
+
+        except UploadError as e:
+            metrics.record_error(e)
+            return _error(str(e), e.status_code, filename=filename)
+        except ExecutorError as e:
+            metrics.record_error(e)
+            return _error(str(e), e.status_code, headers={"Retry-After": str(e.retry_after)}, filename=filename)
+        except Exception as e:
+            metrics.record_error(e)
+            logger.error(f"❌ Lỗi OCR: {e}")
+            return {"success": False, "error": str(e), "filename": filename}
+
+    @app.post('/ocr/batch')
+    async def ocr_batch_endpoint(request: Request):
+        """OCR nhiều ảnh (trường 'files') trong một request; lỗi của ảnh nào chỉ nằm ở kết quả ảnh đó"""
+        try:
+            preprocessor = get_preprocessor(request.headers.get("X-OCR-Profile"))
+            uploads = await read_uploads(request, field="files", max_files=BATCH_MAX_FILES,
+                                         max_total_bytes=BATCH_MAX_BYTES)
+        except UploadError as e:
+            return _error(str(e), e.status_code)
+
+        window = asyncio.Semaphore(executor.workers)
+
+        async def process(upload):
+            try:
+                async with window:
+                    image_np, _ = await asyncio.to_thread(preprocess_upload, upload, preprocessor)
+                    results, cache_status = await cached_readtext(image_np, wait_if_busy=True)
+                item = summarize_results(results, upload.filename)
+                if cache_status:
+                    item["cache"] = cache_status
+                return item
+            except Exception as e:
+                metrics.record_error(e)
+                return {"success": False, "error": str(e), "filename": upload.filename}
+            finally:
+                upload.release()
+
+        items = await asyncio.gather(*(process(upload) for upload in uploads))
+        for index, item in enumerate(items):
+            item["index"] = index
+        return {
+            "success": all(item["success"] for item in items),
+            "count": len(items),
+            "succeeded": sum(1 for item in items if item["success"]),
+            "results": items,
+        }
+
+    if config["documents"]:
+        _add_document_routes(app, executor, classifier)
+    if job_store is not None:
+        _add_job_routes(app, job_store, job_runner)
+
+    @app.get('/admin/profiles')
+    async def list_profiles(request: Request):
+        if not profiler.check_admin(request.headers.get("X-Admin-Token")):
+            return _error("Cần X-Admin-Token hợp lệ (OCR_ADMIN_TOKEN)", 403)
+        return {"profiles": await asyncio.to_thread(profiler.get_profile_store().recent)}
+
+    @app.get('/admin/profiles/{profile_id}')
+    async def get_profile(request: Request, profile_id: str,
+                          fmt: str = Query("speedscope", alias="format", pattern="^(speedscope|collapsed|raw)$")):
+        """Profile đã lưu: speedscope JSON (mở bằng speedscope.app), collapsed stacks (flamegraph.pl) hoặc raw"""
+        if not profiler.check_admin(request.headers.get("X-Admin-Token")):
+            return _error("Cần X-Admin-Token hợp lệ (OCR_ADMIN_TOKEN)", 403)
+        data = await asyncio.to_thread(profiler.get_profile_store().load, profile_id)
+        if data is None:
+            return _error("Không tìm thấy profile", 404)
+        if fmt == "collapsed":
+            return PlainTextResponse(profiler.to_collapsed(data))
+        if fmt == "speedscope":
+            return JSONResponse(profiler.to_speedscope(data),
+                                headers={"Content-Disposition": f'attachment; filename="{profile_id}.speedscope.json"'})
+        return data
+
+    @app.get('/metrics')
+    async def metrics_endpoint():
+        # Prometheus text format; với OCR_BACKEND=process, thời gian detect/recognize đo trong worker nên không có ở đây
+        return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get('/health')
+    async def health_check():
+        return {"status": "healthy", "service": config["title"], "profile": name}
+
+    @app.get('/ready')
+    async def readiness_check():
+        stats = executor.stats()
+        if not executor.ready:
+            return JSONResponse(
+                {"status": "loading" if not executor.load_error else "error", "error": executor.load_error, "executor": stats},
+                status_code=503,
+            )
+        result = {"status": "ready", "service": config["title"], "profile": name, "executor": stats,
+                  "readers": reader_registry.stats(), "cpu": cpu_settings()}
+        if tiering_enabled():
+            # Với OCR_BACKEND=process, thống kê nằm trong từng worker nên chỉ có ở backend thread
+            result["tiers"] = TIER_STATS.snapshot()
+        return result
+
+    logger.info(f"✅ App profile {name}: ngôn ngữ {languages}, "
+                f"{', '.join(feature for feature in ('classifier', 'documents', 'jobs') if config[feature]) or 'OCR cơ bản'}")
+    return app
+
+
+def _add_document_routes(app: FastAPI, executor: OCRExecutor, classifier):
+    from fastapi.responses import StreamingResponse
+    from services.documents import MAX_DOCUMENT_BYTES, PageSource, format_event, ocr_document_stream
+
+    @app.post('/ocr/document')
+    async def ocr_document_endpoint(request: Request, fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|sse)$")):
+        """OCR PDF/TIFF nhiều trang, stream kết quả từng trang (NDJSON hoặc SSE)"""
+        upload = source = None
+        try:
+            upload = await read_upload(request, max_bytes=MAX_DOCUMENT_BYTES)
+            source = await asyncio.to_thread(PageSource, upload.view())
+        except UploadError as e:
+            return _error(str(e), e.status_code)
+        finally:
+            # Mở tài liệu không được thì trả buffer ngay; mở được thì stream() trả khi xong
+            if source is None and upload is not None:
+                upload.release()
+
+        async def stream():
+            try:
+                async for event in ocr_document_stream(executor, source, classifier):
+                    yield format_event(event, fmt)
+            finally:
+                source.close()
+                upload.release()
+
+        media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+        return StreamingResponse(stream(), media_type=media_type)
+
+
+def _add_job_routes(app: FastAPI, job_store, job_runner):
+    from services.documents import MAX_DOCUMENT_BYTES, PageSource
+    from services.job_queue import JobLimitError, WebhookError, validate_webhook_url
+
+    def validate_document(payload: bytes):
+        # Kiểm tra định dạng, số trang, kích thước render trước khi nhận job thay vì để job lỗi khi chạy
+        PageSource(memoryview(payload)).close()
+
+    @app.post('/jobs')
+    async def create_job(request: Request, webhook_url: Optional[str] = None):
+        """Nhận tài liệu, trả job id ngay; kết quả xem qua GET /jobs/{id} hoặc webhook"""
+        if webhook_url:
+            try:
+                await asyncio.to_thread(validate_webhook_url, webhook_url)
+            except WebhookError as e:
+                return _error(str(e), e.status_code)
+        client_id = request.headers.get("X-Client-Id") or (request.client.host if request.client else "anonymous")
+
+        upload = None
+        try:
+            upload = await read_upload(request, max_bytes=MAX_DOCUMENT_BYTES)
+            payload = bytes(upload.view())
+            filename = upload.filename
+            await asyncio.to_thread(validate_document, payload)
+        except UploadError as e:
+            return _error(str(e), e.status_code)
+        finally:
+            if upload is not None:
+                upload.release()
+
+        try:
+            job_id = await asyncio.to_thread(job_store.enqueue, client_id, payload, filename, webhook_url)
+        except JobLimitError as e:
+            return _error(str(e), e.status_code)
+        job_runner.notify()
+
+        return JSONResponse(
+            {"success": True, "job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"},
+            status_code=202,
+        )
+
+    @app.get('/jobs/{job_id}')
+    async def get_job(job_id: str):
+        job = await asyncio.to_thread(job_store.get, job_id)
+        if job is None:
+            return _error("Không tìm thấy job", 404)
+        return job
+
+
+def run(app: FastAPI, default_port: int = 8000):
+    """Chạy app bằng uvicorn trên cổng PORT"""
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", default_port)))
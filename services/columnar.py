@@ -0,0 +1,131 @@
+﻿# services/columnar.py - Kết quả detect dạng cột (mảng box/confidence + một chuỗi text) thay cho list dict
+import json
+import base64
+import struct
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+MEDIA_TYPE = "application/x-ocr-columnar"
+_MAGIC = b"OCRC"
+_VERSION = 1
+# magic, version, số vùng, số byte text UTF-8
+_HEADER = struct.Struct("<4sHII")
+
+
+class Detections:
+    """
+    Các vùng chữ của một ảnh lưu theo cột:
+
+    - boxes: int16 (n, 4, 2) - 4 đỉnh (x, y) mỗi vùng, theo thứ tự của easyocr
+    - confidence: float32 (n,)
+    - text: mọi dòng nối liền thành một chuỗi
+    - offsets: int32 (n + 1,) - dòng i là text[offsets[i]:offsets[i + 1]] (đơn vị: ký tự Unicode)
+    """
+
+    __slots__ = ("boxes", "confidence", "text", "offsets")
+
+    def __init__(self, boxes: np.ndarray, confidence: np.ndarray, text: str, offsets: np.ndarray):
+        self.boxes = boxes
+        self.confidence = confidence
+        self.text = text
+        self.offsets = offsets
+
+    @classmethod
+    def from_readtext(cls, results: Sequence[Any]) -> "Detections":
+        """Chuyển kết quả reader.readtext (box, text, confidence) sang dạng cột"""
+        n = len(results)
+        if n == 0:
+            return cls(np.zeros((0, 4, 2), dtype=np.int16), np.zeros(0, dtype=np.float32), "", np.zeros(1, dtype=np.int32))
+        texts = [result[1] for result in results]
+        # Box của free_list là float; làm tròn và kẹp vào miền int16
+        boxes = np.asarray([result[0] for result in results], dtype=np.float32).reshape(n, 4, 2)
+        boxes = np.clip(np.rint(boxes), -32768, 32767).astype(np.int16)
+        confidence = np.fromiter((result[2] for result in results), dtype=np.float32, count=n)
+        offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.fromiter(map(len, texts), dtype=np.int32, count=n), out=offsets[1:])
+        return cls(boxes, confidence, "".join(texts), offsets)
+
+    def __len__(self) -> int:
+        return len(self.confidence)
+
+    def line(self, index: int) -> str:
+        return self.text[self.offsets[index]:self.offsets[index + 1]]
+
+    def lines(self) -> List[str]:
+        offsets = self.offsets.tolist()
+        return [self.text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def bounds(self) -> np.ndarray:
+        """Hình chữ nhật bao (n, 4): x_min, y_min, x_max, y_max"""
+        return np.concatenate([self.boxes.min(axis=1), self.boxes.max(axis=1)], axis=1)
+
+    def to_json(self, encoding: str = "list") -> Dict[str, Any]:
+        """
+        JSON dạng cột. encoding="list": mảng số thường (dễ đọc);
+        encoding="base64": mảng nhị phân little-endian mã hoá base64 (nhỏ hơn, parse nhanh hơn).
+        """
+        if encoding == "base64":
+            def pack(array):
+                return base64.b64encode(np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<")).tobytes()).decode("ascii")
+
+            boxes, confidence, offsets = pack(self.boxes), pack(self.confidence), pack(self.offsets)
+        else:
+            boxes = self.boxes.reshape(-1).tolist()
+            confidence = [round(c, 4) for c in self.confidence.tolist()]
+            offsets = self.offsets.tolist()
+        return {
+            "format": "columnar",
+            "version": _VERSION,
+            "encoding": encoding,
+            "count": len(self),
+            "boxes": boxes,
+            "confidence": confidence,
+            "text": self.text,
+            "offsets": offsets,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Detections":
+        n = data["count"]
+        if data.get("encoding") == "base64":
+            def unpack(value, dtype):
+                return np.frombuffer(base64.b64decode(value), dtype=np.dtype(dtype).newbyteorder("<")).astype(dtype)
+
+            boxes = unpack(data["boxes"], np.int16)
+            confidence = unpack(data["confidence"], np.float32)
+            offsets = unpack(data["offsets"], np.int32)
+        else:
+            boxes = np.asarray(data["boxes"], dtype=np.int16)
+            confidence = np.asarray(data["confidence"], dtype=np.float32)
+            offsets = np.asarray(data["offsets"], dtype=np.int32)
+        return cls(boxes.reshape(n, 4, 2), confidence, data["text"], offsets)
+
+    def to_bytes(self) -> bytes:
+        """Định dạng nhị phân: header | boxes int16 | confidence float32 | offsets int32 | text UTF-8"""
+        text = self.text.encode("utf-8")
+        return b"".join((
+            _HEADER.pack(_MAGIC, _VERSION, len(self), len(text)),
+            self.boxes.astype("<i2").tobytes(),
+            self.confidence.astype("<f4").tobytes(),
+            self.offsets.astype("<i4").tobytes(),
+            text,
+        ))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Detections":
+        magic, version, n, text_len = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("Không phải dữ liệu columnar hợp lệ")
+        view = memoryview(data)[_HEADER.size:]
+        boxes = np.frombuffer(view, dtype="<i2", count=n * 8).reshape(n, 4, 2)
+        view = view[n * 16:]
+        confidence = np.frombuffer(view, dtype="<f4", count=n)
+        view = view[n * 4:]
+        offsets = np.frombuffer(view, dtype="<i4", count=n + 1)
+        text = bytes(view[(n + 1) * 4:(n + 1) * 4 + text_len]).decode("utf-8")
+        return cls(boxes.astype(np.int16), confidence.astype(np.float32), text, offsets.astype(np.int32))
+
+
+def dumps(detections: Detections, encoding: str = "list") -> str:
+    return json.dumps(detections.to_json(encoding), ensure_ascii=False)
@@ -0,0 +1,110 @@
+﻿# services/cpu_tuning.py - Chế độ suy luận CPU: lượng tử hoá int8, giới hạn thread torch mỗi worker, TorchScript tuỳ chọn
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# easyocr mặc định quantize=True: lượng tử hoá động (int8) recognizer khi chạy CPU. OCR_QUANTIZE=1 giữ nguyên
+# mặc định đó (không phải tối ưu thêm), 0 = tắt để chạy float32 (so sánh độ chính xác, hoặc khi int8 lệch)
+QUANTIZE = os.getenv("OCR_QUANTIZE", "1") == "1"
+# Thread intra-op mỗi tiến trình worker (0 = số core / OCR_WORKERS) và inter-op
+TORCH_THREADS = int(os.getenv("OCR_TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.getenv("OCR_TORCH_INTEROP_THREADS", 1))
+# Trace recognizer sang TorchScript (thử nghiệm; chỉ dùng khi kết quả khớp bản gốc)
+TORCHSCRIPT = os.getenv("OCR_TORCHSCRIPT", "0") == "1"
+
+_configured = None
+_configure_lock = threading.Lock()
+
+
+def default_threads(workers: Optional[int] = None) -> int:
+    """Chia đều số core cho các worker để không tranh thread lẫn nhau"""
+    workers = max(1, workers or int(os.getenv("OCR_WORKERS", 1)))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def configure_torch_threads(threads: Optional[int] = None, interop_threads: Optional[int] = None) -> Dict[str, int]:
+    """
+    Đặt số thread torch cho tiến trình hiện tại. Gọi lại với cùng giá trị thì bỏ qua;
+    số thread inter-op chỉ đặt được trước khi torch chạy việc song song đầu tiên.
+    """
+    global _configured
+    threads = threads or TORCH_THREADS or default_threads()
+    interop_threads = interop_threads or TORCH_INTEROP_THREADS
+    with _configure_lock:
+        if _configured is not None and _configured["threads"] == threads:
+            return _configured
+        try:
+            import torch
+        except ImportError:
+            return {"threads": threads, "interop_threads": interop_threads}
+
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Đã có việc inter-op chạy trước đó (vd. tiến trình con sau fork): giữ giá trị hiện tại
+            interop_threads = torch.get_num_interop_threads()
+        _configured = {"threads": torch.get_num_threads(), "interop_threads": interop_threads}
+        logger.info(f"✅ Torch CPU: {_configured['threads']} thread intra-op, {_configured['interop_threads']} inter-op")
+        return _configured
+
+
+def reader_options(quantize: Optional[bool] = None) -> Dict[str, Any]:
+    """Tham số CPU cho easyocr.Reader"""
+    return {"gpu": False, "quantize": QUANTIZE if quantize is None else quantize}
+
+
+def trace_recognizer(reader, widths=(256, 512)) -> bool:
+    """
+    Thay reader.recognizer bằng bản TorchScript trace. Bản trace được so với bản gốc
+    ở nhiều độ rộng ảnh (độ rộng crop thay đổi theo dòng); lệch hoặc lỗi thì giữ nguyên.
+
+    Returns:
+        True nếu đã thay
+    """
+    try:
+        import torch
+        from easyocr.easyocr import imgH
+    except ImportError:
+        return False
+
+    model = reader.recognizer
+    model.eval()
+    text = torch.zeros(1, 1, dtype=torch.long)
+    try:
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(model, (torch.rand(1, 1, imgH, widths[0]), text), check_trace=False))
+            for width in widths:
+                sample = torch.rand(2, 1, imgH, width)
+                expected, actual = model(sample, text), traced(sample, text)
+                if expected.shape != actual.shape or not torch.allclose(expected, actual, atol=1e-3):
+                    logger.warning(f"⚠️ TorchScript recognizer lệch kết quả ở độ rộng {width}, giữ model gốc")
+                    return False
+    except Exception as e:
+        logger.warning(f"⚠️ Không trace được recognizer: {e}")
+        return False
+
+    reader.recognizer = traced
+    logger.info("✅ Recognizer chạy bằng TorchScript")
+    return True
+
+
+def tune_reader(reader, torchscript: Optional[bool] = None):
+    """Áp chế độ CPU lên reader vừa tạo (eval, TorchScript tuỳ chọn)"""
+    for name in ("recognizer", "detector"):
+        module = getattr(reader, name, None)
+        if module is not None and hasattr(module, "eval"):
+            module.eval()
+    if TORCHSCRIPT if torchscript is None else torchscript:
+        trace_recognizer(reader)
+    return reader
+
+
+def cpu_settings() -> Dict[str, Any]:
+    """Cấu hình CPU đang dùng (cho /ready, báo cáo benchmark)"""
+    settings = {"quantize": QUANTIZE, "torchscript": TORCHSCRIPT, "cpu_count": os.cpu_count()}
+    settings.update(_configured or {"threads": TORCH_THREADS or default_threads(), "interop_threads": TORCH_INTEROP_THREADS})
+    return settings
@@ -0,0 +1,261 @@
+﻿# services/documents.py - OCR tài liệu nhiều trang (PDF/TIFF), chạy song song và stream kết quả
+import os
+import json
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from services.columnar import Detections
+from services.field_extraction import extract_fields
+from services.image_io import MAX_PIXELS, UploadError, _MemoryReader, decode_errors, open_image, to_8bit
+from services.metrics import record_error, stage
+
+logger = logging.getLogger(__name__)
+
+PDF_DPI = int(os.getenv("OCR_PDF_DPI", 200))
+# OCR_MAX_PAGES: tên cũ, vẫn đọc để tương thích
+MAX_PAGES = int(os.getenv("OCR_DOCUMENT_MAX_PAGES", os.getenv("OCR_MAX_PAGES", 200)))
+# Tổng pixel sau khi render mọi trang (mặc định ~250 trang A4 ở 200 DPI); mỗi trang vẫn theo OCR_MAX_PIXELS
+MAX_DOCUMENT_PIXELS = int(os.getenv("OCR_DOCUMENT_MAX_PIXELS", 1_000_000_000))
+MAX_DOCUMENT_BYTES = int(os.getenv("OCR_MAX_DOCUMENT_BYTES", 100 * 1024 * 1024))
+
+# pdfium không thread-safe: mọi lời gọi vào pdfium đi qua một khoá chung
+_PDFIUM_LOCK = threading.Lock()
+
+
+class PageSource:
+    """
+    Tách trang lười từ PDF, TIFF nhiều frame hoặc ảnh đơn trong một buffer.
+    Mỗi trang chỉ được render/giải mã khi render(i) được gọi; số trang và tổng
+    kích thước render được kiểm tra ngay khi mở (UploadError 413).
+    """
+
+    def __init__(self, data: memoryview, dpi: Optional[int] = None):
+        self._data = data
+        self._lock = threading.Lock()
+        self.dpi = dpi or PDF_DPI
+        self._pdf = None
+        self._image = None
+        # Lỗi riêng của thư viện PDF (pypdfium2.PdfiumError), chỉ gán khi là PDF
+        self._pdf_error = ()
+
+        if bytes(data[:5]) == b"%PDF-":
+            try:
+                import pypdfium2 as pdfium
+            except ImportError:
+                raise UploadError("Cần cài pypdfium2 để xử lý PDF", status_code=415)
+            self._pdf_error = pdfium.PdfiumError
+            with self._errors():
+                with _PDFIUM_LOCK:
+                    self._pdf = pdfium.PdfDocument(_MemoryReader(data))
+                    self.page_count = len(self._pdf)
+            self.kind = "pdf"
+        else:
+            from PIL import Image
+            with self._errors():
+                self._image = Image.open(_MemoryReader(data))
+                self.page_count = getattr(self._image, "n_frames", 1)
+            self.kind = (self._image.format or "image").lower()
+
+        try:
+            if self.page_count > MAX_PAGES:
+                raise UploadError(f"Tài liệu có {self.page_count} trang, vượt giới hạn {MAX_PAGES}", status_code=413)
+            with self._errors():
+                self.total_pixels = self._total_pixels()
+            if self.total_pixels > MAX_DOCUMENT_PIXELS:
+                raise UploadError(f"Tài liệu quá lớn sau khi render: {self.total_pixels} pixel "
+                                  f"(giới hạn {MAX_DOCUMENT_PIXELS})", status_code=413)
+        except UploadError:
+            self.close()
+            raise
+
+    @contextmanager
+    def _errors(self):
+        """PDF / ảnh hỏng -> UploadError 415 (vượt giới hạn pixel của PIL -> 413), đóng tài liệu đã mở"""
+        try:
+            with decode_errors("tài liệu"):
+                try:
+                    yield
+                except self._pdf_error as e:
+                    raise UploadError(f"File PDF bị hỏng hoặc không đọc được: {e}", status_code=415) from e
+        except UploadError:
+            self.close()
+            raise
+
+    def _total_pixels(self) -> int:
+        """Tổng pixel của mọi trang khi render, chỉ đọc kích thước trang (không render)"""
+        scale = self.dpi / 72
+        total = 0
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                for index in range(self.page_count):
+                    width, height = self._pdf.get_page_size(index)
+                    total += int(width * scale) * int(height * scale)
+            return total
+        with self._lock:
+            for index in range(self.page_count):
+                self._image.seek(index)
+                total += self._image.size[0] * self._image.size[1]
+            self._image.seek(0)
+        return total
+
+    def render(self, index: int):
+        """Render trang index (0-based) thành numpy array"""
+        import numpy as np
+
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                page = self._pdf[index]
+                try:
+                    width, height = page.get_size()
+                    self._check_pixels(width * self.dpi / 72, height * self.dpi / 72, index)
+                    bitmap = page.render(scale=self.dpi / 72)
+                    image = bitmap.to_pil()
+                finally:
+                    page.close()
+            return np.asarray(image.convert("RGB"))
+
+        with self._lock:
+            if self.page_count == 1:
+                # Ảnh đơn: đi qua đúng giới hạn pixel/draft như /ocr
+                image = to_8bit(open_image(self._data))
+                return np.asarray(image if image.mode in ("RGB", "L") else image.convert("RGB"))
+            self._image.seek(index)
+            self._check_pixels(*self._image.size, index)
+            frame = self._image.copy()
+        frame = to_8bit(frame)
+        if frame.mode not in ("RGB", "L"):
+            frame = frame.convert("RGB")
+        return np.asarray(frame)
+
+    @staticmethod
+    def _check_pixels(width: float, height: float, index: int):
+        if width * height > MAX_PIXELS:
+            raise UploadError(f"Trang {index + 1} quá lớn: {int(width)}x{int(height)} pixel", status_code=413)
+
+    def close(self):
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                self._pdf.close()
+            self._pdf = None
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+
+def _page_result(page: int, results: List[Any]) -> Dict[str, Any]:
+    """Kết quả một trang, cùng dạng với /ocr và /ocr/batch (confidence 0-1, total_lines)"""
+    text_lines = [result[1] for result in results]
+    confidences = [float(result[2]) for result in results]
+    return {
+        "type": "page",
+        "page": page,
+        "success": True,
+        "text": "\n".join(text_lines),
+        "confidence": sum(confidences) / len(confidences) if confidences else 0.0,
+        "total_lines": len(text_lines),
+        "engine": "EasyOCR",
+    }
+
+
+def _document_fields(layouts: Dict[int, Detections], doc_type: str) -> Dict[str, Any]:
+    """Trích xuất trường từng trang theo thứ tự, trường đã có ở trang trước thì giữ nguyên"""
+    fields = {}
+    for index in sorted(layouts):
+        for name, field in extract_fields(layouts[index], doc_type).items():
+            if name not in fields:
+                fields[name] = {**field, "page": index + 1}
+    return fields
+
+
+async def _ocr_page(executor, source: PageSource, index: int):
+    image = await asyncio.to_thread(source.render, index)
+    # Hàng đợi đầy thì chờ rồi thử lại thay vì bỏ trang
+    return await executor.readtext_when_free(image)
+
+
+async def ocr_document_stream(executor, source: PageSource, classifier=None,
+                              window: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    OCR song song các trang (tối đa `window` trang cùng lúc), yield kết quả
+    từng trang ngay khi xong, cuối cùng yield tổng hợp kèm phân loại tài liệu.
+    """
+    window = window or executor.workers
+    texts: Dict[int, str] = {}
+    layouts: Dict[int, Detections] = {}
+    tasks: Dict[asyncio.Task, int] = {}
+    next_index = 0
+
+    yield {"type": "document", "kind": source.kind, "pages": source.page_count}
+
+    try:
+        while next_index < source.page_count or tasks:
+            while next_index < source.page_count and len(tasks) < window:
+                task = asyncio.ensure_future(_ocr_page(executor, source, next_index))
+                tasks[task] = next_index
+                next_index += 1
+
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks.pop(task)
+                try:
+                    results = task.result()
+                    page = _page_result(index + 1, results)
+                    texts[index] = page["text"]
+                    if classifier is not None:
+                        layouts[index] = Detections.from_readtext(results)
+                except Exception as e:
+                    record_error(e)
+                    logger.error(f"❌ Lỗi OCR trang {index + 1}: {e}")
+                    page = {"type": "page", "page": index + 1, "success": False, "error": str(e)}
+                yield page
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    full_text = "\n".join(texts[i] for i in sorted(texts))
+    summary = {
+        "type": "summary",
+        "pages": source.page_count,
+        "pages_ok": len(texts),
+        "character_count": len(full_text),
+    }
+    if classifier is not None:
+        with stage("classification"):
+            doc_type, confidence, metadata = await asyncio.to_thread(classifier.classify, full_text)
+        fields = await asyncio.to_thread(_document_fields, layouts, doc_type)
+        # Trường lấy theo vị trí box đáng tin hơn regex trên text đã làm phẳng
+        metadata.update({name: field["value"] for name, field in fields.items()})
+        summary.update({"document_type": doc_type, "classification_confidence": confidence,
+                        "metadata": metadata, "fields": fields})
+    yield summary
+
+
+async def ocr_document(executor, data, classifier=None, window: Optional[int] = None) -> Dict[str, Any]:
+    """OCR toàn bộ tài liệu và gom kết quả (dùng cho job chạy nền)"""
+    source = await asyncio.to_thread(PageSource, memoryview(data))
+    pages = []
+    summary = {}
+    try:
+        async for event in ocr_document_stream(executor, source, classifier, window=window):
+            if event["type"] == "page":
+                pages.append({k: v for k, v in event.items() if k != "type"})
+            elif event["type"] == "summary":
+                summary = {k: v for k, v in event.items() if k != "type"}
+    finally:
+        source.close()
+
+    pages.sort(key=lambda page: page["page"])
+    summary["text"] = "\n".join(page["text"] for page in pages if page.get("success"))
+    summary["page_results"] = pages
+    return summary
+
+
+def format_event(event: Dict[str, Any], fmt: str = "ndjson") -> str:
+    """Định dạng một sự kiện cho NDJSON hoặc Server-Sent Events"""
+    data = json.dumps(event, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
@@ -0,0 +1,242 @@
+﻿# services/field_extraction.py - Trích xuất trường (key -> value) theo vị trí box, dùng template theo loại tài liệu
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from services.columnar import Detections
+
+
+_COMBINING_RE = re.compile("[\u0300-\u036f]")
+
+
+def fold(text: str) -> str:
+    """lowercase + bỏ dấu tiếng Việt, để khớp key chịu được lỗi mất dấu của OCR"""
+    return _COMBINING_RE.sub("", unicodedata.normalize("NFD", text.lower())).replace("đ", "d")
+
+
+class FieldSpec:
+    """
+    Một trường trong template.
+
+    Args:
+        name: Tên trường trả về
+        key: Regex khớp nhãn (viết không dấu, chữ thường)
+        value: Regex giá trị hợp lệ (trên text gốc), nhóm 1 nếu có là phần giữ lại
+        directions: Thứ tự tìm giá trị: "inline" (cùng box, sau nhãn), "right", "below"
+        max_gap: Khoảng cách tối đa tới box giá trị, tính theo chiều cao box nhãn
+    """
+
+    def __init__(self, name: str, key: str, value: str = r"(.+)",
+                 directions: Tuple[str, ...] = ("inline", "right", "below"), max_gap: float = 12.0):
+        self.name = name
+        self.key = re.compile(key)
+        self.value = re.compile(value)
+        self.directions = directions
+        self.max_gap = max_gap
+
+    def parse_value(self, text: str, lenient: bool = False) -> Optional[str]:
+        text = text.strip(" :.-\t")
+        if not text or lenient:
+            return text or None
+        match = self.value.search(text)
+        if match is None:
+            return None
+        return (match.group(1) if match.groups() else match.group(0)).strip()
+
+
+_DATE = r"(\d{1,2}\s*[/.-]\s*\d{1,2}\s*[/.-]\s*\d{4})"
+_MONEY = r"(\d{1,3}(?:[.,\s]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?)"
+
+TEMPLATES: Dict[str, List[FieldSpec]] = {
+    "invoice": [
+        FieldSpec("invoice_number", r"\bso\s*(?:hd|hoa\s*don)\b|invoice\s*no", r"([A-Za-z0-9][A-Za-z0-9/-]*)"),
+        FieldSpec("date", r"\bngay\b(?!\s*sinh)|\bdate\b", _DATE),
+        FieldSpec("total_amount", r"tong\s*cong|tong\s*(?:so\s*)?tien(?:\s*thanh\s*toan)?|\btotal\b", _MONEY),
+        FieldSpec("tax_code", r"ma\s*so\s*thue|\bmst\b|tax\s*code", r"(\d[\d\s-]{8,}\d)"),
+        FieldSpec("customer", r"khach\s*hang|nguoi\s*mua|ten\s*don\s*vi|buyer", r"(.{2,})"),
+    ],
+    "id_card": [
+        FieldSpec("id_number", r"^\s*(?:so|no)\b", r"(\d{9,12})"),
+        FieldSpec("name", r"ho\s*(?:va\s*)?ten|full\s*name", r"(.{2,})"),
+        FieldSpec("birthday", r"ngay\s*(?:,?\s*thang\s*,?\s*nam\s*)?sinh|sinh\s*ngay|date\s*of\s*birth", _DATE),
+        FieldSpec("nationality", r"quoc\s*tich|nationality", r"([^\d]{2,})"),
+        FieldSpec("hometown", r"que\s*quan|nguyen\s*quan|place\s*of\s*origin", r"(.{2,})", max_gap=20.0),
+    ],
+    "driver_license": [
+        FieldSpec("license_number", r"^\s*(?:so|no)\b", r"(\d{9,12})"),
+        FieldSpec("name", r"ho\s*(?:va\s*)?ten|full\s*name", r"(.{2,})"),
+        FieldSpec("birthday", r"ngay\s*sinh|date\s*of\s*birth", _DATE),
+        FieldSpec("license_class", r"\bhang\b|\bclass\b", r"\b([A-F]\d?)\b"),
+        FieldSpec("expiry", r"gia\s*tri\s*den|expires?", _DATE),
+    ],
+}
+
+
+class GridIndex:
+    """
+    Chỉ mục lưới đều trên hình chữ nhật bao của các box, lưu dạng mảng đã sắp
+    xếp theo mã ô: dựng O(n log n) hoàn toàn bằng numpy, truy vấn một vùng chỉ
+    xét các box nằm trong những ô giao với vùng đó.
+    """
+
+    def __init__(self, bounds: np.ndarray, cell_size: Optional[float] = None):
+        self.bounds = bounds
+        if cell_size is None:
+            heights = bounds[:, 3] - bounds[:, 1]
+            cell_size = max(float(np.median(heights)) * 4 if len(bounds) else 0.0, 16.0)
+        self.cell_size = cell_size
+
+        cells = np.floor_divide(bounds, cell_size).astype(np.int64)
+        self._origin = cells[:, :2].min(axis=0) if len(cells) else np.zeros(2, dtype=np.int64)
+        cells -= np.tile(self._origin, 2)
+        self._rows = int(cells[:, 3].max()) + 1 if len(cells) else 1
+
+        # Mỗi box được ghi vào mọi ô nó phủ: sinh các cặp (mã ô, chỉ số box) rồi sắp theo mã ô
+        nx = cells[:, 2] - cells[:, 0] + 1
+        ny = cells[:, 3] - cells[:, 1] + 1
+        spans = nx * ny
+        owner = np.repeat(np.arange(len(cells)), spans)
+        local = np.arange(int(spans.sum())) - np.repeat(np.cumsum(spans) - spans, spans)
+        cx = cells[owner, 0] + local // ny[owner]
+        cy = cells[owner, 1] + local % ny[owner]
+        keys = cx * self._rows + cy
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._owners = owner[order]
+
+    def query(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Chỉ số các box giao với hình chữ nhật (x0, y0, x1, y1)"""
+        size = self.cell_size
+        ox, oy = self._origin.tolist()
+        cy0 = max(int(y0 // size) - oy, 0)
+        cy1 = min(int(y1 // size) - oy, self._rows - 1)
+        cx0 = max(int(x0 // size) - ox, 0)
+        cx1 = int(x1 // size) - ox
+        if cy0 > cy1 or cx0 > cx1:
+            return np.zeros(0, dtype=np.int64)
+
+        # Các ô cùng cột x liền nhau trong mảng mã ô -> một lát cắt mỗi cột
+        columns = np.arange(cx0, cx1 + 1) * self._rows
+        starts = np.searchsorted(self._keys, columns + cy0, side="left")
+        ends = np.searchsorted(self._keys, columns + cy1, side="right")
+        if not (ends > starts).any():
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.unique(np.concatenate([self._owners[s:e] for s, e in zip(starts.tolist(), ends.tolist()) if e > s]))
+        b = self.bounds[candidates]
+        mask = (b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)
+        return candidates[mask]
+
+
+class FieldExtractor:
+    """
+    Trích xuất trường theo template của loại tài liệu: tìm box nhãn khớp key,
+    rồi lấy giá trị trong cùng box, box gần nhất bên phải cùng hàng, hoặc box
+    gần nhất bên dưới cùng cột.
+
+    Args:
+        templates: Template theo loại tài liệu (mặc định TEMPLATES)
+    """
+
+    def __init__(self, templates: Optional[Dict[str, List[FieldSpec]]] = None):
+        self.templates = templates or TEMPLATES
+
+    def extract(self, detections: Detections, doc_type: str, lenient: bool = False) -> Dict[str, Any]:
+        """
+        Args:
+            lenient: Nhận mọi text khác rỗng làm giá trị (chỉ định vị box giá trị,
+                vd. trên pass OCR độ phân giải thấp nhiều lỗi ký tự)
+
+        Returns:
+            {tên trường: {"value", "confidence", "box": [x0, y0, x1, y1], "line", "source"}}
+            với line là chỉ số dòng chứa giá trị trong detections
+        """
+        specs = self.templates.get(doc_type)
+        if not specs or not len(detections):
+            return {}
+
+        lines = detections.lines()
+        # Bỏ dấu cả trang một lần; text một dòng OCR không chứa "\n"
+        folded = fold("\n".join(lines)).split("\n")
+        bounds = detections.bounds().astype(np.float32)
+        index = GridIndex(bounds)
+        used = set()
+        fields = {}
+
+        for spec in specs:
+            for i, line in enumerate(folded):
+                match = spec.key.search(line)
+                if match is None:
+                    continue
+                found = self._resolve(spec, i, match, lines, bounds, index, used, lenient)
+                if found is not None:
+                    value, j, source = found
+                    used.add(j)
+                    fields[spec.name] = {
+                        "value": value,
+                        "confidence": round(float(detections.confidence[j]), 4),
+                        "box": bounds[j].astype(int).tolist(),
+                        "line": j,
+                        "source": source,
+                    }
+                    break
+        return fields
+
+    def _resolve(self, spec: FieldSpec, i: int, match, lines: List[str], bounds: np.ndarray,
+                 index: GridIndex, used: set, lenient: bool) -> Optional[Tuple[str, int, str]]:
+        x0, y0, x1, y1 = bounds[i]
+        height = max(y1 - y0, 1.0)
+        max_gap = spec.max_gap * height
+
+        for direction in spec.directions:
+            if direction == "inline":
+                # fold() giữ nguyên số ký tự trừ khi bỏ dấu tổ hợp; ánh xạ lại vị trí theo text gốc
+                rest = _after_key(lines[i], match.end())
+                value = spec.parse_value(rest, lenient) if rest else None
+                if value:
+                    return value, i, "inline"
+                continue
+
+            if direction == "right":
+                candidates = index.query(x1, y0, x1 + max_gap, y1)
+                b = bounds[candidates]
+                overlap = np.minimum(b[:, 3], y1) - np.maximum(b[:, 1], y0)
+                keep = (overlap >= 0.5 * np.minimum(b[:, 3] - b[:, 1], height)) & (b[:, 0] >= x1 - 0.5 * height)
+                distance = b[:, 0] - x1
+            else:
+                candidates = index.query(x0 - height, y1, x1 + max_gap, y1 + 3 * height)
+                b = bounds[candidates]
+                overlap = np.minimum(b[:, 2], x1 + max_gap) - np.maximum(b[:, 0], x0)
+                keep = (overlap > 0) & (b[:, 1] >= y1 - 0.5 * height)
+                distance = (b[:, 1] - y1) * 4 + np.abs(b[:, 0] - x0)
+
+            keep &= candidates != i
+            for j in candidates[keep][np.argsort(distance[keep], kind="stable")].tolist():
+                if j in used:
+                    continue
+                value = spec.parse_value(lines[j], lenient)
+                if value:
+                    return value, j, direction
+        return None
+
+
+def _after_key(line: str, folded_end: int) -> str:
+    """Phần text gốc sau nhãn, với folded_end là vị trí kết thúc nhãn trong fold(line)"""
+    count = 0
+    for position, ch in enumerate(line):
+        if count >= folded_end:
+            return line[position:]
+        count += len(fold(ch))
+    return ""
+
+
+_extractor = None
+
+
+def extract_fields(detections: Detections, doc_type: str, lenient: bool = False) -> Dict[str, Any]:
+    """Trích xuất trường với template mặc định"""
+    global _extractor
+    if _extractor is None:
+        _extractor = FieldExtractor()
+    return _extractor.extract(detections, doc_type, lenient)
@@ -0,0 +1,331 @@
+﻿# services/image_io.py - Nhận upload dạng stream và giải mã ảnh thẳng vào numpy
+import io
+import os
+import math
+import struct
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+MAX_UPLOAD_BYTES = int(os.getenv("OCR_MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", 40_000_000))
+DECODE_MAX_SIDE = int(os.getenv("OCR_DECODE_MAX_SIDE", 4096))
+
+
+class UploadError(Exception):
+    """Upload không hợp lệ, kèm HTTP status để endpoint trả về"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Buffer:
+    """bytearray tái sử dụng: ghi đè theo vị trí thay vì cấp phát lại mỗi request"""
+
+    def __init__(self, capacity: int):
+        self.data = bytearray(capacity)
+        self.size = 0
+
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > len(self.data):
+            capacity = max(end, len(self.data) * 2)
+            try:
+                self.data.extend(bytes(capacity - len(self.data)))
+            except BufferError:
+                # Còn memoryview cũ trỏ vào buffer: chuyển sang bytearray mới
+                data = bytearray(capacity)
+                data[:self.size] = self.data[:self.size]
+                self.data = data
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def view(self) -> memoryview:
+        return memoryview(self.data)[:self.size]
+
+
+class BufferPool:
+    """
+    Pool các buffer upload dùng lại giữa các request.
+
+    Args:
+        size: Số buffer giữ lại tối đa (mặc định OCR_UPLOAD_POOL)
+        initial_capacity: Dung lượng ban đầu mỗi buffer
+        max_keep_bytes: Buffer lớn hơn mức này sẽ bị bỏ thay vì giữ lại
+    """
+
+    def __init__(self, size: Optional[int] = None, initial_capacity: int = 1024 * 1024,
+                 max_keep_bytes: Optional[int] = None):
+        self.size = size if size is not None else int(os.getenv("OCR_UPLOAD_POOL", 4))
+        self.initial_capacity = initial_capacity
+        self.max_keep_bytes = max_keep_bytes or MAX_UPLOAD_BYTES
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> _Buffer:
+        with self._lock:
+            buffer = self._free.pop() if self._free else None
+        if buffer is None:
+            buffer = _Buffer(self.initial_capacity)
+        buffer.size = 0
+        return buffer
+
+    def release(self, buffer: _Buffer):
+        if len(buffer.data) > self.max_keep_bytes:
+            return
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(buffer)
+
+
+buffer_pool = BufferPool()
+
+
+class _MemoryReader(io.RawIOBase):
+    """File-like chỉ đọc trên memoryview, để PIL đọc mà không sao chép cả buffer"""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        chunk = self._view[self._pos:self._pos + len(target)]
+        target[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+@contextmanager
+def decode_errors(what: str = "ảnh"):
+    """
+    Đổi lỗi khi PIL mở / giải mã sang UploadError: vượt giới hạn pixel của PIL
+    (DecompressionBombError) -> 413, định dạng lạ hoặc file hỏng / bị cắt -> 415.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        yield
+    except UploadError:
+        raise
+    except Image.DecompressionBombError as e:
+        raise UploadError(f"{what.capitalize()} quá lớn: {e}", status_code=413) from e
+    except UnidentifiedImageError as e:
+        raise UploadError(f"Không nhận dạng được định dạng {what}", status_code=415) from e
+    except (OSError, SyntaxError, EOFError, ValueError, struct.error) as e:
+        # PIL báo file hỏng bằng nhiều loại lỗi (OSError "image file is truncated", SyntaxError "broken PNG file"...)
+        raise UploadError(f"File {what} bị hỏng hoặc không đầy đủ: {e}", status_code=415) from e
+
+
+def open_image(data, max_pixels: Optional[int] = None, max_side: Optional[int] = None):
+    """
+    Mở ảnh từ bytes/memoryview, kiểm tra giới hạn pixel trước khi giải mã.
+    JPEG quá lớn được giải mã ở chế độ draft (DCT scaling) xuống gần max_side;
+    định dạng khác được reduce sau khi giải mã.
+
+    Returns:
+        PIL Image đã giải mã
+    """
+    from PIL import Image
+
+    max_pixels = max_pixels or MAX_PIXELS
+    max_side = DECODE_MAX_SIDE if max_side is None else max_side
+
+    with decode_errors():
+        image = Image.open(_MemoryReader(memoryview(data)))
+
+        width, height = original_size = image.size
+        if max_side and max(width, height) > max_side and image.format == "JPEG":
+            scale = max_side / max(width, height)
+            image.draft(image.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+            width, height = image.size
+
+        if width * height > max_pixels:
+            raise UploadError(f"Ảnh quá lớn: {width}x{height} vượt giới hạn {max_pixels} pixel", status_code=413)
+
+        image.load()
+        if max_side and max(image.size) > max_side:
+            factor = math.ceil(max(image.size) / max_side)
+            if factor > 1:
+                image = image.reduce(factor)
+    if image.size != original_size:
+        _scale_dpi(image, original_size)
+    return image
+
+
+def _scale_dpi(image, original_size):
+    """DPI trong metadata là của ảnh gốc; sau draft/reduce ghi lại DPI thực để bước sau không thu nhỏ thêm lần nữa"""
+    dpi = image.info.get("dpi")
+    try:
+        image.info["dpi"] = (float(dpi[0]) * image.width / original_size[0],
+                             float(dpi[1]) * image.height / original_size[1])
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        pass
+
+
+# Mode một kênh nhiều hơn 8 bit (PNG/TIFF 16-bit, ảnh y tế / scan chất lượng cao)
+WIDE_MODES = ("I;16", "I;16B", "I;16L", "I;16N", "I")
+
+
+def to_8bit(image):
+    """
+    Ảnh 16/32-bit một kênh -> "L" theo tỷ lệ (convert("L") của PIL chỉ cắt ở 255,
+    làm gần như toàn bộ ảnh thành trắng). Mode "I" có giá trị <= 255 giữ nguyên thang.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if image.mode not in WIDE_MODES:
+        return image
+    pixels = np.asarray(image).astype(np.float64)
+    top = 65535.0 if image.mode.startswith("I;16") or pixels.max(initial=0) > 255 else 255.0
+    pixels = np.clip(pixels, 0, top) * (255.0 / top)
+    return Image.fromarray(np.round(pixels).astype(np.uint8), mode="L")
+
+
+def decode_image(data, max_pixels: Optional[int] = None, max_side: Optional[int] = None):
+    """Giải mã ảnh thành numpy array"""
+    import numpy as np
+
+    return np.asarray(to_8bit(open_image(data, max_pixels=max_pixels, max_side=max_side)))
+
+
+class Upload:
+    """File ảnh đã nhận, nằm trong một buffer của pool cho đến khi release()"""
+
+    def __init__(self, filename: Optional[str], buffer: _Buffer, pool: BufferPool):
+        self.filename = filename
+        self._buffer = buffer
+        self._pool = pool
+
+    @property
+    def size(self) -> int:
+        return self._buffer.size if self._buffer is not None else 0
+
+    def view(self) -> memoryview:
+        return self._buffer.view()
+
+    def decode(self, max_pixels: Optional[int] = None, max_side: Optional[int] = None):
+        """Giải mã thành numpy array rồi trả buffer về pool"""
+        try:
+            return decode_image(self.view(), max_pixels=max_pixels, max_side=max_side)
+        finally:
+            self.release()
+
+    def release(self):
+        if self._buffer is not None:
+            self._pool.release(self._buffer)
+            self._buffer = None
+
+
+async def read_uploads(request, field: str = "file", pool: Optional[BufferPool] = None,
+                       max_bytes: Optional[int] = None, max_files: int = 1,
+                       max_total_bytes: Optional[int] = None) -> List[Upload]:
+    """
+    Đọc multipart body theo từng chunk, ghi mỗi phần file tên `field` vào một
+    buffer của pool. Không dùng file tạm, không giữ thêm bản sao của body.
+    max_bytes giới hạn từng file, max_total_bytes giới hạn tổng các file (UploadError 413).
+    """
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+    pool = pool or buffer_pool
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError("Cần gửi ảnh dạng multipart/form-data", status_code=415)
+
+    uploads: List[Upload] = []
+    state = {"field": b"", "value": b"", "name": None, "filename": None, "buffer": None, "total": 0}
+
+    def on_part_begin():
+        state["name"] = state["filename"] = state["buffer"] = None
+
+    def on_header_field(data, start, end):
+        state["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        if state["field"].lower() == b"content-disposition":
+            _, disposition = parse_options_header(state["value"])
+            state["name"] = disposition.get(b"name", b"").decode("utf-8", "replace")
+            filename = disposition.get(b"filename")
+            state["filename"] = filename.decode("utf-8", "replace") if filename is not None else None
+        state["field"] = state["value"] = b""
+
+    def on_headers_finished():
+        if state["name"] != field:
+            return
+        if len(uploads) >= max_files:
+            raise UploadError(f"Tối đa {max_files} file mỗi request", status_code=413)
+        state["buffer"] = pool.acquire()
+        uploads.append(Upload(state["filename"], state["buffer"], pool))
+
+    def on_part_data(data, start, end):
+        buffer = state["buffer"]
+        if buffer is None:
+            return
+        if buffer.size + (end - start) > max_bytes:
+            raise UploadError(f"File vượt quá {max_bytes} byte", status_code=413)
+        state["total"] += end - start
+        if max_total_bytes and state["total"] > max_total_bytes:
+            raise UploadError(f"Tổng dung lượng file vượt quá {max_total_bytes} byte", status_code=413)
+        buffer.write(memoryview(data)[start:end])
+
+    def on_part_end():
+        state["buffer"] = None
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                parser.write(chunk)
+        parser.finalize()
+    except Exception as e:
+        for upload in uploads:
+            upload.release()
+        if isinstance(e, FormParserError):
+            raise UploadError(f"Body multipart không hợp lệ: {e}", status_code=400) from e
+        raise
+
+    if not uploads:
+        raise UploadError(f"Thiếu trường file '{field}'", status_code=400)
+    return uploads
+
+
+async def read_upload(request, field: str = "file", pool: Optional[BufferPool] = None,
+                      max_bytes: Optional[int] = None) -> Upload:
+    """Đọc một file ảnh từ multipart body (xem read_uploads)"""
+    uploads = await read_uploads(request, field=field, pool=pool, max_bytes=max_bytes, max_files=1)
+    return uploads[0]
@@ -0,0 +1,442 @@
+﻿# services/job_queue.py - Hàng đợi job OCR bền vững trên SQLite (không cần broker ngoài)
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import sqlite3
+import ipaddress
+import threading
+import http.client
+import urllib.parse
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Host được nhận webhook, cách nhau bằng dấu phẩy ("*.example.com" gồm cả subdomain); trống = mọi host
+WEBHOOK_ALLOWED_HOSTS = tuple(host.strip().lower() for host in os.getenv("OCR_WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip())
+# 1 = cho phép webhook tới địa chỉ nội bộ (loopback, mạng riêng, link-local); chỉ dùng khi phát triển
+WEBHOOK_ALLOW_PRIVATE = os.getenv("OCR_WEBHOOK_ALLOW_PRIVATE", "0") == "1"
+# Thời hạn nhận job: tiến trình chạy job gia hạn định kỳ; hết hạn (tiến trình chết) thì tiến trình khác nhận lại
+LEASE_SECONDS = float(os.getenv("OCR_JOB_LEASE_SECONDS", 60))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    filename TEXT,
+    payload BLOB,
+    webhook_url TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client_id, status);
+"""
+
+
+class JobLimitError(Exception):
+    """Client đã có quá nhiều job đang chờ"""
+
+    status_code = 429
+
+
+class WebhookError(ValueError):
+    """webhook_url không hợp lệ hoặc trỏ tới host không được phép"""
+
+    status_code = 400
+
+
+def _host_allowed(host: str) -> bool:
+    for allowed in WEBHOOK_ALLOWED_HOSTS:
+        if allowed.startswith("*."):
+            if host.endswith(allowed[1:]) or host == allowed[2:]:
+                return True
+        elif host == allowed:
+            return True
+    return False
+
+
+def validate_webhook_url(url: str) -> str:
+    """
+    Kiểm tra webhook_url chống SSRF: chỉ http(s), host nằm trong OCR_WEBHOOK_ALLOWED_HOSTS
+    (nếu có), và mọi địa chỉ host phân giải ra phải là địa chỉ công khai.
+
+    Raises:
+        WebhookError: URL sai dạng, host không được phép hoặc trỏ vào mạng nội bộ
+    """
+    parsed = _parse_webhook_url(url)
+    if not WEBHOOK_ALLOW_PRIVATE:
+        _resolve_webhook(parsed)
+    return url
+
+
+def _parse_webhook_url(url: str) -> urllib.parse.SplitResult:
+    parsed = urllib.parse.urlsplit(url)
+    try:
+        parsed.port
+    except ValueError:
+        raise WebhookError("webhook_url có cổng không hợp lệ")
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise WebhookError("webhook_url phải là URL http(s)")
+    host = parsed.hostname.lower()
+    if WEBHOOK_ALLOWED_HOSTS and not _host_allowed(host):
+        raise WebhookError(f"Host webhook không được phép: {host}")
+    return parsed
+
+
+def _resolve_webhook(parsed: urllib.parse.SplitResult) -> Tuple[int, List[str]]:
+    """Phân giải host một lần; trả về (cổng, các địa chỉ đã kiểm tra) để kết nối đúng vào các địa chỉ này"""
+    host = parsed.hostname.lower()
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError) as e:
+        raise WebhookError(f"Không phân giải được host webhook {host}: {e}")
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    if not WEBHOOK_ALLOW_PRIVATE:
+        for address in addresses:
+            ip = ipaddress.ip_address(address.split("%", 1)[0])
+            if getattr(ip, "ipv4_mapped", None):
+                ip = ip.ipv4_mapped
+            if not ip.is_global:
+                raise WebhookError(f"Host webhook trỏ tới địa chỉ nội bộ: {host} ({ip})")
+    return port, addresses
+
+
+class JobStore:
+    """
+    Lưu job trong SQLite: job sống sót qua restart. Job đang chạy được gắn owner
+    (tiến trình nhận nó) và lease_until; nhiều worker/replica dùng chung file chỉ
+    đưa lại vào hàng đợi (recover) job có lease đã hết hạn.
+
+    Args:
+        path: File SQLite (mặc định OCR_JOBS_DB)
+        max_queued_per_client: Số job chờ tối đa mỗi client (mặc định OCR_JOBS_MAX_QUEUED)
+        max_attempts: Số lần chạy tối đa mỗi job trước khi đánh dấu lỗi
+        lease_seconds: Thời hạn nhận job (mặc định OCR_JOB_LEASE_SECONDS)
+    """
+
+    def __init__(self, path: Optional[str] = None, max_queued_per_client: Optional[int] = None,
+                 max_attempts: int = 3, lease_seconds: Optional[float] = None):
+        self.path = path or os.getenv("OCR_JOBS_DB", "jobs.db")
+        self.max_queued_per_client = max_queued_per_client or int(os.getenv("OCR_JOBS_MAX_QUEUED", 100))
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds or LEASE_SECONDS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._migrate()
+
+    def _migrate(self):
+        """Thêm cột lease cho file jobs.db tạo từ phiên bản trước"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if name in columns:
+                continue
+            try:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+            except sqlite3.OperationalError as e:
+                # Tiến trình khác vừa thêm cột
+                if "duplicate column" not in str(e):
+                    raise
+
+    def enqueue(self, client_id: str, payload: bytes, filename: Optional[str] = None,
+                webhook_url: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            queued = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client_id = ? AND status IN ('queued', 'running')",
+                (client_id,),
+            ).fetchone()[0]
+            if queued >= self.max_queued_per_client:
+                raise JobLimitError(f"Client {client_id} đã có {queued} job chưa xong")
+            self._conn.execute(
+                "INSERT INTO jobs (id, client_id, status, filename, payload, webhook_url, created_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, client_id, filename, sqlite3.Binary(payload), webhook_url, time.time()),
+            )
+        return job_id
+
+    def claim(self, per_client_limit: int) -> Optional[Dict[str, Any]]:
+        """Lấy job cũ nhất của client chưa vượt giới hạn chạy đồng thời, gắn owner + lease"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, client_id, filename, payload, webhook_url, attempts FROM jobs AS j "
+                    "WHERE status = 'queued' AND "
+                    "(SELECT COUNT(*) FROM jobs AS r WHERE r.client_id = j.client_id AND r.status = 'running') < ? "
+                    "ORDER BY created_at LIMIT 1",
+                    (per_client_limit,),
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, "
+                        "owner = ?, lease_until = ? WHERE id = ?",
+                        (now, self.owner, now + self.lease_seconds, row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(row) if row is not None else None
+
+    def complete(self, job_id: str, result: Dict[str, Any]) -> bool:
+        """Ghi kết quả; False nếu job không còn thuộc tiến trình này (lease hết hạn, đã bị nhận lại)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, payload = NULL, finished_at = ?, lease_until = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (json.dumps(result, ensure_ascii=False), time.time(), job_id, self.owner),
+            )
+        return cursor.rowcount > 0
+
+    def fail(self, job_id: str, error: str) -> bool:
+        """Đánh dấu lỗi; False nếu job không còn thuộc tiến trình này"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, payload = NULL, finished_at = ?, lease_until = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (error, time.time(), job_id, self.owner),
+            )
+        return cursor.rowcount > 0
+
+    def renew(self, job_ids: Iterable[str]) -> int:
+        """Gia hạn lease cho các job tiến trình này đang chạy"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ? AND id IN ({placeholders})",
+                (time.time() + self.lease_seconds, self.owner, *job_ids),
+            )
+        return cursor.rowcount
+
+    def release(self) -> int:
+        """Trả job đang chạy của tiến trình này về hàng đợi (khi tắt) để tiến trình khác nhận ngay"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL WHERE status = 'running' AND owner = ?",
+                (self.owner,),
+            )
+        return cursor.rowcount
+
+    def recover(self) -> int:
+        """Đưa job có lease đã hết hạn (tiến trình chạy nó đã chết) về hàng đợi"""
+        now = time.time()
+        expired = "status = 'running' AND (lease_until IS NULL OR lease_until < ?)"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'Quá số lần thử', payload = NULL, finished_at = ?, "
+                    f"lease_until = NULL WHERE {expired} AND attempts >= ?",
+                    (now, now, self.max_attempts),
+                )
+                cursor = self._conn.execute(
+                    f"UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL WHERE {expired}", (now,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if cursor.rowcount:
+            logger.info(f"🔄 Đưa lại {cursor.rowcount} job có lease hết hạn vào hàng đợi")
+        return cursor.rowcount
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, client_id, status, filename, result, error, attempts, created_at, started_at, finished_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """Kết nối tới địa chỉ đã kiểm tra thay vì phân giải lại host (DNS rebinding); Host header vẫn là hostname"""
+
+    def __init__(self, host: str, port: int, address: str, timeout: float):
+        super().__init__(host, port, timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self._address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Như _PinnedHTTPConnection; chứng chỉ TLS (SNI) vẫn kiểm tra theo hostname"""
+
+    def __init__(self, host: str, port: int, address: str, timeout: float):
+        super().__init__(host, port, timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        sock = socket.create_connection((self._address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _post_webhook(url: str, body: Dict[str, Any], timeout: float = 10.0) -> int:
+    """
+    POST kết quả tới webhook. Host được phân giải và kiểm tra lại lúc gửi (DNS có thể đã đổi
+    sau khi job được nhận) rồi kết nối thẳng vào địa chỉ vừa kiểm tra, không phân giải lần hai.
+    Không theo redirect: redirect có thể dẫn webhook vào mạng nội bộ.
+    """
+    parsed = _parse_webhook_url(url)
+    port, addresses = _resolve_webhook(parsed)
+    path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    connection_class = _PinnedHTTPSConnection if parsed.scheme == "https" else _PinnedHTTPConnection
+
+    error = None
+    for address in addresses:
+        connection = connection_class(parsed.hostname, port, address, timeout)
+        try:
+            connection.request("POST", path, body=data, headers={"Content-Type": "application/json"})
+            status = connection.getresponse().status
+        except OSError as e:
+            # Địa chỉ này không kết nối được, thử địa chỉ tiếp theo của host
+            error = e
+            continue
+        finally:
+            connection.close()
+        if 300 <= status < 400:
+            raise WebhookError(f"Webhook trả về redirect {status}, không theo")
+        if status >= 400:
+            raise OSError(f"Webhook trả về HTTP {status}")
+        return status
+    raise error or WebhookError(f"Không phân giải được host webhook {parsed.hostname}")
+
+
+class JobRunner:
+    """
+    Các vòng lặp asyncio lấy job từ JobStore, chạy OCR qua OCRExecutor và ghi
+    kết quả; gọi webhook (nếu có) khi job kết thúc. Một task nền gia hạn lease
+    của job đang chạy và nhận lại job có lease hết hạn của tiến trình khác.
+
+    Args:
+        store: JobStore
+        process: Coroutine nhận (payload bytes, filename) và trả về dict kết quả
+        concurrency: Số job chạy đồng thời (mặc định OCR_JOB_RUNNERS)
+        per_client_limit: Số job chạy đồng thời tối đa mỗi client (mặc định OCR_JOBS_PER_CLIENT)
+    """
+
+    def __init__(self, store: JobStore, process, concurrency: Optional[int] = None,
+                 per_client_limit: Optional[int] = None):
+        self.store = store
+        self.process = process
+        self.concurrency = max(1, concurrency or int(os.getenv("OCR_JOB_RUNNERS", 1)))
+        self.per_client_limit = max(1, per_client_limit or int(os.getenv("OCR_JOBS_PER_CLIENT", 2)))
+        self._wakeup = None
+        self._tasks = []
+        self._running = set()
+
+    def start(self):
+        self.store.recover()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._loop()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.ensure_future(self._heartbeat()))
+        logger.info(f"✅ Job runner: {self.concurrency} luồng, {self.per_client_limit} job/client")
+
+    def notify(self):
+        """Báo có job mới để runner không phải chờ hết chu kỳ poll"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Job đang chạy dở về hàng đợi ngay, không phải chờ lease hết hạn
+        released = await asyncio.to_thread(self.store.release)
+        if released:
+            logger.info(f"🔄 Trả {released} job chạy dở về hàng đợi")
+        self._running.clear()
+
+    async def _heartbeat(self):
+        interval = self.store.lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.store.renew, list(self._running))
+                if await asyncio.to_thread(self.store.recover):
+                    self.notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Gia hạn lease job thất bại: {e}")
+
+    async def _loop(self):
+        while True:
+            job = await asyncio.to_thread(self.store.claim, self.per_client_limit)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        self._running.add(job_id)
+        try:
+            result = await self.process(bytes(job["payload"]), job["filename"])
+            owned = await asyncio.to_thread(self.store.complete, job_id, result)
+            body = {"id": job_id, "status": "done", "result": result}
+        except asyncio.CancelledError:
+            # Tiến trình đang dừng: stop() trả job về hàng đợi
+            raise
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} lỗi: {e}")
+            owned = await asyncio.to_thread(self.store.fail, job_id, str(e))
+            body = {"id": job_id, "status": "failed", "error": str(e)}
+        finally:
+            self._running.discard(job_id)
+
+        if not owned:
+            # Lease hết hạn và job đã được tiến trình khác nhận lại; tiến trình đó sẽ ghi kết quả và gọi webhook
+            logger.warning(f"⚠️ Job {job_id} đã bị nhận lại, bỏ kết quả của tiến trình này")
+            return
+
+        if job["webhook_url"]:
+            try:
+                await asyncio.to_thread(_post_webhook, job["webhook_url"], body)
+            except Exception as e:
+                logger.warning(f"⚠️ Gọi webhook cho job {job_id} thất bại: {e}")
@@ -0,0 +1,291 @@
+﻿# services/metrics.py - Metrics dạng Prometheus (text format) và đo thời gian từng bước của pipeline OCR
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+# OCR_METRICS=0: stage()/timed() thành no-op, không đo gì
+ENABLED = os.getenv("OCR_METRICS", "1") == "1"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Một mẫu: (nhãn, giá trị)
+Sample = Tuple[Dict[str, str], float]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+               for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # nhãn -> [số đếm từng bucket (+Inf ở cuối), tổng, số lần]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def totals(self) -> Dict[Tuple[str, ...], Dict[str, float]]:
+        with self._lock:
+            return {key: {"count": series[2], "seconds": series[1]} for key, series in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, [list(series[0]), series[1], series[2]]) for key, series in self._series.items())
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Tập metric của tiến trình, cộng các collector đọc số liệu tại thời điểm scrape"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._collectors: Dict[str, Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name: str, collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+        """
+        collector() trả về các (tên, kiểu "gauge"/"counter", mô tả, [(nhãn, giá trị)]).
+        Đăng ký lại cùng name thì thay collector cũ (vd. app được tạo lại).
+        """
+        with self._lock:
+            self._collectors[name] = collector
+
+    def render(self) -> str:
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                ERRORS.inc(type=type(e).__name__)
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ocr_stage_seconds", "Thời gian từng bước pipeline OCR (giây)", ["stage"]))
+REQUESTS = REGISTRY.register(Counter(
+    "ocr_http_requests_total", "Số request HTTP theo endpoint và mã trạng thái", ["path", "status"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "ocr_http_request_seconds", "Thời gian xử lý request HTTP (giây)", ["path"]))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "ocr_http_in_flight_requests", "Số request HTTP đang xử lý"))
+ERRORS = REGISTRY.register(Counter(
+    "ocr_errors_total", "Số lỗi theo loại exception", ["type"]))
+
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+@contextmanager
+def _timed_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def stage(name: str):
+    """Đo thời gian một khối: with stage("detection"): ...  (no-op khi OCR_METRICS=0)"""
+    if not ENABLED:
+        return _NOOP_STAGE
+    return _timed_stage(name)
+
+
+def observe_stage(name: str, seconds: float):
+    """Ghi thời gian đã đo sẵn (vd. từ thông tin tiền xử lý)"""
+    if ENABLED:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def timed(name: str):
+    """Decorator đo thời gian hàm; khi tắt metrics trả lại nguyên hàm gốc"""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        return wrapper
+    return decorator
+
+
+def stage_totals() -> Dict[str, Dict[str, float]]:
+    """Số lần và tổng thời gian (giây) theo bước, cho báo cáo benchmark"""
+    return {key[0]: totals for key, totals in STAGE_SECONDS.totals().items()}
+
+
+def record_error(error: BaseException):
+    ERRORS.inc(type=type(error).__name__)
+
+
+def readtext_staged(reader, image, **kwargs):
+    """
+    reader.readtext nhưng tách detect / recognize để đo từng bước. Chỉ tách với
+    easyocr.Reader (đúng các bước readtext làm); reader bọc ngoài (registry, hai
+    tầng) tự đo bên trong nên được gọi thẳng.
+    """
+    if not ENABLED or kwargs or type(reader).__module__ != "easyocr.easyocr":
+        return reader.readtext(image, **kwargs)
+
+    from easyocr.utils import reformat_input
+
+    img, img_cv_grey = reformat_input(image)
+    with stage("detection"):
+        horizontal_list, free_list = reader.detect(img, reformat=False)
+    with stage("recognition"):
+        return reader.recognize(img_cv_grey, horizontal_list[0], free_list[0], reformat=False)
+
+
+def register_executor(executor):
+    """Độ sâu hàng đợi và số việc đang chạy của OCRExecutor"""
+    def collect():
+        stats = executor.stats()
+        yield "ocr_queue_depth", "gauge", "Số việc OCR đang chờ worker", [({}, stats["queued"])]
+        yield "ocr_running_jobs", "gauge", "Số việc OCR đang chạy", [({}, stats["running"])]
+        yield "ocr_executor_capacity", "gauge", "Số việc tối đa (worker + hàng đợi)", [({}, stats["capacity"])]
+    REGISTRY.register_collector("executor", collect)
+
+
+def register_cache(cache):
+    """Hit/miss và tỷ lệ hit của cache kết quả"""
+    def collect():
+        stats = cache.stats()
+        yield "ocr_cache_hits_total", "counter", "Số lần cache hit", [({}, stats["hits"])]
+        yield "ocr_cache_misses_total", "counter", "Số lần cache miss", [({}, stats["misses"])]
+        yield "ocr_cache_hit_ratio", "gauge", "Tỷ lệ cache hit", [({}, stats["hit_ratio"])]
+        yield "ocr_cache_bytes", "gauge", "Dung lượng cache trong RAM (byte)", [({}, stats["bytes"])]
+        yield "ocr_cache_disk_bytes", "gauge", "Dung lượng cache trên đĩa (byte)", [({}, stats["disk_bytes"])]
+    REGISTRY.register_collector("cache", collect)
+
+
+def register_reader_registry(registry):
+    """Dung lượng model ước lượng của từng reader"""
+    def collect():
+        stats = registry.stats()
+        samples = [({"languages": ",".join(reader["languages"])}, reader["mb"] * 1048576) for reader in stats["readers"]]
+        samples.append(({"languages": "detector"}, stats["detector_mb"] * 1048576))
+        yield "ocr_reader_memory_bytes", "gauge", "Dung lượng trọng số model ước lượng (byte)", samples
+        yield "ocr_reader_evictions_total", "counter", "Số reader bị bỏ do vượt budget", [({}, stats["evictions"])]
+    REGISTRY.register_collector("readers", collect)
+
+
+def register_phash_index(index):
+    """Tra ảnh gần trùng: hit và thời gian nhận dạng tiết kiệm được"""
+    def collect():
+        stats = index.stats()
+        yield "ocr_phash_lookups_total", "counter", "Số lần tra ảnh gần trùng", [({}, stats["lookups"])]
+        yield "ocr_phash_hits_total", "counter", "Số lần dùng lại kết quả của ảnh gần trùng", [({}, stats["hits"])]
+        yield "ocr_phash_seconds_saved_total", "counter", "Thời gian OCR tiết kiệm nhờ ảnh gần trùng (giây)", [({}, stats["seconds_saved"])]
+        yield "ocr_phash_entries", "gauge", "Số kết quả trong index ảnh gần trùng", [({}, stats["entries"])]
+    REGISTRY.register_collector("phash", collect)
+
+
+def render() -> str:
+    return REGISTRY.render()
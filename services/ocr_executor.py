@@ -0,0 +1,349 @@
+﻿# services/ocr_executor.py - Worker pool cho OCR, không chặn event loop
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from services.metrics import readtext_staged
+from services import profiler
+from services.worker_farm import WorkerTimeout
+
+logger = logging.getLogger(__name__)
+
+# Nạp model lỗi (vd. mất mạng khi tải model): thử lại sau LOAD_RETRY_SECONDS, gấp đôi mỗi lần, tối đa LOAD_RETRY_MAX
+LOAD_RETRY_SECONDS = float(os.getenv("OCR_LOAD_RETRY_SECONDS", 5))
+LOAD_RETRY_MAX = float(os.getenv("OCR_LOAD_RETRY_MAX", 300))
+
+
+class ExecutorError(Exception):
+    """Lỗi từ executor, kèm HTTP status để endpoint trả về"""
+
+    status_code = 503
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: int = 1):
+        super().__init__(message)
+        if status_code is not None:
+            self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class ExecutorOverloaded(ExecutorError):
+    """Hàng đợi OCR đã đầy"""
+
+    status_code = 429
+
+
+class ExecutorTimeout(ExecutorError):
+    """OCR chạy quá thời gian cho phép"""
+
+    status_code = 504
+
+
+def _copy_outcome(source: Future, target: Future):
+    if source.cancelled():
+        target.set_exception(ExecutorError("Việc OCR đã bị huỷ", status_code=503))
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _readtext(reader, image, **kwargs):
+    return readtext_staged(reader, image, **kwargs)
+
+
+def _readtext_batched(reader, batcher, image, **kwargs):
+    from services.recognition_batcher import readtext_batched
+    return readtext_batched(reader, batcher, image, **kwargs)
+
+
+class OCRExecutor:
+    """
+    Pool worker cho OCR: hàng đợi có giới hạn và timeout theo từng request.
+    Mỗi worker gọi reader_factory một lần để lấy reader; app truyền vào registry
+    dùng chung (services/reader_registry.py) nên các thread worker dùng chung model.
+
+    Args:
+        reader_factory: Hàm trả về reader cho worker (vd. lambda: get_reader_registry())
+        workers: Số worker (mặc định OCR_WORKERS)
+        queue_size: Số việc được chờ thêm ngoài các worker (mặc định OCR_QUEUE_SIZE)
+        timeout: Timeout mỗi request, giây (mặc định OCR_TIMEOUT)
+        backend: "thread" (thread trong tiến trình, reader theo reader_factory) hoặc "process" (worker farm
+            fork sau khi nạp model, xem services/worker_farm.py); mặc định OCR_BACKEND
+
+    Khi OCR_BATCH_WAIT_MS > 0 (chỉ với backend "thread", không dùng cùng OCR_TIERED),
+    bước nhận dạng của các request đồng thời được gom batch qua RecognitionBatcher.
+
+    Model có thể nạp ở nền bằng start_warm_up(); trong lúc chưa sẵn sàng, việc
+    mới được giữ lại trong executor (OCR_QUEUE_UNTIL_READY=1, không chiếm worker,
+    không tự nạp model) rồi mới giao cho worker khi nạp xong, hoặc bị từ chối với 503.
+    Nạp lỗi thì việc đang giữ và việc mới nhận 503 đến hết thời gian backoff,
+    request sau đó sẽ nạp lại.
+    """
+
+    def __init__(self, reader_factory: Callable[[], Any], workers: Optional[int] = None,
+                 queue_size: Optional[int] = None, timeout: Optional[float] = None,
+                 backend: Optional[str] = None):
+        self.reader_factory = reader_factory
+        self.workers = max(1, workers or int(os.getenv("OCR_WORKERS", 1)))
+        self.queue_size = max(0, queue_size if queue_size is not None else int(os.getenv("OCR_QUEUE_SIZE", 8)))
+        self.timeout = timeout if timeout is not None else float(os.getenv("OCR_TIMEOUT", 120))
+        self.backend = (backend or os.getenv("OCR_BACKEND", "thread")).lower()
+
+        self._pool = None
+        self._farm = None
+        if self.backend == "process":
+            from services.worker_farm import OCRWorkerFarm
+            self._farm = OCRWorkerFarm(reader_factory, processes=self.workers)
+        elif self.backend == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ocr-worker")
+        else:
+            raise ValueError(f"OCR_BACKEND không hợp lệ: {self.backend}")
+
+        self.batcher = None
+        if self._pool is not None:
+            from services.recognition_batcher import RecognitionBatcher, batching_enabled
+            from services.tiered_ocr import tiering_enabled
+            # Đường batch gọi detect/recognize của reader chính xác, sẽ bỏ qua tầng nhanh của OCR_TIERED
+            if batching_enabled() and tiering_enabled():
+                logger.warning("⚠️ OCR_TIERED=1: bỏ qua OCR_BATCH_WAIT_MS, không gom batch nhận dạng")
+            elif batching_enabled():
+                self.batcher = RecognitionBatcher()
+
+        self.queue_until_ready = os.getenv("OCR_QUEUE_UNTIL_READY", "1") == "1"
+        self.load_error = None
+        self._ready = threading.Event()
+        self._warm_thread = None
+        self._load_failures = 0
+        self._retry_at = 0.0
+        # Việc nhận trong lúc model chưa sẵn sàng: (future, fn, args, kwargs, hạn chót, context)
+        self._waiting = []
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._closed = False
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    @property
+    def ready(self) -> bool:
+        """Model đã nạp xong trên mọi worker"""
+        return self._ready.is_set()
+
+    def _get_reader(self):
+        """Reader của worker hiện tại, tạo lần đầu khi cần"""
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            logger.info(f"🔄 Khởi tạo reader cho {threading.current_thread().name}...")
+            reader = self.reader_factory()
+            self._local.reader = reader
+            logger.info(f"✅ Reader của {threading.current_thread().name} đã sẵn sàng")
+        return reader
+
+    def _call(self, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            with profiler.profiled_thread():
+                return fn(self._get_reader(), *args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Đưa việc vào pool; fn nhận reader của worker làm tham số đầu tiên.
+        Với backend "process", fn và tham số phải pickle được.
+        """
+        return self._submit(fn, args, kwargs, self.timeout)
+
+    def _submit(self, fn: Callable, args: tuple, kwargs: dict, timeout: Optional[float]) -> Future:
+        if not self.ready:
+            self.start_warm_up()
+            if self.load_error:
+                retry_after = max(1, math.ceil(self._retry_at - time.monotonic()))
+                raise ExecutorError(f"Không nạp được model OCR: {self.load_error}", status_code=503,
+                                    retry_after=retry_after)
+            if not self.queue_until_ready:
+                raise ExecutorError("Model OCR đang được nạp", status_code=503, retry_after=5)
+
+        with self._lock:
+            if self._closed:
+                raise ExecutorError("OCR executor đã dừng", status_code=503)
+            if self._pending >= self.capacity:
+                raise ExecutorOverloaded(f"Hàng đợi OCR đã đầy ({self.capacity} việc)")
+            self._pending += 1
+            # Request đang được profile: worker chạy trong context của request để được lấy mẫu
+            context = contextvars.copy_context() if profiler.active() else None
+            if not self._ready.is_set():
+                # Chờ warm-up ở đây thay vì trên worker: worker (hay thread của request) không tự nạp model
+                future = Future()
+                deadline = time.monotonic() + timeout if timeout else None
+                self._waiting.append((future, fn, args, kwargs, deadline, context))
+                future.add_done_callback(self._release)
+                return future
+
+        try:
+            future = self._dispatch(fn, args, kwargs, timeout, context)
+        except ExecutorError:
+            self._release()
+            raise
+
+        # Chỉ trả slot khi việc thật sự kết thúc, kể cả khi request đã timeout
+        future.add_done_callback(self._release)
+        return future
+
+    def _dispatch(self, fn: Callable, args: tuple, kwargs: dict, timeout: Optional[float], context=None) -> Future:
+        """Giao việc cho farm hoặc thread pool (model đã sẵn sàng)"""
+        try:
+            if self._farm is not None:
+                # Farm tự terminate worker khi việc quá hạn, slot được trả ngay sau đó
+                return self._farm.submit_job(fn, args, kwargs, timeout=timeout)
+            if context is not None:
+                return self._pool.submit(context.run, self._call, fn, args, kwargs)
+            return self._pool.submit(self._call, fn, args, kwargs)
+        except RuntimeError:
+            raise ExecutorError("OCR executor đã dừng", status_code=503)
+
+    def _take_waiting(self):
+        with self._lock:
+            waiting, self._waiting = self._waiting, []
+        return waiting
+
+    def _dispatch_waiting(self):
+        """Model vừa sẵn sàng: giao các việc đang giữ cho worker"""
+        for future, fn, args, kwargs, deadline, context in self._take_waiting():
+            # Request đã timeout (future bị huỷ) thì bỏ qua
+            if not future.set_running_or_notify_cancel():
+                continue
+            timeout = max(0.001, deadline - time.monotonic()) if deadline is not None else None
+            try:
+                inner = self._dispatch(fn, args, kwargs, timeout, context)
+            except ExecutorError as e:
+                future.set_exception(e)
+                continue
+            inner.add_done_callback(lambda inner, future=future: _copy_outcome(inner, future))
+
+    def _fail_waiting(self, error: ExecutorError):
+        for future, *_ in self._take_waiting():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """Chạy fn trên worker và chờ kết quả mà không chặn event loop"""
+        limit = timeout if timeout is not None else self.timeout
+        future = self._submit(fn, args, kwargs, limit)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), limit or None)
+        except asyncio.TimeoutError:
+            # Việc còn nằm trong hàng đợi sẽ bị huỷ; việc đang chạy: backend "process"
+            # dừng worker khi quá hạn, backend "thread" thì chạy nốt
+            future.cancel()
+            raise ExecutorTimeout(f"OCR vượt quá {limit:.0f}s")
+        except WorkerTimeout:
+            # Farm dừng worker ngay trước khi wait_for hết giờ
+            raise ExecutorTimeout(f"OCR vượt quá {limit:.0f}s")
+
+    async def readtext(self, image, timeout: Optional[float] = None, **kwargs):
+        """reader.readtext chạy trên worker pool"""
+        if self.batcher is not None and not kwargs:
+            return await self.run(_readtext_batched, self.batcher, image, timeout=timeout)
+        return await self.run(_readtext, image, timeout=timeout, **kwargs)
+
+    async def readtext_when_free(self, image, retries: int = 20, **kwargs):
+        """Như readtext nhưng chờ rồi thử lại khi hàng đợi đầy (cho việc nền, batch)"""
+        for attempt in range(retries + 1):
+            try:
+                return await self.readtext(image, **kwargs)
+            except ExecutorOverloaded as e:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    def warm_up(self):
+        """Tạo sẵn reader cho tất cả worker (chặn đến khi xong)"""
+        if self._farm is not None:
+            self._farm.start()
+            self._ready.set()
+            return
+
+        barrier = threading.Barrier(self.workers)
+
+        def _load():
+            try:
+                self._get_reader()
+            except Exception:
+                barrier.abort()
+                raise
+            # Giữ worker lại đến khi mọi worker đều đã có reader
+            barrier.wait()
+
+        futures = [self._pool.submit(_load) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+        self._ready.set()
+
+    def start_warm_up(self):
+        """Nạp model ở thread nền và trả về ngay (không chạy lại khi đang nạp hoặc đang chờ backoff)"""
+        with self._lock:
+            if self._warm_thread is not None:
+                return
+            if self.load_error and time.monotonic() < self._retry_at:
+                return
+            self.load_error = None
+            self._warm_thread = threading.Thread(target=self._warm_up_background, name="ocr-warm-up", daemon=True)
+        self._warm_thread.start()
+
+    def _warm_up_background(self):
+        try:
+            self.warm_up()
+            with self._lock:
+                self._load_failures = 0
+            logger.info("✅ OCR executor đã sẵn sàng")
+            self._dispatch_waiting()
+        except Exception as e:
+            with self._lock:
+                self._load_failures += 1
+                backoff = min(LOAD_RETRY_MAX, LOAD_RETRY_SECONDS * 2 ** (self._load_failures - 1))
+                self._retry_at = time.monotonic() + backoff
+                self.load_error = str(e)
+                # Cho phép request sau thời gian backoff nạp lại
+                self._warm_thread = None
+            logger.error(f"❌ Lỗi nạp model OCR: {e} (thử lại sau {backoff:.0f}s)")
+            self._fail_waiting(ExecutorError(f"Không nạp được model OCR: {e}", status_code=503,
+                                             retry_after=max(1, math.ceil(backoff))))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = self._pending
+            running = self._running
+        stats = {"backend": self.backend, "ready": self.ready, "workers": self.workers, "capacity": self.capacity}
+        if self._farm is not None:
+            farm = self._farm.stats()
+            running = farm["busy"]
+            stats["restarts"] = farm["restarts"]
+        stats["running"] = running
+        stats["queued"] = max(pending - running, 0)
+        return stats
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._closed = True
+        self._fail_waiting(ExecutorError("OCR executor đã dừng", status_code=503))
+        if self._farm is not None:
+            self._farm.shutdown(wait_workers=wait)
+        else:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
@@ -1,32 +1,59 @@
 ﻿# services/ocr_service.py - OCR Service mới cho hệ thống
 import os
+import time
 import logging
-from typing import Dict, Any
-from services.smart_ocr import extract_text_from_image
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Any, Iterator, Optional
+from services.smart_ocr import extract_text_from_image, get_ocr_engine
+from services.cpu_tuning import configure_torch_threads, default_threads
 
 logger = logging.getLogger(__name__)
 
 class OCRService:
     """OCR Service cho hệ thống Smart OCR"""
     
-    def __init__(self):
+    def __init__(self, warm_up: bool = False):
+        # Không nạp model khi import; gọi warm_up()/start_warm_up() khi cần
         self.initialized = False
-        self._initialize()
+        self.load_error = None
+        self._warm_thread = None
+        self._lock = threading.Lock()
+        if warm_up:
+            self._initialize()
     
     def _initialize(self):
-        """Khởi tạo service"""
+        """Khởi tạo service (nạp OCR engine)"""
         try:
-            # Test OCR engine
-            test_result = extract_text_from_image(__file__)  # Test với chính file này
-            if not test_result['success']:
-                logger.warning("OCR engine cần khởi tạo lại...")
+            get_ocr_engine()
             
             self.initialized = True
+            self.load_error = None
             logger.info("✅ OCR Service đã sẵn sàng")
             
         except Exception as e:
+            self.load_error = str(e)
             logger.error(f"❌ Lỗi khởi tạo OCR Service: {e}")
     
+    def warm_up(self):
+        """Nạp OCR engine ngay (chặn đến khi xong)"""
+        self._initialize()
+        return self.initialized
+    
+    def start_warm_up(self):
+        """Nạp OCR engine ở thread nền, trả về ngay"""
+        with self._lock:
+            if self._warm_thread is not None:
+                return
+            self._warm_thread = threading.Thread(target=self._initialize, name="ocr-service-warm-up", daemon=True)
+        self._warm_thread.start()
+    
+    @property
+    def ready(self) -> bool:
+        return self.initialized
+    
     def process_document(self, image_path: str) -> Dict[str, Any]:
         """
         Xử lý document với OCR mới
@@ -66,14 +93,147 @@ class OCRService:
                 'confidence': 0.0
             }
     
-    def batch_process(self, image_paths: list) -> list:
-        """Xử lý nhiều ảnh cùng lúc"""
-        results = []
-        for image_path in image_paths:
-            results.append(self.process_document(image_path))
-        return results
+    def iter_batch(self, image_paths: list, workers: Optional[int] = None, ordered: bool = True,
+                   timeout: Optional[float] = None,
+                   progress: Optional[Callable[[int, int], None]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Xử lý nhiều ảnh song song trên process pool, yield kết quả từng ảnh.
+        
+        Args:
+            image_paths: Danh sách đường dẫn ảnh
+            workers: Số tiến trình (mặc định OCR_BATCH_WORKERS, 0 = số CPU)
+            ordered: True = yield theo thứ tự đầu vào, False = theo thứ tự xong
+            timeout: Số giây tối đa cho mỗi ảnh (mặc định OCR_BATCH_ITEM_TIMEOUT, 0 = không giới hạn)
+            progress: Hàm progress(done, total) gọi sau mỗi ảnh xong
+            
+        Yields:
+            Dict kết quả như process_document, kèm 'index' và 'image_path'.
+            Lỗi hoặc quá thời gian của một ảnh chỉ ảnh hưởng kết quả của ảnh đó.
+        """
+        paths = list(image_paths)
+        total = len(paths)
+        if workers is None:
+            workers = int(os.getenv("OCR_BATCH_WORKERS", 0))
+        workers = min(workers or os.cpu_count() or 1, total) or 1
+        if timeout is None:
+            timeout = float(os.getenv("OCR_BATCH_ITEM_TIMEOUT", 0))
+        
+        if workers == 1:
+            items = self._iter_sequential(paths)
+        else:
+            items = self._iter_parallel(paths, workers, timeout or None)
+        
+        pending = {}
+        next_index = 0
+        for done, (index, result) in enumerate(items, 1):
+            result['index'] = index
+            result['image_path'] = paths[index]
+            if progress is not None:
+                progress(done, total)
+            if not ordered:
+                yield result
+                continue
+            pending[index] = result
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+    
+    def _iter_sequential(self, paths: list):
+        for index, image_path in enumerate(paths):
+            yield index, self.process_document(image_path)
+    
+    def _iter_parallel(self, paths: list, workers: int, timeout: Optional[float]):
+        """Chạy tối đa `workers` ảnh cùng lúc; pool bị treo/chết thì dựng lại"""
+        context = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        queue = list(range(len(paths)))[::-1]
+        running = {}  # future -> (index, deadline)
+        crashes = {}  # index -> số lần pool chết khi đang chạy ảnh này
+        pool = _new_pool(workers, context)
+        logger.info(f"🔄 Batch OCR: {len(paths)} ảnh trên {workers} tiến trình")
+        try:
+            while queue or running:
+                while queue and len(running) < workers:
+                    if crashes.get(queue[-1]) and running:
+                        break
+                    index = queue.pop()
+                    future = pool.submit(_process_in_worker, paths[index])
+                    running[future] = (index, time.monotonic() + timeout if timeout else None)
+                    if crashes.get(index):
+                        # Ảnh bị nghi làm chết tiến trình: chạy lại một mình
+                        break
+                
+                deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+                wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+                done, _ = wait(running, timeout=wait_for, return_when=FIRST_COMPLETED)
+                
+                broken = False
+                for future in done:
+                    index, _ = running.pop(future)
+                    try:
+                        yield index, future.result()
+                    except BrokenProcessPool:
+                        # Không biết ảnh nào làm chết tiến trình: chạy lại riêng rồi mới báo lỗi
+                        broken = True
+                        crashes[index] = crashes.get(index, 0) + 1
+                        if crashes[index] < 2:
+                            queue.append(index)
+                        else:
+                            yield index, _failed(f'Tiến trình OCR bị dừng khi xử lý {paths[index]}')
+                    except Exception as e:
+                        yield index, _failed(str(e))
+                
+                now = time.monotonic()
+                expired = [f for f, (_, deadline) in running.items() if deadline is not None and deadline <= now]
+                for future in expired:
+                    index, _ = running.pop(future)
+                    logger.error(f"❌ Quá {timeout}s khi OCR {paths[index]}")
+                    yield index, _failed(f'Quá thời gian {timeout}s')
+                
+                if expired or broken:
+                    # Không huỷ được một task đang chạy: dừng cả pool, chạy lại các ảnh dở dang
+                    queue.extend(index for index, _ in running.values())
+                    queue.sort(reverse=True)
+                    running.clear()
+                    _terminate_pool(pool)
+                    pool = _new_pool(workers, context)
+        finally:
+            _terminate_pool(pool)
+    
+    def batch_process(self, image_paths: list, workers: Optional[int] = None,
+                      timeout: Optional[float] = None) -> list:
+        """Xử lý nhiều ảnh cùng lúc, kết quả theo thứ tự đầu vào"""
+        return list(self.iter_batch(image_paths, workers=workers, timeout=timeout))
+
+def _failed(error: str) -> Dict[str, Any]:
+    return {
+        'success': False,
+        'error': error,
+        'text': '',
+        'confidence': 0.0
+    }
+
+def _new_pool(workers: int, context) -> ProcessPoolExecutor:
+    # Mỗi tiến trình con chỉ dùng phần core của mình, tránh N tiến trình cùng mở thread trên mọi core
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                               initializer=configure_torch_threads, initargs=(default_threads(workers),))
+
+
+def _terminate_pool(pool: ProcessPoolExecutor):
+    """Dừng pool ngay, kể cả tiến trình đang treo"""
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout=5)
+
+def _process_in_worker(image_path: str) -> Dict[str, Any]:
+    """Chạy trong tiến trình con của iter_batch"""
+    return ocr_service.process_document(image_path)
 
-# Singleton instance cho toàn hệ thống
+# Singleton instance cho toàn hệ thống (model được nạp khi cần)
 ocr_service = OCRService()
 
 # API cũ để tương thích ngược
@@ -88,7 +248,7 @@ def extract_text(image_path: str) -> str:
 
 if __name__ == '__main__':
     # Test service
-    service = OCRService()
+    service = OCRService(warm_up=True)
     test_image = "uploads/66e5febd.png"
     
     if os.path.exists(test_image):
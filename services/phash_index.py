@@ -0,0 +1,223 @@
+﻿# services/phash_index.py - Nhận ra ảnh gần trùng (chụp lại, nén lại) bằng perceptual hash + BK-tree, dùng lại kết quả OCR
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Tắt mặc định: tài liệu cùng mẫu (hai hoá đơn cùng layout) có hash rất gần nhau
+ENABLED = os.getenv("OCR_PHASH", "0") == "1"
+# Độ giống tối thiểu (1 - khoảng cách Hamming / số bit) để coi là cùng một tài liệu
+SIMILARITY = float(os.getenv("OCR_PHASH_SIMILARITY", 0.95))
+MAX_ENTRIES = int(os.getenv("OCR_PHASH_MAX_ENTRIES", 10000))
+
+HASH_BITS = 64
+# dHash chi tiết hơn (16x16) để xác nhận ứng viên tìm được bằng pHash
+DETAIL_SIZE = 16
+_DCT_SIZE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    return np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+try:
+    _popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _popcount(value: int) -> int:
+        return bin(value).count("1")
+
+
+def hamming(a: int, b: int) -> int:
+    return _popcount(a ^ b)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel().astype(np.uint8)).tobytes(), "big")
+
+
+def _normalize(image) -> Image.Image:
+    """Ảnh xám, giãn tương phản: bớt ảnh hưởng của độ sáng / cân bằng trắng khi chụp lại"""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    return ImageOps.autocontrast(image.convert("L"), cutoff=1)
+
+
+def phash(image) -> int:
+    """pHash 64 bit: 8x8 hệ số DCT tần số thấp của thumbnail 32x32, so với trung vị"""
+    gray = np.asarray(_normalize(image).resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ gray @ _DCT.T)[:8, :8]
+    # Bỏ hệ số DC (độ sáng trung bình) khi lấy trung vị
+    median = np.median(low.ravel()[1:])
+    return _bits_to_int(low > median)
+
+
+def dhash(image, size: int = 8) -> int:
+    """dHash size*size bit: chiều tăng/giảm độ sáng giữa các điểm kề nhau theo hàng"""
+    gray = np.asarray(_normalize(image).resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(gray[:, 1:] > gray[:, :-1])
+
+
+def image_hashes(image) -> Tuple[int, int]:
+    """(pHash 64 bit, dHash 256 bit) của ảnh (PIL hoặc numpy)"""
+    return phash(image), dhash(image, DETAIL_SIZE)
+
+
+class BKTree:
+    """BK-tree theo khoảng cách Hamming: tìm mọi hash trong bán kính r mà không quét hết"""
+
+    def __init__(self):
+        # node: [hash, các id cùng hash, {khoảng cách: node con}]
+        self._root: Optional[List[Any]] = None
+        self.size = 0
+
+    def add(self, value: int, item_id: int):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item_id], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item_id], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, int]]:
+        """Các (khoảng cách, id) có hash cách value không quá radius"""
+        if self._root is None:
+            return []
+        found, stack = [], [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item_id) for item_id in node[1])
+            # Bất đẳng thức tam giác: chỉ nhánh có khoảng cách trong [d - r, d + r] mới có thể chứa kết quả
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class PHashIndex:
+    """
+    Kết quả OCR theo perceptual hash của ảnh, tra theo độ giống thay vì khớp tuyệt đối.
+
+    Ứng viên tìm bằng pHash 64 bit trên BK-tree, rồi xác nhận bằng dHash 256 bit; cả hai
+    phải đạt similarity. Kết quả chỉ dùng lại trong cùng namespace (ngôn ngữ, tiền xử lý, ...).
+    Vượt max_entries thì bỏ mục ít dùng gần đây nhất; BK-tree dựng lại khi số mục đã bỏ
+    chiếm quá nửa cây.
+
+    Args:
+        similarity: 0-1, mặc định OCR_PHASH_SIMILARITY
+        max_entries: Số kết quả giữ lại, mặc định OCR_PHASH_MAX_ENTRIES
+    """
+
+    def __init__(self, similarity: Optional[float] = None, max_entries: Optional[int] = None):
+        self.similarity = SIMILARITY if similarity is None else similarity
+        self.max_entries = max_entries or MAX_ENTRIES
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._tree = BKTree()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.seconds_saved = 0.0
+
+    def _radius(self, bits: int) -> int:
+        return int((1.0 - self.similarity) * bits)
+
+    def lookup(self, hashes: Tuple[int, int], namespace: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Kết quả của ảnh gần trùng nhất, hoặc None.
+
+        Returns:
+            dict gồm result, similarity, distance, saved_s (thời gian OCR của lần gốc)
+        """
+        coarse, detail = hashes
+        detail_radius = self._radius(DETAIL_SIZE * DETAIL_SIZE)
+        with self._lock:
+            self.lookups += 1
+            best = None
+            for distance, item_id in self._tree.search(coarse, self._radius(HASH_BITS)):
+                entry = self._entries.get(item_id)
+                if entry is None or entry["namespace"] != namespace:
+                    continue
+                detail_distance = hamming(detail, entry["detail"])
+                if detail_distance > detail_radius:
+                    continue
+                if best is None or (distance, detail_distance) < best[:2]:
+                    best = (distance, detail_distance, item_id)
+            if best is None:
+                return None
+            entry = self._entries[best[2]]
+            self._entries.move_to_end(best[2])
+            self.hits += 1
+            self.seconds_saved += entry["seconds"]
+            return {
+                "result": entry["result"],
+                "similarity": round(1.0 - best[1] / (DETAIL_SIZE * DETAIL_SIZE), 4),
+                "distance": best[0],
+                "saved_s": entry["seconds"],
+            }
+
+    def add(self, hashes: Tuple[int, int], result: Any, seconds: float, namespace: str = ""):
+        """Lưu kết quả OCR của ảnh; seconds = thời gian nhận dạng để tính thời gian tiết kiệm"""
+        coarse, detail = hashes
+        with self._lock:
+            item_id = self._next_id
+            self._next_id += 1
+            self._entries[item_id] = {"detail": detail, "coarse": coarse, "namespace": namespace,
+                                      "result": result, "seconds": seconds}
+            self._tree.add(coarse, item_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self._tree.size > 2 * len(self._entries):
+                self._rebuild()
+
+    def _rebuild(self):
+        tree = BKTree()
+        for item_id, entry in self._entries.items():
+            tree.add(entry["coarse"], item_id)
+        self._tree = tree
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "seconds_saved": round(self.seconds_saved, 3),
+                "similarity": self.similarity,
+            }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_phash_index() -> PHashIndex:
+    """Index dùng chung của tiến trình; thống kê có ở /metrics"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = PHashIndex()
+                from services.metrics import register_phash_index
+                register_phash_index(_index)
+    return _index
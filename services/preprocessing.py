@@ -0,0 +1,264 @@
+﻿# services/preprocessing.py - Tiền xử lý ảnh trước bước detect (xoay EXIF, grayscale, thu nhỏ, chỉnh nghiêng)
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from services.image_io import UploadError, open_image, to_8bit
+from services.metrics import observe_stage
+from services.profiler import profiled_thread
+
+logger = logging.getLogger(__name__)
+
+# Cỡ chữ thân văn bản giả định (point) để ước lượng chiều cao chữ từ DPI
+BODY_TEXT_PT = 10
+# DPI nhỏ hơn mức này thường là giá trị mặc định của phần mềm, không đáng tin
+MIN_TRUSTED_DPI = 100
+
+# Profile dựng sẵn; OCR_PREPROCESS_PROFILES (JSON) có thể thêm/ghi đè theo tenant.
+# "original" (mặc định) chỉ xoay theo EXIF, giữ nguyên màu và độ phân giải như trước khi có tiền xử lý;
+# các profile khác đổi kết quả OCR nên client chọn qua X-OCR-Profile hoặc OCR_PREPROCESS_PROFILE
+DEFAULT_PROFILE = "original"
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "original": {"grayscale": False, "target_text_height": 0, "max_side": 0, "deskew": False},
+    "fast": {"grayscale": True, "target_text_height": 16, "max_side": 1600, "deskew": False},
+    "balanced": {"grayscale": True, "target_text_height": 24, "max_side": 2560, "deskew": False},
+    "accurate": {"grayscale": False, "target_text_height": 0, "max_side": 4096, "deskew": True},
+}
+
+
+class Preprocessor:
+    """
+    Chuỗi bước tiền xử lý, mỗi bước bật/tắt được và được đo thời gian.
+
+    Args:
+        name: Tên profile (để log / Server-Timing)
+        exif_transpose: Xoay ảnh theo EXIF Orientation (ảnh chụp điện thoại)
+        grayscale: Chuyển sang ảnh xám (detect/nhận dạng nhanh hơn, ít bộ nhớ hơn)
+        target_text_height: Chiều cao chữ mong muốn (pixel) khi ảnh có DPI, 0 = tắt
+        max_side: Cạnh dài tối đa sau khi thu nhỏ, 0 = không giới hạn
+        deskew: Ước lượng và chỉnh góc nghiêng nhỏ của trang
+        max_skew: Góc nghiêng tối đa (độ) được xét khi deskew
+    """
+
+    def __init__(self, name: str = DEFAULT_PROFILE, exif_transpose: bool = True, grayscale: bool = False,
+                 target_text_height: int = 0, max_side: int = 0, deskew: bool = False,
+                 max_skew: float = 5.0):
+        self.name = name
+        self.exif_transpose = exif_transpose
+        self.grayscale = grayscale
+        self.target_text_height = target_text_height
+        self.max_side = max_side
+        self.deskew = deskew
+        self.max_skew = max_skew
+
+    def params(self) -> Dict[str, Any]:
+        return {
+            "exif_transpose": self.exif_transpose,
+            "grayscale": self.grayscale,
+            "target_text_height": self.target_text_height,
+            "max_side": self.max_side,
+            "deskew": self.deskew,
+            "max_skew": self.max_skew,
+        }
+
+    def load(self, data) -> Tuple[Any, Dict[str, Any]]:
+        """Giải mã bytes/memoryview rồi tiền xử lý; trả về (numpy array, thông tin)"""
+        start = time.perf_counter()
+        image = open_image(data)
+        decode_ms = (time.perf_counter() - start) * 1000
+        observe_stage("decode", decode_ms / 1000)
+        array, info = self.apply(image)
+        info["steps"] = {"decode": round(decode_ms, 2), **info["steps"]}
+        return array, info
+
+    def apply(self, image) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Tiền xử lý một PIL Image.
+
+        Returns:
+            (numpy array uint8 RGB hoặc xám, dict gồm profile, thời gian từng bước (ms),
+            hệ số thu nhỏ, góc đã chỉnh và kích thước cuối)
+        """
+        import numpy as np
+
+        steps = {}
+        info = {"profile": self.name, "steps": steps, "scale": 1.0, "angle": 0.0}
+
+        def timed(step, fn, *args):
+            start = time.perf_counter()
+            result = fn(*args)
+            steps[step] = round((time.perf_counter() - start) * 1000, 2)
+            return result
+
+        if self.exif_transpose:
+            image = timed("exif", _exif_transpose, image)
+        image = timed("mode", _normalize_mode, image, self.grayscale)
+
+        scale = _target_scale(image, self.target_text_height, self.max_side)
+        if scale < 1.0:
+            image = timed("resize", _resize, image, scale)
+            info["scale"] = round(scale, 4)
+
+        if self.deskew:
+            angle = timed("deskew_estimate", _estimate_skew, image, self.max_skew)
+            if angle:
+                image = timed("deskew_rotate", _rotate, image, angle)
+                info["angle"] = angle
+
+        info["size"] = list(image.size)
+        observe_stage("preprocess", sum(steps.values()) / 1000)
+        return np.asarray(image), info
+
+
+def _exif_transpose(image):
+    from PIL import ImageOps
+
+    # Đọc tag Orientation trước: phần lớn ảnh không cần xoay, tránh copy ảnh
+    orientation = image.getexif().get(0x0112, 1)
+    if orientation in (None, 1):
+        return image
+    return ImageOps.exif_transpose(image)
+
+
+def _normalize_mode(image, grayscale: bool):
+    """Đưa mọi mode (RGBA, P, CMYK, 16-bit...) về RGB hoặc L; nền trong suốt thành trắng"""
+    from PIL import Image
+
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA", "PA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.getchannel("A"))
+        image = background
+    # 16-bit phải đổi thang về 8-bit trước, convert("L") sẽ cắt mọi giá trị > 255 thành trắng
+    image = to_8bit(image)
+
+    if grayscale:
+        return image if image.mode == "L" else image.convert("L")
+    if image.mode in ("RGB", "L"):
+        return image
+    return image.convert("RGB")
+
+
+def _target_scale(image, target_text_height: int, max_side: int) -> float:
+    """Hệ số thu nhỏ (<= 1): theo DPI để chữ cao khoảng target_text_height, và theo max_side"""
+    scale = 1.0
+    dpi = image.info.get("dpi")
+    if target_text_height and dpi:
+        try:
+            dpi_value = float(min(dpi[:2]))
+        except (TypeError, ValueError):
+            dpi_value = 0.0
+        if dpi_value >= MIN_TRUSTED_DPI:
+            text_height = dpi_value * BODY_TEXT_PT / 72
+            scale = min(scale, target_text_height / text_height)
+    if max_side and max(image.size) > max_side:
+        scale = min(scale, max_side / max(image.size))
+    return scale
+
+
+def _resize(image, scale: float):
+    from PIL import Image
+
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    # reducing_gap: giảm nhanh theo bội số nguyên trước rồi mới lọc, gần bằng chất lượng LANCZOS
+    return image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+
+def _estimate_skew(image, max_skew: float, step: float = 0.25, sample_side: int = 800) -> float:
+    """
+    Ước lượng góc cần xoay để chỉnh nghiêng bằng projection profile: với góc
+    đúng, các dòng chữ thẳng hàng nên tổng bình phương histogram theo hàng là lớn nhất.
+    """
+    import numpy as np
+
+    grey = image.convert("L") if image.mode != "L" else image
+    if max(grey.size) > sample_side:
+        factor = max(grey.size) / sample_side
+        grey = grey.resize((max(1, int(grey.width / factor)), max(1, int(grey.height / factor))))
+    pixels = np.asarray(grey, dtype=np.uint8)
+
+    # Pixel chữ: tối hơn nền (giả định chữ tối trên nền sáng)
+    ys, xs = np.nonzero(pixels < min(float(pixels.mean()), 128.0))
+    if len(ys) < 100:
+        return 0.0
+    ys = ys.astype(np.float32)
+    xs = xs.astype(np.float32) - pixels.shape[1] / 2
+
+    best_angle, best_score = 0.0, -1.0
+    height = pixels.shape[0]
+    for angle in np.arange(-max_skew, max_skew + step / 2, step):
+        theta = np.deg2rad(angle)
+        rows = (ys * np.cos(theta) - xs * np.sin(theta)).astype(np.int32)
+        hist = np.bincount(rows - rows.min(), minlength=height)
+        score = float(np.dot(hist, hist))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return round(best_angle, 2) if abs(best_angle) >= step else 0.0
+
+
+def _rotate(image, angle: float):
+    from PIL import Image
+
+    fill = 255 if image.mode == "L" else (255, 255, 255)
+    # angle là góc cần xoay (ngược chiều kim đồng hồ) để dòng chữ nằm ngang
+    return image.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=fill)
+
+
+def _load_profiles() -> Dict[str, Dict[str, Any]]:
+    """Profile dựng sẵn + OCR_PREPROCESS_PROFILES; profile có khoá lạ bị bỏ qua (báo khoá sai trong log)"""
+    profiles = {name: dict(params) for name, params in PROFILES.items()}
+    raw = os.getenv("OCR_PREPROCESS_PROFILES", "")
+    if raw:
+        keys = set(Preprocessor().params())
+        try:
+            for name, params in json.loads(raw).items():
+                if not isinstance(params, dict):
+                    logger.warning(f"⚠️ OCR_PREPROCESS_PROFILES: profile '{name}' phải là object JSON, bỏ qua")
+                    continue
+                unknown = sorted(set(params) - keys)
+                if unknown:
+                    logger.warning(f"⚠️ OCR_PREPROCESS_PROFILES: profile '{name}' có khoá không hợp lệ "
+                                   f"{', '.join(unknown)} (hỗ trợ: {', '.join(sorted(keys))}), bỏ qua")
+                    continue
+                profiles[name] = {**profiles.get(name, {}), **params}
+        except (ValueError, AttributeError) as e:
+            logger.warning(f"⚠️ OCR_PREPROCESS_PROFILES không hợp lệ: {e}")
+    return profiles
+
+
+_profiles = None
+_preprocessors: Dict[str, Preprocessor] = {}
+
+
+def get_preprocessor(profile: Optional[str] = None) -> Preprocessor:
+    """
+    Lấy Preprocessor theo tên profile (mặc định OCR_PREPROCESS_PROFILE).
+    Tên không tồn tại -> UploadError 400.
+    """
+    global _profiles
+    if _profiles is None:
+        _profiles = _load_profiles()
+    name = profile or os.getenv("OCR_PREPROCESS_PROFILE", DEFAULT_PROFILE)
+    preprocessor = _preprocessors.get(name)
+    if preprocessor is None:
+        if name not in _profiles:
+            raise UploadError(f"Không có profile tiền xử lý '{name}'", status_code=400)
+        preprocessor = _preprocessors.setdefault(name, Preprocessor(name=name, **_profiles[name]))
+    return preprocessor
+
+
+def preprocess_upload(upload, preprocessor: Preprocessor):
+    """Giải mã + tiền xử lý một Upload rồi trả buffer về pool"""
+    try:
+        with profiled_thread():
+            return preprocessor.load(upload.view())
+    finally:
+        upload.release()
+
+
+def server_timing(info: Dict[str, Any]) -> str:
+    """Thời gian từng bước dạng header Server-Timing"""
+    return ", ".join(f"pre-{step};dur={ms}" for step, ms in info["steps"].items())
@@ -0,0 +1,302 @@
+﻿# services/profiler.py - Profile lấy mẫu theo từng request (sys._current_frames), lưu cục bộ, xuất collapsed stacks / speedscope
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tỷ lệ request /ocr được profile ngẫu nhiên (0.01 = 1%); 0 = chỉ khi admin yêu cầu qua header
+SAMPLE_RATE = float(os.getenv("OCR_PROFILE_RATE", 0))
+INTERVAL_MS = float(os.getenv("OCR_PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("OCR_PROFILE_DIR", "profiles")
+# Số profile giữ lại trên đĩa (xoá cũ nhất)
+MAX_PROFILES = int(os.getenv("OCR_PROFILE_KEEP", 50))
+# Số profile tối đa mỗi phút, kể cả yêu cầu từ admin (lấy mẫu tốn CPU)
+MAX_PER_MINUTE = int(os.getenv("OCR_PROFILE_MAX_PER_MIN", 10))
+# Token cho header X-Admin-Token và các endpoint /admin/profiles; trống = tắt
+ADMIN_TOKEN = os.getenv("OCR_ADMIN_TOKEN", "")
+# Độ sâu stack tối đa mỗi mẫu
+MAX_DEPTH = 128
+
+_current: contextvars.ContextVar = contextvars.ContextVar("ocr_profile", default=None)
+
+
+class Profile:
+    """Mẫu stack của các thread đang làm việc cho một request"""
+
+    def __init__(self, name: str, interval_ms: float = INTERVAL_MS):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.interval_ms = interval_ms
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = 0.0
+        self.samples: Counter = Counter()
+        # thread id -> (tên thread, số khối profiled_thread đang mở)
+        self._threads: Dict[int, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            entry = self._threads.setdefault(ident, [threading.current_thread().name, 0])
+            entry[1] += 1
+
+    def exit_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            entry = self._threads.get(ident)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._threads[ident]
+
+    def sample(self, frames: Dict[int, Any]):
+        with self._lock:
+            threads = [(ident, entry[0]) for ident, entry in self._threads.items()]
+        for ident, thread_name in threads:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_name)
+            stack.reverse()
+            with self._lock:
+                self.samples[tuple(stack)] += 1
+
+    def finish(self):
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = [[list(stack), count] for stack, count in self.samples.most_common()]
+        return {"id": self.id, "name": self.name, "started": round(self.started, 3), "duration_ms": self.duration_ms,
+                "interval_ms": self.interval_ms, "sample_count": sum(count for _, count in samples), "samples": samples}
+
+
+class _Sampler:
+    """Một thread nền lấy mẫu cho mọi profile đang mở; tự dừng khi không còn profile nào"""
+
+    def __init__(self):
+        self._profiles: List[Profile] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ocr-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: Profile):
+        with self._lock:
+            if profile in self._profiles:
+                self._profiles.remove(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._profiles)
+                if not profiles:
+                    self._thread = None
+                    return
+            interval = min(profile.interval_ms for profile in profiles) / 1000
+            frames = sys._current_frames()
+            for profile in profiles:
+                profile.sample(frames)
+            del frames
+            time.sleep(interval)
+
+
+_sampler = _Sampler()
+
+
+class ProfileStore:
+    """Profile đã xong, lưu thành <id>.json trong thư mục; giữ tối đa max_profiles file"""
+
+    def __init__(self, directory: str = PROFILE_DIR, max_profiles: int = MAX_PROFILES):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id: str) -> Optional[str]:
+        # id là hex do Profile tạo; chặn đường dẫn lạ từ URL
+        if not profile_id or not all(ch in "0123456789abcdef" for ch in profile_id):
+            return None
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def save(self, profile: Profile):
+        data = profile.to_dict()
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(profile.id)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+            for stale in self._entries()[self.max_profiles:]:
+                try:
+                    os.remove(os.path.join(self.directory, stale))
+                except OSError:
+                    pass
+
+    def _entries(self) -> List[str]:
+        """Tên file profile, mới nhất trước"""
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        except FileNotFoundError:
+            return []
+        return sorted(names, key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+
+    def load(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(profile_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Thông tin tóm tắt các profile, mới nhất trước"""
+        profiles = []
+        for name in self._entries():
+            data = self.load(name[:-5])
+            if data is not None:
+                profiles.append({key: data[key] for key in ("id", "name", "started", "duration_ms", "sample_count")})
+        return profiles
+
+
+class RateLimiter:
+    """Cửa sổ trượt 60 giây"""
+
+    def __init__(self, per_minute: int = MAX_PER_MINUTE):
+        self.per_minute = per_minute
+        self._times: deque = deque()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._times and now - self._times[0] > 60:
+                self._times.popleft()
+            if len(self._times) >= self.per_minute:
+                return False
+            self._times.append(now)
+            return True
+
+
+_store = None
+_limiter = RateLimiter()
+
+
+def get_profile_store() -> ProfileStore:
+    global _store
+    if _store is None:
+        _store = ProfileStore()
+    return _store
+
+
+def check_admin(token: Optional[str]) -> bool:
+    import hmac
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def should_profile(headers) -> bool:
+    """Request này có được profile không: header X-OCR-Profiling: 1 kèm X-Admin-Token đúng, hoặc trúng OCR_PROFILE_RATE"""
+    requested = headers.get("X-OCR-Profiling") == "1" and check_admin(headers.get("X-Admin-Token"))
+    if not requested and not (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE):
+        return False
+    return _limiter.allow()
+
+
+@contextmanager
+def profile_request(name: str, store: Optional[ProfileStore] = None):
+    """
+    Profile một request: mọi khối profiled_thread() chạy trong context này (kể cả thread
+    của asyncio.to_thread và worker OCRExecutor) được lấy mẫu. Yield Profile; lưu khi xong.
+    """
+    profile = Profile(name)
+    token = _current.set(profile)
+    _sampler.add(profile)
+    try:
+        yield profile
+    finally:
+        _sampler.remove(profile)
+        _current.reset(token)
+        profile.finish()
+        try:
+            (store or get_profile_store()).save(profile)
+            logger.info(f"✅ Đã lưu profile {profile.id} ({profile.name}, {profile.duration_ms:.0f} ms)")
+        except OSError as e:
+            logger.warning(f"⚠️ Không lưu được profile {profile.id}: {e}")
+
+
+def active() -> bool:
+    return _current.get() is not None
+
+
+@contextmanager
+def profiled_thread():
+    """Đánh dấu thread hiện tại đang làm việc cho profile của context; không có profile thì không làm gì"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    profile.enter_thread()
+    try:
+        yield
+    finally:
+        profile.exit_thread()
+
+
+def to_collapsed(data: Dict[str, Any]) -> str:
+    """Định dạng collapsed stacks (flamegraph.pl, speedscope, inferno): "a;b;c số_mẫu" mỗi dòng"""
+    return "".join(f"{';'.join(frame.replace(';', ',') for frame in stack)} {count}\n" for stack, count in data["samples"])
+
+
+def to_speedscope(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Định dạng file speedscope (https://www.speedscope.app), một profile kiểu sampled"""
+    frames: List[Dict[str, Any]] = []
+    index: Dict[str, int] = {}
+    samples, weights = [], []
+    for stack, count in data["samples"]:
+        row = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                name, _, location = frame.partition(" (")
+                entry: Dict[str, Any] = {"name": name}
+                if location:
+                    file, _, line = location.rstrip(")").rpartition(":")
+                    entry.update({"file": file, "line": int(line) if line.isdigit() else None})
+                frames.append(entry)
+            row.append(index[frame])
+        samples.append(row)
+        weights.append(round(count * data["interval_ms"], 3))
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{data['name']} {data['id']}",
+        "exporter": "smart-ocr profiler",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": data["name"],
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
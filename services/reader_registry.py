@@ -0,0 +1,236 @@
+﻿# services/reader_registry.py - Registry reader theo bộ ngôn ngữ: dùng chung detector, giới hạn RAM bằng LRU
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from services.tiered_ocr import TieredOCR, create_tiered_reader
+from services.cpu_tuning import configure_torch_threads, reader_options, tune_reader
+from services.metrics import readtext_staged
+
+logger = logging.getLogger(__name__)
+
+# Tổng dung lượng trọng số model được giữ cùng lúc; 0 = không giới hạn
+READER_BUDGET_MB = float(os.getenv("OCR_READER_BUDGET_MB", 0))
+# Ngôn ngữ được phép yêu cầu qua API (?lang=)
+ALLOWED_LANGUAGES = tuple(lang.strip() for lang in os.getenv("OCR_LANGUAGES_ALLOWED", "vi,en").split(",") if lang.strip())
+# Thuộc tính của easyocr.Reader tạo nên detector (CRAFT), chép sang reader tạo với detector=False
+_DETECTOR_ATTRS = ("detector", "detect_network", "get_textbox", "get_detector")
+# Ước lượng khi không đọc được kích thước model (vd. reader không phải torch)
+_FALLBACK_BYTES = 300 * 1024 * 1024
+
+
+def language_key(languages: Iterable[str]) -> Tuple[str, ...]:
+    """Khoá registry: bộ ngôn ngữ không trùng, sắp xếp (['vi', 'en'] và ['en', 'vi'] là một)"""
+    return tuple(sorted({lang.strip() for lang in languages if lang.strip()}))
+
+
+def parse_languages(value: Optional[str], default: Iterable[str], allowed: Iterable[str] = ALLOWED_LANGUAGES) -> List[str]:
+    """Đọc "vi,en" từ query; ngôn ngữ ngoài danh sách cho phép -> ValueError"""
+    if not value:
+        return list(language_key(default))
+    languages = list(language_key(value.split(",")))
+    unknown = [lang for lang in languages if lang not in allowed]
+    if not languages or unknown:
+        raise ValueError(f"Ngôn ngữ không được hỗ trợ: {', '.join(unknown) or value} (cho phép: {', '.join(allowed)})")
+    return languages
+
+
+def build_reader(languages: List[str], detector_parts: Optional[Dict[str, Any]] = None):
+    """
+    easyocr.Reader cho một bộ ngôn ngữ theo chế độ CPU (services/cpu_tuning.py),
+    bọc TieredOCR khi OCR_TIERED=1. Có detector_parts thì tạo reader không
+    detector rồi gắn detector dùng chung.
+    """
+    import easyocr
+
+    configure_torch_threads()
+
+    def accurate():
+        if detector_parts is None:
+            return tune_reader(easyocr.Reader(languages, **reader_options()))
+        reader = easyocr.Reader(languages, detector=False, **reader_options())
+        for name, value in detector_parts.items():
+            setattr(reader, name, value)
+        return tune_reader(reader)
+
+    return create_tiered_reader(accurate, lambda fast_languages: tune_reader(easyocr.Reader(fast_languages, **reader_options())))
+
+
+def _module_bytes(module) -> int:
+    try:
+        return sum(p.numel() * p.element_size() for p in module.parameters())
+    except Exception:
+        return 0
+
+
+def _reader_bytes(reader) -> int:
+    """
+    Trọng số reader giữ riêng (detector dùng chung tính riêng trong registry).
+    TieredOCR cộng thêm reader tầng nhanh: recognizer và detector của nó không dùng chung.
+    """
+    size = _module_bytes(getattr(reader, "recognizer", None))
+    if isinstance(reader, TieredOCR) and reader.fast_reader is not None:
+        fast = reader.fast_reader
+        size += _module_bytes(getattr(fast, "recognizer", None)) + _module_bytes(getattr(fast, "detector", None))
+    return size or _FALLBACK_BYTES
+
+
+class ReaderRegistry:
+    """
+    Reader dùng chung trong tiến trình, tạo theo bộ ngôn ngữ khi cần (thread-safe).
+
+    - Detector (CRAFT) chỉ nạp một lần, các reader sau dùng chung
+    - Tổng trọng số vượt budget_mb thì bỏ reader ít dùng gần đây nhất (LRU);
+      reader đang chạy dở vẫn sống đến khi xong
+    - Chính registry dùng được như reader của default_languages (readtext,
+      detect, recognize, ...), nên truyền thẳng làm reader cho OCRExecutor
+
+    Args:
+        builder: Hàm (languages, detector_parts) -> reader (mặc định build_reader)
+        budget_mb: Giới hạn trọng số model, MB (mặc định OCR_READER_BUDGET_MB, 0 = không giới hạn)
+        default_languages: Bộ ngôn ngữ khi không chỉ định
+    """
+
+    def __init__(self, builder: Optional[Callable[..., Any]] = None, budget_mb: Optional[float] = None,
+                 default_languages: Iterable[str] = ("vi", "en")):
+        self.builder = builder or build_reader
+        self.budget_bytes = int((READER_BUDGET_MB if budget_mb is None else budget_mb) * 1024 * 1024)
+        self.default_languages = list(language_key(default_languages))
+        self._readers: "OrderedDict[Tuple[str, ...], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Tuple[str, ...], threading.Lock] = {}
+        self._detector_lock = threading.Lock()
+        self._detector_parts: Optional[Dict[str, Any]] = None
+        self._detector_bytes = 0
+        self.builds = 0
+        self.evictions = 0
+
+    def get(self, languages: Optional[Iterable[str]] = None):
+        """Reader cho bộ ngôn ngữ, tạo lần đầu khi cần"""
+        key = language_key(languages or self.default_languages)
+        with self._lock:
+            entry = self._touch(key)
+            if entry is not None:
+                return entry["reader"]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Chỉ một thread tạo reader cho mỗi bộ ngôn ngữ; bộ khác vẫn tạo song song được
+        with key_lock:
+            with self._lock:
+                entry = self._touch(key)
+                if entry is not None:
+                    return entry["reader"]
+                detector_parts = self._detector_parts
+            if detector_parts is not None:
+                return self._build(key, detector_parts)
+            # Chưa có detector: các reader tạo cùng lúc chờ reader đầu tiên để dùng chung thay vì nạp thêm bản nữa
+            with self._detector_lock:
+                return self._build(key, self._detector_parts)
+
+    def _build(self, key, detector_parts):
+        logger.info(f"🔄 Khởi tạo reader {list(key)}{' (dùng chung detector)' if detector_parts else ''}...")
+        start = time.perf_counter()
+        reader = self.builder(list(key), detector_parts)
+        size = _reader_bytes(reader)
+        logger.info(f"✅ Reader {list(key)} sẵn sàng sau {time.perf_counter() - start:.1f}s (~{size / 1048576:.0f} MB)")
+
+        with self._lock:
+            self.builds += 1
+            if self._detector_parts is None and getattr(reader, "detector", None) is not None:
+                self._detector_parts = {name: getattr(reader, name) for name in _DETECTOR_ATTRS if hasattr(reader, name)}
+                self._detector_bytes = _module_bytes(self._detector_parts["detector"])
+            self._readers[key] = {"reader": reader, "bytes": size, "last_used": time.time()}
+            self._evict(keep=key)
+        return reader
+
+    def _touch(self, key):
+        entry = self._readers.get(key)
+        if entry is not None:
+            self._readers.move_to_end(key)
+            entry["last_used"] = time.time()
+        return entry
+
+    def _used_bytes(self) -> int:
+        return self._detector_bytes + sum(entry["bytes"] for entry in self._readers.values())
+
+    def _evict(self, keep):
+        """Bỏ reader LRU đến khi trong budget (gọi khi đang giữ self._lock)"""
+        if not self.budget_bytes:
+            return
+        while self._used_bytes() > self.budget_bytes and len(self._readers) > 1:
+            key = next(k for k in self._readers if k != keep)
+            self._readers.pop(key)
+            self.evictions += 1
+            logger.info(f"⚠️ Bỏ reader {list(key)} (vượt budget {self.budget_bytes / 1048576:.0f} MB)")
+
+    def evict(self, languages: Iterable[str]) -> bool:
+        with self._lock:
+            return self._readers.pop(language_key(languages), None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "readers": [
+                    {"languages": list(key), "mb": round(entry["bytes"] / 1048576, 1), "last_used": round(entry["last_used"], 3)}
+                    for key, entry in self._readers.items()
+                ],
+                "detector_mb": round(self._detector_bytes / 1048576, 1),
+                "used_mb": round(self._used_bytes() / 1048576, 1),
+                "budget_mb": round(self.budget_bytes / 1048576, 1) if self.budget_bytes else None,
+                "builds": self.builds,
+                "evictions": self.evictions,
+            }
+
+    def readtext(self, image, **kwargs):
+        return readtext_staged(self.get(), image, **kwargs)
+
+    def __getattr__(self, name):
+        # Thuộc tính reader khác (detect, recognize, recognizer, ...) lấy từ reader mặc định
+        if name.startswith("_") or "_readers" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+class LanguageView:
+    """
+    Registry dùng như reader của một bộ ngôn ngữ cố định: mỗi app giữ view riêng
+    thay vì đổi default_languages của registry dùng chung cả tiến trình.
+    """
+
+    def __init__(self, registry: ReaderRegistry, languages: Iterable[str]):
+        self.registry = registry
+        self.languages = list(language_key(languages))
+
+    def get(self, languages: Optional[Iterable[str]] = None):
+        return self.registry.get(languages or self.languages)
+
+    def readtext(self, image, **kwargs):
+        return readtext_staged(self.get(), image, **kwargs)
+
+    def __getattr__(self, name):
+        # Thuộc tính reader khác (detect, recognize, recognizer, ...) lấy từ reader của view
+        if name.startswith("_") or "registry" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+def readtext_languages(registry, image, languages: Iterable[str], **kwargs):
+    """Chạy trên worker của OCRExecutor (reader là registry / LanguageView): readtext bằng reader của bộ ngôn ngữ"""
+    return readtext_staged(registry.get(languages), image, **kwargs)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_reader_registry() -> ReaderRegistry:
+    """Registry dùng chung của tiến trình"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ReaderRegistry()
+    return _registry
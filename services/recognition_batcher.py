@@ -0,0 +1,199 @@
+﻿# services/recognition_batcher.py - Gom crop nhận dạng từ nhiều request thành một batch
+import os
+import math
+import time
+import queue
+import inspect
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from services.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Tham số nhận dạng của easyocr readtext / recognize mà batcher chuyển cho get_text
+RECOGNITION_KWARGS = ("decoder", "beamWidth", "workers", "allowlist", "blocklist",
+                      "contrast_ths", "adjust_contrast", "filter_ths")
+
+
+def batching_enabled() -> bool:
+    return float(os.getenv("OCR_BATCH_WAIT_MS", 0)) > 0
+
+
+def recognition_settings(reader, **kwargs) -> Dict[str, Any]:
+    """
+    Tham số get_text như reader.recognize dùng: mặc định lấy từ chữ ký reader.recognize
+    (cùng mặc định với readtext), ghi đè bằng kwargs; allowlist / blocklist đổi thành
+    ignore_char theo đúng cách easyocr làm
+    """
+    params = inspect.signature(reader.recognize).parameters
+    values = {name: kwargs[name] if name in kwargs else params[name].default for name in RECOGNITION_KWARGS}
+    if values["allowlist"]:
+        ignore = set(reader.character) - set(values["allowlist"])
+    elif values["blocklist"]:
+        ignore = set(values["blocklist"])
+    else:
+        ignore = set(reader.character) - set(reader.lang_char)
+    return {
+        "ignore_char": "".join(sorted(ignore)),
+        "decoder": values["decoder"],
+        "beamWidth": values["beamWidth"],
+        "contrast_ths": values["contrast_ths"],
+        "adjust_contrast": values["adjust_contrast"],
+        "filter_ths": values["filter_ths"],
+        "workers": values["workers"],
+    }
+
+
+class _Request:
+    __slots__ = ("crops", "future", "reader", "settings")
+
+    def __init__(self, crops, future, reader, settings):
+        self.crops = crops
+        self.future = future
+        self.reader = reader
+        self.settings = settings
+
+
+class RecognitionBatcher:
+    """
+    Gom các vùng chữ (crop) của nhiều request đồng thời trong tối đa max_wait_ms,
+    chạy recognizer trên từng batch có padding, rồi trả kết quả về đúng request.
+
+    Args:
+        reader: easyocr.Reader mặc định cho bước nhận dạng; recognize(reader=...) dùng reader
+            riêng cho lời gọi đó (batch chỉ gom crop của cùng một reader)
+        max_wait_ms: Thời gian tối đa chờ gom batch (mặc định OCR_BATCH_WAIT_MS)
+        max_batch: Số crop tối đa mỗi batch (mặc định OCR_BATCH_SIZE)
+    """
+
+    def __init__(self, reader=None, max_wait_ms: Optional[float] = None, max_batch: Optional[int] = None):
+        self.reader = reader
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.getenv("OCR_BATCH_WAIT_MS", 5))) / 1000.0
+        self.max_batch = max(1, max_batch or int(os.getenv("OCR_BATCH_SIZE", 32)))
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.crops = 0
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="ocr-batcher", daemon=True)
+                self._thread.start()
+
+    def recognize(self, img_cv_grey, horizontal_list, free_list, reader=None, **kwargs) -> Future:
+        """
+        Đưa các box của một ảnh vào hàng đợi nhận dạng, trả về Future kết quả.
+        kwargs: tham số nhận dạng như reader.recognize (RECOGNITION_KWARGS)
+        """
+        from easyocr.utils import get_image_list
+        from easyocr.easyocr import imgH
+
+        reader = reader if reader is not None else self.reader
+        if reader is None:
+            raise ValueError("RecognitionBatcher chưa có reader")
+
+        settings = recognition_settings(reader, **kwargs)
+        future = Future()
+        if not horizontal_list and not free_list:
+            y_max, x_max = img_cv_grey.shape
+            horizontal_list = [[0, x_max, 0, y_max]]
+            free_list = []
+
+        crops, _ = get_image_list(horizontal_list, free_list, img_cv_grey, model_height=imgH)
+        if not crops:
+            future.set_result([])
+            return future
+
+        self._ensure_thread()
+        self._queue.put(_Request(crops, future, reader, settings))
+        return future
+
+    def _collect(self) -> List[_Request]:
+        """Chờ request đầu tiên rồi gom thêm đến khi hết thời gian hoặc đủ batch"""
+        first = self._queue.get()
+        requests = [first]
+        total = len(first.crops)
+        deadline = time.monotonic() + self.max_wait
+        while total < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            requests.append(request)
+            total += len(request.crops)
+        return requests
+
+    def _loop(self):
+        while True:
+            requests = self._collect()
+            try:
+                self._run(requests)
+            except Exception as e:
+                logger.error(f"❌ Lỗi nhận dạng theo batch: {e}")
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _run(self, requests: List[_Request]):
+        # Request của các reader hoặc tham số nhận dạng khác nhau (vd. registry đổi reader) chạy thành batch riêng
+        groups = {}
+        for request in requests:
+            key = (id(request.reader), tuple(request.settings.items()))
+            groups.setdefault(key, []).append(request)
+        for group in groups.values():
+            self._run_reader(group[0].reader, group[0].settings, group)
+
+    def _run_reader(self, reader, settings: Dict[str, Any], requests: List[_Request]):
+        from easyocr.recognition import get_text
+        from easyocr.easyocr import imgH
+
+        # (request, vị trí trong request, crop) sắp theo độ rộng để giảm padding
+        items = [
+            (r_idx, c_idx, crop)
+            for r_idx, request in enumerate(requests)
+            for c_idx, crop in enumerate(request.crops)
+        ]
+        items.sort(key=lambda item: item[2][1].shape[1])
+
+        outputs = [[None] * len(request.crops) for request in requests]
+        for start in range(0, len(items), self.max_batch):
+            chunk = items[start:start + self.max_batch]
+            widest = max(item[2][1].shape[1] for item in chunk)
+            img_w = max(math.ceil(widest / imgH), 1) * imgH
+            results = get_text(
+                reader.character, imgH, int(img_w), reader.recognizer, reader.converter,
+                [item[2] for item in chunk], batch_size=len(chunk), device=reader.device, **settings,
+            )
+            for (r_idx, c_idx, _), result in zip(chunk, results):
+                outputs[r_idx][c_idx] = result
+
+        self.batches += 1
+        self.crops += len(items)
+        for request, output in zip(requests, outputs):
+            request.future.set_result(output)
+
+
+def readtext_batched(reader, batcher: RecognitionBatcher, image, **kwargs) -> List[Any]:
+    """
+    Như reader.readtext nhưng bước nhận dạng đi qua batcher dùng chung.
+    kwargs trong RECOGNITION_KWARGS dùng cho bước nhận dạng, còn lại cho reader.detect
+    """
+    from easyocr.utils import reformat_input
+
+    recognize_kwargs = {name: kwargs.pop(name) for name in RECOGNITION_KWARGS if name in kwargs}
+    img, img_cv_grey = reformat_input(image)
+    with stage("detection"):
+        horizontal_list, free_list = reader.detect(img, reformat=False, **kwargs)
+    # Gồm cả thời gian chờ gom batch
+    with stage("recognition"):
+        future = batcher.recognize(img_cv_grey, horizontal_list[0], free_list[0], reader=reader, **recognize_kwargs)
+        return future.result()
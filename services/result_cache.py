@@ -0,0 +1,226 @@
+﻿# services/result_cache.py - Cache kết quả OCR theo hash nội dung ảnh
+import os
+import io
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _decode_pixels(image):
+    """Giải mã ảnh (đường dẫn, bytes, PIL Image hoặc numpy array) thành numpy array"""
+    import numpy as np
+    from PIL import Image
+
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, str):
+        image = Image.open(image)
+    return np.asarray(image)
+
+
+def to_jsonable(value):
+    """Chuyển kết quả readtext (có numpy int/float) sang kiểu JSON được"""
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return value
+
+
+class OCRResultCache:
+    """
+    Cache hai tầng cho kết quả OCR: LRU trong RAM giới hạn theo số byte và
+    (tuỳ chọn) thư mục trên đĩa để giữ kết quả qua các lần khởi động lại.
+    Tầng đĩa cũng giới hạn theo byte: vượt thì xoá file dùng lâu nhất (theo mtime,
+    được cập nhật mỗi lần hit) đến khi còn khoảng 90% giới hạn.
+
+    Args:
+        max_bytes: Dung lượng tối đa tầng RAM (mặc định OCR_CACHE_MAX_BYTES, 0 = tắt)
+        disk_dir: Thư mục tầng đĩa (mặc định OCR_CACHE_DIR, rỗng = không dùng)
+        disk_max_bytes: Dung lượng tối đa tầng đĩa (mặc định OCR_CACHE_DISK_MAX_BYTES, 0 = không giới hạn)
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, disk_dir: Optional[str] = None,
+                 disk_max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("OCR_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.disk_dir = disk_dir if disk_dir is not None else os.getenv("OCR_CACHE_DIR", "")
+        self.disk_max_bytes = (disk_max_bytes if disk_max_bytes is not None
+                               else int(os.getenv("OCR_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)))
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self.disk_evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # Thư mục có thể còn file của lần chạy trước
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    @staticmethod
+    def make_key(image, langs: Iterable[str] = (), params: Optional[Dict[str, Any]] = None) -> str:
+        """Hash của pixel đã giải mã + danh sách ngôn ngữ + tham số engine"""
+        import numpy as np
+
+        pixels = np.ascontiguousarray(_decode_pixels(image))
+        digest = hashlib.sha256()
+        digest.update(f"{pixels.shape}|{pixels.dtype.str}|".encode())
+        digest.update(memoryview(pixels).cast("B"))
+        digest.update(json.dumps([list(langs), params or {}], sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_files(self):
+        """(mtime, size, path) của mọi file kết quả trong tầng đĩa"""
+        try:
+            shards = [entry.path for entry in os.scandir(self.disk_dir) if entry.is_dir()]
+        except OSError:
+            return []
+        files = []
+        for shard in shards:
+            try:
+                for entry in os.scandir(shard):
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                continue
+        return files
+
+    def _prune_disk(self):
+        """Xoá file dùng lâu nhất đến khi tầng đĩa còn ~90% giới hạn (gọi khi giữ _disk_lock)"""
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"⚠️ Không xoá được file cache {path}: {e}")
+                continue
+            total -= size
+            self.disk_evictions += 1
+        self._disk_bytes = total
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = f.read()
+                value = json.loads(data)
+                # mtime = lần dùng gần nhất, để _prune_disk bỏ file ít dùng trước
+                os.utime(path)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self._remember(key, value, len(data.encode("utf-8")))
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        value = to_jsonable(value)
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        self._remember(key, value, size)
+
+        if self.disk_dir:
+            if self.disk_max_bytes and size > self.disk_max_bytes:
+                return
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"⚠️ Không ghi được cache ra đĩa: {e}")
+                return
+            with self._disk_lock:
+                # Ghi đè cùng key có thể đếm trùng, _prune_disk tính lại từ file thật
+                self._disk_bytes += size
+                if self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes:
+                    self._prune_disk()
+
+    def _remember(self, key: str, value: Any, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes,
+                "disk_evictions": self.disk_evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Cache dùng chung trong tiến trình
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> OCRResultCache:
+    """Lấy cache kết quả OCR dùng chung"""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = OCRResultCache()
+    return _result_cache
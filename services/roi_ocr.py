@@ -0,0 +1,144 @@
+﻿# services/roi_ocr.py - OCR theo vùng quan tâm: pass độ phân giải thấp để phân loại + định vị trường, chỉ nhận dạng lại các vùng đó ở độ phân giải gốc
+import os
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from services.columnar import Detections
+from services.field_extraction import TEMPLATES, extract_fields
+from services.metrics import readtext_staged, stage
+
+logger = logging.getLogger(__name__)
+
+# Loại tài liệu chỉ cần vài trường, đủ điều kiện chạy theo vùng
+ROI_TYPES = tuple(t.strip() for t in os.getenv("OCR_ROI_TYPES", "id_card,driver_license").split(",") if t.strip())
+# Cạnh dài của ảnh cho pass phân loại
+LOW_RES_SIDE = int(os.getenv("OCR_ROI_LOW_RES", 800))
+# Ngưỡng để tin kết quả theo vùng; không đạt thì OCR lại cả trang
+MIN_FIELD_CONFIDENCE = float(os.getenv("OCR_ROI_MIN_CONFIDENCE", 0.5))
+MIN_FIELD_RATIO = float(os.getenv("OCR_ROI_MIN_FIELDS", 0.5))
+# Lề thêm quanh mỗi vùng, tính theo chiều cao box
+ROI_PADDING = 0.25
+
+_classifier = None
+
+
+def _get_classifier():
+    """DocumentClassifier dùng chung trong worker (tạo lần đầu khi cần)"""
+    global _classifier
+    if _classifier is None:
+        from document_classifier import DocumentClassifier
+        _classifier = DocumentClassifier()
+    return _classifier
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    return np.asarray(Image.fromarray(image).convert("L"))
+
+
+def _downscale(gray: np.ndarray, side: int):
+    """Ảnh thu nhỏ để cạnh dài <= side, kèm hệ số thu nhỏ"""
+    height, width = gray.shape
+    scale = min(1.0, side / max(height, width))
+    if scale == 1.0:
+        return gray, scale
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return np.asarray(Image.fromarray(gray).resize(size, Image.BILINEAR, reducing_gap=2.0)), scale
+
+
+def _scale_box(box, factor: float) -> List[List[float]]:
+    return [[float(x) * factor, float(y) * factor] for x, y in box]
+
+
+def _recognize_regions(reader, gray: np.ndarray, boxes: Sequence[Sequence[int]]) -> List[Optional[Tuple[str, float]]]:
+    """
+    Nhận dạng các vùng (x0, y0, x1, y1) trên ảnh gốc trong một lời gọi reader.recognize
+    (một batch cho recognizer); trả về (text, confidence) hoặc None theo thứ tự boxes
+    """
+    height, width = gray.shape
+    regions = []
+    for x0, y0, x1, y1 in boxes:
+        pad = max(2, int((y1 - y0) * ROI_PADDING))
+        regions.append([max(0, x0 - pad), min(width, x1 + pad), max(0, y0 - pad), min(height, y1 + pad)])
+    if not regions:
+        return []
+
+    with stage("recognition"):
+        results = reader.recognize(gray, horizontal_list=regions, free_list=[])
+    # easyocr sắp kết quả theo y: ghép lại với vùng yêu cầu theo góc trên-trái gần nhất
+    corners = np.array([[region[0], region[2]] for region in regions], dtype=np.float32)
+    matched: List[Optional[Tuple[str, float]]] = [None] * len(regions)
+    for box, text, confidence in results:
+        index = int(np.abs(corners - np.asarray(box[0], dtype=np.float32)).sum(axis=1).argmin())
+        if matched[index] is None:
+            matched[index] = (text, float(confidence))
+    return matched
+
+
+def _full_page(reader, image: np.ndarray, reason: str) -> Dict[str, Any]:
+    logger.info(f"⚠️ ROI OCR chuyển sang OCR cả trang ({reason})")
+    results = readtext_staged(reader, image)
+    with stage("classification"):
+        doc_type, confidence, _ = _get_classifier().classify("\n".join(result[1] for result in results))
+    return {
+        "mode": "full",
+        "fallback": reason,
+        "document_type": doc_type,
+        "classification_confidence": confidence,
+        "results": results,
+        "fields": extract_fields(Detections.from_readtext(results), doc_type),
+    }
+
+
+def roi_readtext(reader, image: np.ndarray, doc_types: Sequence[str] = ROI_TYPES) -> Dict[str, Any]:
+    """
+    OCR nhanh cho tài liệu đã biết mẫu (chạy trên worker, nhận reader làm tham số đầu):
+
+    1. readtext trên ảnh thu nhỏ (LOW_RES_SIDE) -> phân loại + định vị các trường theo template
+    2. Chỉ nhận dạng lại các box giá trị ở độ phân giải gốc
+    3. Thiếu trường hoặc confidence thấp -> OCR cả trang (mode "full", kèm lý do trong "fallback")
+
+    Returns:
+        dict gồm mode, document_type, classification_confidence, results (dạng readtext,
+        toạ độ ảnh gốc; ở mode "roi" chỉ các dòng trường là kết quả độ phân giải gốc), fields
+    """
+    gray = _to_gray(image)
+    low, scale = _downscale(gray, LOW_RES_SIDE)
+    results = [(_scale_box(box, 1 / scale), text, float(confidence)) for box, text, confidence in readtext_staged(reader, low)]
+
+    with stage("classification"):
+        doc_type, confidence, _ = _get_classifier().classify("\n".join(result[1] for result in results))
+    if doc_type not in doc_types or doc_type not in TEMPLATES:
+        return _full_page(reader, image, "document_type")
+
+    required = MIN_FIELD_RATIO * len(TEMPLATES[doc_type])
+    # Text ở độ phân giải thấp hay sai ký tự: chỉ cần định vị box giá trị
+    located = extract_fields(Detections.from_readtext(results), doc_type, lenient=True)
+    if len(located) < required:
+        return _full_page(reader, image, "fields_not_found")
+
+    targets = list(located.values())
+    # Mọi vùng trường của trang đi chung một lời gọi recognize
+    for field, recognized in zip(targets, _recognize_regions(reader, gray, [target["box"] for target in targets])):
+        if recognized is not None:
+            line = field["line"]
+            results[line] = (results[line][0], recognized[0], recognized[1])
+
+    fields = extract_fields(Detections.from_readtext(results), doc_type)
+    mean_confidence = float(np.mean([field["confidence"] for field in fields.values()])) if fields else 0.0
+    if len(fields) < required or mean_confidence < MIN_FIELD_CONFIDENCE:
+        return _full_page(reader, image, "low_confidence")
+
+    return {
+        "mode": "roi",
+        "document_type": doc_type,
+        "classification_confidence": confidence,
+        "results": results,
+        "fields": fields,
+        "regions": len(located),
+        "scale": round(scale, 4),
+    }
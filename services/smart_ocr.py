@@ -1,31 +1,138 @@
 ﻿# cross_drive_ocr.py - OCR hoạt động trên cả ổ C: và D:from services.smart_ocr import extract_text_from_image
 
 import os
+import re
 import sys
+import json
+import time
 import logging
+import threading
+import unicodedata
+
+from services.recognition_batcher import RecognitionBatcher, batching_enabled, readtext_batched
+from services.result_cache import get_result_cache
+from services.preprocessing import get_preprocessor
+from services.columnar import Detections
+from services.tiered_ocr import TieredOCR, cache_params
+from services.reader_registry import get_reader_registry
+from services.metrics import readtext_staged, record_error, stage
+from services import phash_index
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Lỗi mã hoá thường gặp: UTF-8 bị đọc nhầm thành cp1252/latin-1
+ENCODING_FIXES = {
+    'Ã¡': 'á', 'Ã ': 'à', 'Ã¢': 'â', 'Ã£': 'ã',
+    'Ã¨': 'è', 'Ã©': 'é', 'Ãª': 'ê', 'Ã¬': 'ì',
+    'Ã­': 'í', 'Ã²': 'ò', 'Ã³': 'ó', 'Ã´': 'ô',
+    'Ãµ': 'õ', 'Ã¹': 'ù', 'Ãº': 'ú', 'Ã½': 'ý',
+    'Äƒ': 'ă', 'Ä‘': 'đ', 'Ä©': 'ĩ', 'Å©': 'ũ',
+    'Æ¡': 'ơ', 'Æ°': 'ư'
+}
+# Mọi khoá có dạng <ký tự dẫn><ký tự thứ hai>, không khoá nào chồng lên khoá khác
+# nên một lượt thay thế cho kết quả giống hệt thay lần lượt từng khoá
+_MOJIBAKE_LEADS = frozenset(wrong[0] for wrong in ENCODING_FIXES)
+_MOJIBAKE_RE = re.compile('|'.join(re.escape(wrong) for wrong in sorted(ENCODING_FIXES, key=len, reverse=True)))
+
+
+def _fix_mojibake(match):
+    return ENCODING_FIXES[match.group(0)]
+
+
+def normalize_vietnamese(text):
+    """Sửa lỗi mã hoá, chuẩn hoá NFC và gộp khoảng trắng trong một lượt mỗi bước"""
+    if not text:
+        return text
+    
+    # ASCII: không có lỗi mã hoá, NFC không đổi gì -> chỉ gộp khoảng trắng
+    if not text.isascii():
+        if not _MOJIBAKE_LEADS.isdisjoint(text):
+            text = _MOJIBAKE_RE.sub(_fix_mojibake, text)
+        if not unicodedata.is_normalized('NFC', text):
+            text = unicodedata.normalize('NFC', text)
+    
+    # str.split() và \s dùng cùng định nghĩa khoảng trắng Unicode
+    return ' '.join(text.split())
+
+
+def normalize_vietnamese_stream(chunks):
+    """
+    Chuẩn hoá văn bản rất lớn theo từng chunk, kết quả nối lại giống hệt
+    normalize_vietnamese(''.join(chunks)).
+    
+    Mỗi chunk chỉ được cắt tại khoảng trắng không đứng sau ký tự dẫn của lỗi
+    mã hoá, nên không lỗi mã hoá / tổ hợp dấu nào bị tách đôi.
+    """
+    pending = ''
+    emitted = False
+    for chunk in chunks:
+        # Vị trí cắt chỉ có thể nằm trong phần mới thêm (phần cũ đã không có chỗ cắt)
+        searched = len(pending)
+        pending += chunk
+        cut = len(pending)
+        while cut > searched:
+            cut -= 1
+            if pending[cut].isspace() and (cut == 0 or pending[cut - 1] not in _MOJIBAKE_LEADS):
+                break
+        else:
+            continue
+        head, pending = pending[:cut], pending[cut:]
+        piece = normalize_vietnamese(head)
+        if piece:
+            yield (' ' + piece) if emitted else piece
+            emitted = True
+    piece = normalize_vietnamese(pending)
+    if piece:
+        yield (' ' + piece) if emitted else piece
+
+
+class VietnameseTextProcessor:
+    """Giữ API cũ: text_processor.normalize_vietnamese(text)"""
+    
+    encoding_fixes = ENCODING_FIXES
+    
+    def normalize_vietnamese(self, text):
+        return normalize_vietnamese(text)
+
+
+_text_processor = VietnameseTextProcessor()
+
 class CrossDriveOCR:
     def __init__(self):
-        # Thiết lập environment variables cho ổ D:
-        os.environ["HF_HOME"] = "D:\\.cache\\huggingface"
+        # Máy Windows của dự án để cache model trên ổ D:; không ghi đè HF_HOME đã cấu hình
+        if os.name == "nt":
+            os.environ.setdefault("HF_HOME", "D:\\.cache\\huggingface")
         
+        self.languages = ['vi', 'en']
         self.text_processor = None
-        self.reader = None
+        self.batcher = None
         self._initialize_components()
     
+    @property
+    def reader(self):
+        """
+        Reader của self.languages lấy từ registry mỗi lần dùng: không giữ tham chiếu
+        lâu dài nên registry bỏ được reader khi vượt OCR_READER_BUDGET_MB (tạo lại khi cần)
+        """
+        return get_reader_registry().get(self.languages)
+    
     def _initialize_components(self):
         """Khởi tạo tất cả components với cache trên ổ D:"""
         try:
             logger.info("🔄 Đang khởi tạo OCR engine (cache trên ổ D:)...")
             
-            # Khởi tạo EasyOCR
-            import easyocr
-            self.reader = easyocr.Reader(['vi', 'en'], gpu=False)
+            # Nạp sẵn reader trong registry dùng chung của tiến trình (OCR_TIERED=1: bọc OCR hai tầng)
+            reader = self.reader
             logger.info("✅ EasyOCR đã sẵn sàng")
             
+            # Gom batch nhận dạng giữa các lời gọi đồng thời (OCR_BATCH_WAIT_MS > 0);
+            # đường batch bỏ qua phân tầng nên không dùng cùng OCR_TIERED.
+            # Reader truyền theo từng lời gọi, batcher không giữ reader
+            if batching_enabled() and not isinstance(reader, TieredOCR):
+                self.batcher = RecognitionBatcher()
+                logger.info(f"✅ Batch nhận dạng: chờ tối đa {self.batcher.max_wait * 1000:.0f}ms, {self.batcher.max_batch} crop/batch")
+            
             # Khởi tạo Vietnamese processor
             self._init_vietnamese_processor()
             logger.info("✅ Vietnamese processor đã sẵn sàng")
@@ -37,37 +144,18 @@ class CrossDriveOCR:
             raise
     
     def _init_vietnamese_processor(self):
-        """Khởi tạo Vietnamese text processor"""
-        import re
-        import unicodedata
-        
-        class VietnameseTextProcessor:
-            def __init__(self):
-                self.encoding_fixes = {
-                    'Ã¡': 'á', 'Ã ': 'à', 'Ã¢': 'â', 'Ã£': 'ã',
-                    'Ã¨': 'è', 'Ã©': 'é', 'Ãª': 'ê', 'Ã¬': 'ì',
-                    'Ã­': 'í', 'Ã²': 'ò', 'Ã³': 'ó', 'Ã´': 'ô',
-                    'Ãµ': 'õ', 'Ã¹': 'ù', 'Ãº': 'ú', 'Ã½': 'ý',
-                    'Äƒ': 'ă', 'Ä‘': 'đ', 'Ä©': 'ĩ', 'Å©': 'ũ',
-                    'Æ¡': 'ơ', 'Æ°': 'ư'
-                }
-            
-            def normalize_vietnamese(self, text):
-                if not text:
-                    return text
-                
-                for wrong, correct in self.encoding_fixes.items():
-                    text = text.replace(wrong, correct)
-                
-                text = unicodedata.normalize('NFC', text)
-                text = re.sub(r'\s+', ' ', text).strip()
-                
-                return text
-        
-        self.text_processor = VietnameseTextProcessor()
+        """Khởi tạo Vietnamese text processor (dùng chung cấp module)"""
+        self.text_processor = _text_processor
     
-    def extract_text(self, image_path):
-        """Trích xuất text từ ảnh - hỗ trợ cả ổ C: và D:"""
+    def extract_text(self, image_path, profile=None, detections=None):
+        """Trích xuất text từ ảnh - hỗ trợ cả ổ C: và D:
+        
+        Args:
+            image_path: Đường dẫn ảnh
+            profile: Profile tiền xử lý (mặc định OCR_PREPROCESS_PROFILE)
+            detections: "list" / "base64" để kèm box + confidence từng vùng dạng cột
+                (xem services/columnar.py), None = chỉ text
+        """
         try:
             # Xử lý đường dẫn ảnh
             actual_path = self._resolve_image_path(image_path)
@@ -80,10 +168,42 @@ class CrossDriveOCR:
                     'character_count': 0
                 }
             
+            # Giải mã + tiền xử lý (xoay EXIF, grayscale, thu nhỏ, chỉnh nghiêng)
+            preprocessor = get_preprocessor(profile)
+            with open(actual_path, 'rb') as f:
+                image, preprocessing = preprocessor.load(f.read())
+            
+            # Cache theo nội dung ảnh đã tiền xử lý + cấu hình engine
+            cache = get_result_cache()
+            cache_key = self._cache_key(cache, image, preprocessor)
+            if cache_key is not None:
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"⚡ Cache hit: {os.path.basename(actual_path)}")
+                    return self._with_detections(dict(cached, cached=True, preprocessing=preprocessing), detections)
+            
+            # Ảnh gần trùng (chụp lại / nén lại cùng tài liệu): dùng lại kết quả đã OCR
+            near_dup = self._near_duplicate(image, preprocessor)
+            if near_dup is not None:
+                index, hashes, namespace = near_dup
+                match = index.lookup(hashes, namespace)
+                if match is not None:
+                    logger.info(f"⚡ Ảnh gần trùng ({match['similarity']:.1%}): {os.path.basename(actual_path)}, "
+                                f"tiết kiệm {match['saved_s'] * 1000:.0f}ms")
+                    return self._with_detections(dict(
+                        match['result'], cached=True, preprocessing=preprocessing,
+                        near_duplicate={'similarity': match['similarity'], 'distance': match['distance'],
+                                        'saved_ms': round(match['saved_s'] * 1000, 1)}), detections)
+            
             logger.info(f"📖 Đang xử lý ảnh: {os.path.basename(actual_path)}")
             
             # OCR processing
-            result = self.reader.readtext(actual_path)
+            started = time.perf_counter()
+            reader = self.reader
+            if self.batcher is not None:
+                result = readtext_batched(reader, self.batcher, image)
+            else:
+                result = readtext_staged(reader, image)
             
             # Extract text
             all_text = []
@@ -98,22 +218,33 @@ class CrossDriveOCR:
             combined_text = '\n'.join(all_text)
             
             # Xử lý tiếng Việt
-            cleaned_text = self.text_processor.normalize_vietnamese(combined_text)
+            with stage("normalization"):
+                cleaned_text = self.text_processor.normalize_vietnamese(combined_text)
             
             # Tính độ tin cậy
             avg_confidence = sum(confidence_scores) / len(confidence_scores) if confidence_scores else 0.0
             
             logger.info(f"✅ OCR thành công: {len(cleaned_text)} ký tự, độ tin cậy: {avg_confidence:.2%}")
             
-            return {
+            output = {
                 'success': True,
                 'text': cleaned_text,
-                'confidence': avg_confidence,
+                'confidence': float(avg_confidence),
                 'character_count': len(cleaned_text),
-                'raw_lines': len(all_text)
+                'raw_lines': len(all_text),
+                # Box/confidence từng vùng dạng cột; cache giữ lại để trả khi được yêu cầu
+                'detections': Detections.from_readtext(result).to_json()
             }
+            if cache_key is not None:
+                cache.put(cache_key, output)
+            if near_dup is not None:
+                index, hashes, namespace = near_dup
+                index.add(hashes, dict(output), time.perf_counter() - started, namespace)
+            output['preprocessing'] = preprocessing
+            return self._with_detections(output, detections)
             
         except Exception as e:
+            record_error(e)
             logger.error(f"❌ Lỗi OCR: {e}")
             return {
                 'success': False,
@@ -123,6 +254,47 @@ class CrossDriveOCR:
                 'character_count': 0
             }
     
+    @staticmethod
+    def _with_detections(output, detections):
+        """Bỏ hoặc đổi encoding của phần detections theo yêu cầu"""
+        columns = output.pop('detections', None)
+        if detections and columns is not None:
+            if detections != columns.get('encoding'):
+                columns = Detections.from_json(columns).to_json(detections)
+            output['detections'] = columns
+        return output
+    
+    def _cache_key(self, cache, image, preprocessor):
+        """Khoá cache cho ảnh đã tiền xử lý, None nếu cache tắt"""
+        if not cache.enabled:
+            return None
+        try:
+            params = {'engine': 'easyocr', 'normalize': 'vi', 'preprocess': preprocessor.params()}
+            # Cấu hình phân tầng lấy từ môi trường, không cần nạp reader khi cache hit
+            tier = cache_params()
+            if tier:
+                params['tier'] = tier
+            return cache.make_key(image, self.languages, params)
+        except Exception as e:
+            logger.warning(f"⚠️ Bỏ qua cache: {e}")
+            return None
+    
+    def _near_duplicate(self, image, preprocessor):
+        """(index, hashes, namespace) để tra ảnh gần trùng, None nếu OCR_PHASH tắt"""
+        if not phash_index.ENABLED:
+            return None
+        try:
+            params = {'languages': sorted(self.languages), 'preprocess': preprocessor.params()}
+            # Cấu hình phân tầng lấy từ môi trường, không cần nạp reader khi cache hit
+            tier = cache_params()
+            if tier:
+                params['tier'] = tier
+            namespace = json.dumps(params, sort_keys=True, default=str)
+            return phash_index.get_phash_index(), phash_index.image_hashes(image), namespace
+        except Exception as e:
+            logger.warning(f"⚠️ Bỏ qua tra ảnh gần trùng: {e}")
+            return None
+    
     def _resolve_image_path(self, image_path):
         """Giải quyết đường dẫn ảnh trên cả ổ C: và D:"""
         if os.path.exists(image_path):
@@ -142,28 +314,32 @@ class CrossDriveOCR:
 
 # Global instance
 _ocr_instance = None
+_ocr_lock = threading.Lock()
 
 def get_ocr_engine():
-    """Lấy OCR engine instance"""
+    """Lấy OCR engine instance (nhiều thread gọi cùng lúc vẫn chỉ tạo một engine)"""
     global _ocr_instance
     if _ocr_instance is None:
-        _ocr_instance = CrossDriveOCR()
+        with _ocr_lock:
+            if _ocr_instance is None:
+                _ocr_instance = CrossDriveOCR()
     return _ocr_instance
 
-def extract_text_from_image(image_path):
+def extract_text_from_image(image_path, profile=None, detections=None):
     """API chính cho hệ thống"""
     ocr = get_ocr_engine()
-    return ocr.extract_text(image_path)
+    return ocr.extract_text(image_path, profile=profile, detections=detections)
 
 # Demo
 if __name__ == '__main__':
     print("🧪 TEST OCR ĐA Ổ ĐĨA")
     print("=" * 50)
     
-    # Test với ảnh trên ổ C:
-    test_images = [
-        r'C:\Users\ADMIN\smart-ocr-system\Smart-OCR-System-Complete-v1.0\uploads\66e5febd.png'
-    ]
+    # python services/smart_ocr.py <ảnh> [<ảnh> ...]
+    # Ảnh mẫu: python benchmarks/synthetic_docs.py --out samples/ ; đo hiệu năng: benchmarks/bench_ocr.py
+    test_images = sys.argv[1:]
+    if not test_images:
+        print("Cách dùng: python services/smart_ocr.py <ảnh> [<ảnh> ...]")
     
     for image_path in test_images:
         print(f"\n📁 Đang xử lý: {image_path}")
@@ -0,0 +1,217 @@
+﻿# services/tiered_ocr.py - OCR hai tầng: tầng nhanh trước, chỉ dòng/trang confidence thấp mới chạy lại bằng model đầy đủ
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from services.metrics import readtext_staged, stage
+
+logger = logging.getLogger(__name__)
+
+# Tầng nhanh: "downscale" (cùng reader, ảnh thu nhỏ) hoặc danh sách ngôn ngữ cho reader nhẹ riêng, vd. "en"
+FAST_TIER = os.getenv("OCR_TIER_FAST", "downscale")
+FAST_SIDE = int(os.getenv("OCR_TIER_FAST_SIDE", 1280))
+# Dòng có confidence dưới ngưỡng được nhận dạng lại bằng model đầy đủ
+THRESHOLD = float(os.getenv("OCR_TIER_THRESHOLD", 0.6))
+# Tỷ lệ dòng yếu vượt mức này thì OCR lại cả trang thay vì từng dòng
+PAGE_RATIO = float(os.getenv("OCR_TIER_PAGE_RATIO", 0.5))
+# Lề thêm quanh mỗi dòng khi nhận dạng lại, tính theo chiều cao box
+LINE_PADDING = 0.2
+
+
+def tiering_enabled() -> bool:
+    return os.getenv("OCR_TIERED", "0") == "1"
+
+
+def cache_params() -> Optional[Dict[str, Any]]:
+    """Cấu hình phân tầng theo môi trường, cho khoá cache; None khi tắt"""
+    if not tiering_enabled():
+        return None
+    return {"fast": FAST_TIER if FAST_TIER != "downscale" else f"downscale:{FAST_SIDE}",
+            "threshold": THRESHOLD, "page_ratio": PAGE_RATIO}
+
+
+class TierStats:
+    """Đếm số trang kết thúc ở từng tầng và thời gian từng tầng (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pages = {"fast": 0, "lines": 0, "page": 0}
+            self.lines = 0
+            self.lines_escalated = 0
+            self.lines_improved = 0
+            self.seconds = {"fast": 0.0, "accurate": 0.0}
+
+    def record(self, outcome: str, lines: int, escalated: int, improved: int, fast_s: float, accurate_s: float):
+        with self._lock:
+            self.pages[outcome] += 1
+            self.lines += lines
+            self.lines_escalated += escalated
+            self.lines_improved += improved
+            self.seconds["fast"] += fast_s
+            self.seconds["accurate"] += accurate_s
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(self.pages.values())
+            escalated_pages = self.pages["lines"] + self.pages["page"]
+            return {
+                "pages": total,
+                "pages_by_outcome": dict(self.pages),
+                # Tỷ lệ trang xong hẳn ở tầng nhanh
+                "fast_hit_rate": round(self.pages["fast"] / total, 4) if total else 0.0,
+                "lines": self.lines,
+                "lines_escalated": self.lines_escalated,
+                "lines_improved": self.lines_improved,
+                "avg_fast_ms": round(self.seconds["fast"] / total * 1000, 2) if total else 0.0,
+                "avg_accurate_ms": round(self.seconds["accurate"] / escalated_pages * 1000, 2) if escalated_pages else 0.0,
+            }
+
+
+# Thống kê chung của tiến trình
+TIER_STATS = TierStats()
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    return np.asarray(Image.fromarray(image).convert("L"))
+
+
+def _bounds(box) -> Tuple[int, int, int, int]:
+    xs = [point[0] for point in box]
+    ys = [point[1] for point in box]
+    return int(min(xs)), int(min(ys)), int(max(xs)), int(max(ys))
+
+
+class TieredOCR:
+    """
+    Reader hai tầng, dùng thay reader.readtext:
+
+    1. Tầng nhanh: reader nhẹ hoặc cùng reader trên ảnh thu nhỏ (cạnh dài FAST_SIDE)
+    2. Các dòng confidence < threshold được nhận dạng lại (reader.recognize) bằng
+       model đầy đủ trên ảnh gốc; quá nhiều dòng yếu (> page_ratio) thì readtext lại cả trang
+
+    Thuộc tính khác (detect, recognize, ...) chuyển thẳng tới reader đầy đủ.
+
+    Args:
+        accurate_reader: Reader đầy đủ (vd. easyocr.Reader(['vi', 'en']))
+        fast_reader: Reader nhẹ; None = dùng accurate_reader trên ảnh thu nhỏ
+        threshold, page_ratio, fast_side: Mặc định theo biến môi trường OCR_TIER_*
+        stats: Nơi ghi thống kê (mặc định TIER_STATS)
+    """
+
+    def __init__(self, accurate_reader, fast_reader=None, threshold: Optional[float] = None,
+                 page_ratio: Optional[float] = None, fast_side: Optional[int] = None,
+                 stats: Optional[TierStats] = None):
+        self.accurate_reader = accurate_reader
+        self.fast_reader = fast_reader
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.page_ratio = PAGE_RATIO if page_ratio is None else page_ratio
+        self.fast_side = fast_side or FAST_SIDE
+        self.stats = stats or TIER_STATS
+
+    def __getattr__(self, name):
+        # Chỉ gọi khi thuộc tính không có trên TieredOCR; tránh đệ quy khi đối tượng chưa khởi tạo xong
+        if "accurate_reader" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.accurate_reader, name)
+
+    def params(self) -> Dict[str, Any]:
+        """Cấu hình ảnh hưởng kết quả (dùng cho khoá cache)"""
+        return {
+            "fast": "reader" if self.fast_reader is not None else f"downscale:{self.fast_side}",
+            "threshold": self.threshold,
+            "page_ratio": self.page_ratio,
+        }
+
+    def _fast_pass(self, image: np.ndarray) -> List[Any]:
+        if self.fast_reader is not None:
+            return readtext_staged(self.fast_reader, image)
+        height, width = image.shape[:2]
+        scale = min(1.0, self.fast_side / max(height, width))
+        if scale == 1.0:
+            return readtext_staged(self.accurate_reader, image)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        small = np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR, reducing_gap=2.0))
+        return [([[x / scale, y / scale] for x, y in box], text, confidence)
+                for box, text, confidence in readtext_staged(self.accurate_reader, small)]
+
+    def _recognize_lines(self, gray: np.ndarray, boxes: List[Any]) -> List[Optional[Tuple[str, float]]]:
+        """Nhận dạng lại các dòng trên ảnh gốc trong một lời gọi; trả (text, confidence) theo thứ tự boxes"""
+        height, width = gray.shape
+        regions = []
+        for box in boxes:
+            x0, y0, x1, y1 = _bounds(box)
+            pad = max(2, int((y1 - y0) * LINE_PADDING))
+            regions.append([max(0, x0 - pad), min(width, x1 + pad), max(0, y0 - pad), min(height, y1 + pad)])
+
+        with stage("recognition"):
+            recognized = self.accurate_reader.recognize(gray, horizontal_list=regions, free_list=[])
+        # easyocr sắp kết quả theo y: ghép lại với vùng yêu cầu theo góc trên-trái gần nhất
+        corners = np.array([[region[0], region[2]] for region in regions], dtype=np.float32)
+        matched: List[Optional[Tuple[str, float]]] = [None] * len(regions)
+        for box, text, confidence in recognized:
+            distance = np.abs(corners - np.asarray(box[0], dtype=np.float32)).sum(axis=1)
+            index = int(distance.argmin())
+            if matched[index] is None:
+                matched[index] = (text, float(confidence))
+        return matched
+
+    def readtext(self, image: np.ndarray, **kwargs) -> List[Any]:
+        if kwargs:
+            # Tham số riêng của easyocr: bỏ qua phân tầng
+            return readtext_staged(self.accurate_reader, image, **kwargs)
+
+        start = time.perf_counter()
+        results = self._fast_pass(image)
+        fast_s = time.perf_counter() - start
+
+        weak = [i for i, result in enumerate(results) if result[2] < self.threshold]
+        if not weak:
+            self.stats.record("fast", len(results), 0, 0, fast_s, 0.0)
+            return results
+
+        start = time.perf_counter()
+        if len(weak) > self.page_ratio * len(results):
+            results = readtext_staged(self.accurate_reader, image)
+            self.stats.record("page", len(results), len(results), 0, fast_s, time.perf_counter() - start)
+            return results
+
+        results = list(results)
+        improved = 0
+        recognized = self._recognize_lines(_to_gray(image), [results[i][0] for i in weak])
+        for i, line in zip(weak, recognized):
+            # Chỉ thay khi model đầy đủ tự tin hơn tầng nhanh
+            if line is not None and line[1] > results[i][2]:
+                results[i] = (results[i][0], line[0], line[1])
+                improved += 1
+        self.stats.record("lines", len(results), len(weak), improved, fast_s, time.perf_counter() - start)
+        return results
+
+
+def create_tiered_reader(accurate_factory: Callable[[], Any],
+                         fast_factory: Optional[Callable[[List[str]], Any]] = None) -> Any:
+    """
+    Reader theo cấu hình: TieredOCR khi OCR_TIERED=1, ngược lại reader đầy đủ.
+
+    Args:
+        accurate_factory: Hàm tạo reader đầy đủ
+        fast_factory: Hàm tạo reader nhẹ từ danh sách ngôn ngữ (khi OCR_TIER_FAST không phải "downscale")
+    """
+    accurate = accurate_factory()
+    if not tiering_enabled():
+        return accurate
+    fast = None
+    if FAST_TIER != "downscale" and fast_factory is not None:
+        fast = fast_factory([lang.strip() for lang in FAST_TIER.split(",") if lang.strip()])
+    logger.info(f"✅ OCR hai tầng: tầng nhanh {'reader ' + FAST_TIER if fast is not None else f'ảnh thu nhỏ {FAST_SIDE}px'}, ngưỡng {THRESHOLD}")
+    return TieredOCR(accurate, fast_reader=fast)
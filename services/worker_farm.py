@@ -0,0 +1,393 @@
+﻿# services/worker_farm.py - Farm tiến trình OCR fork sau khi đã nạp model
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, wait
+from multiprocessing.reduction import recv_handle, send_handle
+from typing import Any, Callable, Dict, Optional
+
+from services.cpu_tuning import TORCH_THREADS, configure_torch_threads, default_threads
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCrashed(Exception):
+    """Tiến trình worker chết khi đang xử lý việc"""
+
+
+class WorkerError(Exception):
+    """Lỗi xảy ra bên trong tiến trình worker"""
+
+
+class WorkerTimeout(Exception):
+    """Việc chạy quá hạn, tiến trình worker đã bị dừng"""
+
+
+def _limit_torch_threads(threads: int):
+    try:
+        configure_torch_threads(threads)
+    except Exception:
+        pass
+
+
+def _worker_main(conn, reader, threads: int):
+    """Vòng lặp của tiến trình con: nhận việc qua pipe, trả kết quả qua pipe"""
+    _limit_torch_threads(threads)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        job_id, fn, args, kwargs = message
+        try:
+            reply = (job_id, True, fn(reader, *args, **kwargs))
+        except Exception as e:
+            reply = (job_id, False, f"{type(e).__name__}: {e}")
+
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # Kết quả không pickle được thì vẫn phải báo lỗi về
+            conn.send((job_id, False, f"Không gửi được kết quả: {e}"))
+
+
+def _zygote_main(control, reader, threads: int):
+    """
+    Tiến trình zygote: chỉ có một thread, fork worker mới mỗi khi tiến trình cha yêu cầu
+    rồi gửi đầu pipe của worker (fd) và pid về cho cha.
+    """
+    # Worker (cháu của tiến trình cha) thoát thì được dọn ngay, không thành zombie;
+    # tiến trình cha phát hiện worker chết qua pipe bị đóng
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            message = control.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                control.close()
+                parent_conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _worker_main(child_conn, reader, threads)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+        send_handle(control, parent_conn.fileno(), pid)
+        control.send(pid)
+        parent_conn.close()
+
+
+def _wait_closed(conn, timeout: float) -> bool:
+    """Chờ đầu pipe phía worker đóng (worker đã thoát), bỏ qua dữ liệu còn sót; True nếu đã đóng"""
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not conn.poll(remaining):
+                return False
+            conn.recv()
+    except (EOFError, OSError):
+        return True
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.pid = None
+        self.conn = None
+        self.job_id = None
+        self.deadline = None
+
+    def stop(self, timeout: float = 1.0):
+        """SIGTERM, chờ worker thoát, quá hạn thì SIGKILL"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                return
+            if _wait_closed(self.conn, timeout):
+                return
+
+
+class OCRWorkerFarm:
+    """
+    Nạp model một lần trong tiến trình cha rồi fork N worker (chia sẻ bộ nhớ
+    copy-on-write). Việc được phân cho worker rảnh qua pipe cục bộ, worker chết
+    sẽ được khởi động lại tự động. Việc có timeout mà chạy quá hạn thì worker bị
+    terminate rồi fork lại, nên việc treo không giữ worker mãi.
+
+    Worker không fork trực tiếp từ tiến trình cha: cha có nhiều thread (uvicorn, thread
+    executor, pool thread của torch) và tiến trình fork lúc một thread khác đang giữ khoá
+    (logging, torch, pdfium) sẽ kẹt khi dùng khoá đó. Ngay sau khi nạp model, cha fork một
+    zygote một thread; mọi worker (kể cả worker fork lại) đều fork từ zygote. Lần fork
+    zygote vẫn từ tiến trình cha, nên start() nên chạy sớm (vd. lúc warm-up) trước khi
+    có nhiều việc chạy song song; zygote chết thì được tạo lại từ cha (có log).
+
+    Args:
+        reader_factory: Hàm tạo reader, chỉ gọi một lần trong tiến trình cha
+        processes: Số tiến trình worker (mặc định OCR_WORKERS)
+        threads_per_worker: Số thread torch mỗi worker (mặc định OCR_TORCH_THREADS, 0 = chia đều số core)
+    """
+
+    def __init__(self, reader_factory: Callable[[], Any], processes: Optional[int] = None,
+                 threads_per_worker: Optional[int] = None):
+        self.reader_factory = reader_factory
+        self.processes = max(1, processes or int(os.getenv("OCR_WORKERS", 1)))
+        self.threads_per_worker = threads_per_worker or TORCH_THREADS or default_threads(self.processes)
+
+        self._ctx = multiprocessing.get_context("fork")
+        self._reader = None
+        self._zygote = None
+        self._control = None
+        self._workers = []
+        self._pending = deque()
+        self._futures: Dict[int, Future] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = self._ctx.Pipe(duplex=False)
+        self._thread = None
+        self._started = False
+        self._closed = False
+        self.restarts = 0
+
+    def start(self):
+        """Nạp model rồi fork các worker (chỉ chạy một lần)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        logger.info("🔄 Nạp model cho worker farm...")
+        try:
+            self._reader = self.reader_factory()
+        except Exception:
+            with self._lock:
+                self._started = False
+            raise
+        self._start_zygote()
+        self._workers = [_Worker(i) for i in range(self.processes)]
+        for worker in self._workers:
+            self._spawn(worker)
+
+        self._thread = threading.Thread(target=self._dispatch_loop, name="ocr-farm", daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Worker farm đã sẵn sàng: {self.processes} tiến trình")
+
+    def _start_zygote(self):
+        if self._zygote is not None:
+            self._control.close()
+            if self._zygote.is_alive():
+                self._zygote.kill()
+            self._zygote.join(timeout=1)
+        control, child_control = self._ctx.Pipe()
+        self._zygote = self._ctx.Process(
+            target=_zygote_main,
+            args=(child_control, self._reader, self.threads_per_worker),
+            name="ocr-farm-zygote",
+            daemon=True,
+        )
+        self._zygote.start()
+        child_control.close()
+        self._control = control
+
+    def _spawn(self, worker: _Worker):
+        """Nhờ zygote fork worker mới; zygote không trả lời thì tạo lại zygote rồi thử lại một lần"""
+        for attempt in range(2):
+            try:
+                self._control.send(worker.index)
+                if not self._control.poll(10):
+                    raise OSError("zygote không phản hồi")
+                fd = recv_handle(self._control)
+                pid = self._control.recv()
+                break
+            except (EOFError, OSError) as e:
+                if attempt:
+                    raise
+                logger.error(f"❌ Zygote của worker farm lỗi ({e}), khởi động lại...")
+                self._start_zygote()
+        worker.pid = pid
+        worker.conn = Connection(fd)
+        worker.job_id = None
+        worker.deadline = None
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Gửi việc cho farm; fn phải pickle được và nhận reader làm tham số đầu"""
+        return self.submit_job(fn, args, kwargs)
+
+    def submit_job(self, fn: Callable, args: tuple = (), kwargs: Optional[dict] = None,
+                   timeout: Optional[float] = None) -> Future:
+        """
+        Như submit, kèm timeout (giây, tính từ lúc gửi): quá hạn thì việc bị bỏ
+        (nếu còn chờ) hoặc worker đang chạy nó bị terminate và fork lại.
+        """
+        if not self._started:
+            self.start()
+
+        future = Future()
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker farm đã dừng")
+            job_id = self._next_id
+            self._next_id += 1
+            self._futures[job_id] = future
+            self._pending.append((job_id, fn, args, kwargs or {}, deadline))
+        self._wakeup_w.send(None)
+        return future
+
+    def _assign(self):
+        """Giao việc đang chờ cho các worker rảnh"""
+        for worker in self._workers:
+            if worker.job_id is not None:
+                continue
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    job = self._pending.popleft()
+                    future = self._futures[job[0]]
+                deadline = job[4]
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._finish(job[0], False, WorkerTimeout("Việc OCR hết hạn khi còn chờ worker"))
+                    continue
+                # Việc đã bị huỷ (vd. timeout) trong lúc chờ thì bỏ qua
+                if future.set_running_or_notify_cancel():
+                    break
+                with self._lock:
+                    self._futures.pop(job[0], None)
+            try:
+                worker.conn.send(job[:4])
+                worker.job_id = job[0]
+                worker.deadline = deadline
+            except Exception as e:
+                self._finish(job[0], False, f"Không gửi được việc cho worker: {e}")
+
+    def _finish(self, job_id: int, ok: bool, payload: Any):
+        with self._lock:
+            future = self._futures.pop(job_id, None)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(payload)
+        elif isinstance(payload, BaseException):
+            future.set_exception(payload)
+        else:
+            future.set_exception(WorkerError(payload))
+
+    def _handle_crash(self, worker: _Worker):
+        logger.error(f"❌ Worker {worker.index} (pid {worker.pid}) đã dừng, khởi động lại...")
+        if worker.job_id is not None:
+            self._finish(worker.job_id, False, WorkerCrashed("Worker OCR bị dừng"))
+        worker.conn.close()
+        self.restarts += 1
+        if not self._closed:
+            self._spawn(worker)
+
+    def _kill_expired(self):
+        """Terminate worker đang chạy việc quá hạn rồi fork lại"""
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.job_id is None or worker.deadline is None or now < worker.deadline:
+                continue
+            logger.warning(f"⚠️ Worker {worker.index} chạy quá hạn, dừng và khởi động lại...")
+            worker.stop()
+            self._finish(worker.job_id, False, WorkerTimeout("Việc OCR chạy quá hạn, worker đã bị dừng"))
+            worker.conn.close()
+            self.restarts += 1
+            if not self._closed:
+                self._spawn(worker)
+
+    def _wait_timeout(self) -> float:
+        """Thời gian chờ tối đa: 1s, hoặc đến hạn gần nhất của việc đang chạy"""
+        deadlines = [worker.deadline for worker in self._workers
+                     if worker.job_id is not None and worker.deadline is not None]
+        if not deadlines:
+            return 1.0
+        return min(1.0, max(0.0, min(deadlines) - time.monotonic()))
+
+    def _dispatch_loop(self):
+        while not self._closed:
+            self._assign()
+
+            # Worker không phải tiến trình con của cha (con của zygote): worker chết = pipe bị đóng
+            conns = {worker.conn: worker for worker in self._workers}
+            ready = wait([self._wakeup_r] + list(conns), timeout=self._wait_timeout())
+
+            for obj in ready:
+                if obj is self._wakeup_r:
+                    while self._wakeup_r.poll():
+                        self._wakeup_r.recv()
+                elif obj in conns:
+                    worker = conns[obj]
+                    try:
+                        job_id, ok, payload = obj.recv()
+                    except (EOFError, OSError):
+                        self._handle_crash(worker)
+                        continue
+                    worker.job_id = None
+                    worker.deadline = None
+                    self._finish(job_id, ok, payload)
+
+            self._kill_expired()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = len(self._pending)
+        return {
+            "processes": self.processes,
+            "busy": sum(1 for worker in self._workers if worker.job_id is not None),
+            "queued": queued,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self, wait_workers: bool = True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            pending = list(self._futures.values())
+            self._futures.clear()
+            self._pending.clear()
+        self._wakeup_w.send(None)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except Exception:
+                pass
+        for worker in self._workers:
+            if not (wait_workers and _wait_closed(worker.conn, 5)):
+                worker.stop()
+            worker.conn.close()
+        if self._zygote is not None:
+            try:
+                self._control.send(None)
+            except Exception:
+                pass
+            self._zygote.join(timeout=5)
+            if self._zygote.is_alive():
+                self._zygote.terminate()
+            self._control.close()
+
+        for future in pending:
+            if not future.done() and not future.cancel():
+                future.set_exception(WorkerError("Worker farm đã dừng"))
@@ -0,0 +1,5 @@
+﻿# tests/conftest.py - Cho phép import services.* khi chạy pytest từ bất kỳ thư mục nào
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
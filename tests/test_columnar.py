@@ -0,0 +1,58 @@
+﻿# tests/test_columnar.py - Round trip Detections: readtext -> JSON (list / base64) / nhị phân -> Detections
+import json
+
+import numpy as np
+import pytest
+
+from services.columnar import Detections, dumps
+
+READTEXT = [
+    ([[10.4, 20.6], [110, 20], [110, 40], [10, 40]], "CỘNG HÒA", np.float64(0.98765)),
+    ([[12, 50], [200.5, 50], [200, 70], [12, 70]], "Số: 12/2024", 0.5),
+    ([[0, 80], [5, 80], [5, 90], [0, 90]], "", 0.125),
+]
+
+
+def _assert_same(a: Detections, b: Detections, confidence_tolerance: float = 0.0):
+    assert len(a) == len(b)
+    assert a.lines() == b.lines()
+    np.testing.assert_array_equal(a.boxes, b.boxes)
+    np.testing.assert_array_equal(a.offsets, b.offsets)
+    np.testing.assert_allclose(a.confidence, b.confidence, atol=confidence_tolerance)
+    assert b.boxes.dtype == np.int16 and b.confidence.dtype == np.float32 and b.offsets.dtype == np.int32
+
+
+def test_from_readtext_columns():
+    detections = Detections.from_readtext(READTEXT)
+
+    assert detections.boxes.shape == (3, 4, 2)
+    assert detections.boxes[0, 0].tolist() == [10, 21]
+    assert detections.lines() == ["CỘNG HÒA", "Số: 12/2024", ""]
+    assert detections.line(1) == "Số: 12/2024"
+    assert detections.bounds()[1].tolist() == [12, 50, 200, 70]
+
+
+@pytest.mark.parametrize("encoding", ["list", "base64"])
+def test_json_round_trip(encoding):
+    detections = Detections.from_readtext(READTEXT)
+    data = json.loads(dumps(detections, encoding))
+
+    assert data["encoding"] == encoding and data["count"] == 3
+    _assert_same(detections, Detections.from_json(data), 1e-4 if encoding == "list" else 0.0)
+
+
+def test_bytes_round_trip():
+    detections = Detections.from_readtext(READTEXT)
+    _assert_same(detections, Detections.from_bytes(detections.to_bytes()))
+
+
+def test_empty_round_trip():
+    detections = Detections.from_readtext([])
+    for encoding in ("list", "base64"):
+        _assert_same(detections, Detections.from_json(detections.to_json(encoding)))
+    _assert_same(detections, Detections.from_bytes(detections.to_bytes()))
+
+
+def test_from_bytes_rejects_other_data():
+    with pytest.raises(ValueError):
+        Detections.from_bytes(b"XXXX" + bytes(16))
@@ -0,0 +1,89 @@
+﻿# tests/test_documents.py - PageSource: giới hạn trang/pixel, tài liệu hỏng -> 415; /ocr/document và /jobs từ chối trước khi OCR
+import io
+
+import pytest
+from PIL import Image
+
+from services import documents
+from services.documents import PageSource
+from services.image_io import UploadError
+
+pdfium = pytest.importorskip("pypdfium2")
+
+
+def _pdf(pages: int = 2) -> bytes:
+    pdf = pdfium.PdfDocument.new()
+    for _ in range(pages):
+        pdf.new_page(200, 300)
+    buffer = io.BytesIO()
+    pdf.save(buffer)
+    return buffer.getvalue()
+
+
+def _tiff(pages: int = 3) -> bytes:
+    frames = [Image.new("L", (120, 80), 255 - index) for index in range(pages)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="TIFF", save_all=True, append_images=frames[1:])
+    return buffer.getvalue()
+
+
+def _open_status(data: bytes) -> int:
+    with pytest.raises(UploadError) as error:
+        PageSource(memoryview(data))
+    return error.value.status_code
+
+
+def test_pdf_and_tiff_pages():
+    source = PageSource(memoryview(_pdf(2)), dpi=72)
+    assert (source.kind, source.page_count, source.total_pixels) == ("pdf", 2, 2 * 200 * 300)
+    assert source.render(1).shape == (300, 200, 3)
+    source.close()
+
+    source = PageSource(memoryview(_tiff(3)))
+    assert (source.kind, source.page_count) == ("tiff", 3)
+    assert source.render(2)[0, 0] == 253
+    source.close()
+
+
+@pytest.mark.parametrize("data", [
+    b"%PDF-1.4 hong",
+    _pdf()[:60],
+    _pdf()[:len(_pdf()) // 2],
+    _tiff()[:20],
+    b"khong phai tai lieu",
+])
+def test_corrupt_document_is_415(data):
+    assert _open_status(data) == 415
+
+
+def test_page_and_pixel_limits_are_413(monkeypatch):
+    monkeypatch.setattr(documents, "MAX_PAGES", 2)
+    assert _open_status(_tiff(3)) == 413
+
+    monkeypatch.setattr(documents, "MAX_PAGES", 200)
+    monkeypatch.setattr(documents, "MAX_DOCUMENT_PIXELS", 120 * 80 * 2)
+    assert _open_status(_tiff(3)) == 413
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from services.app import create_app
+
+    monkeypatch.setenv("OCR_JOBS_DB", str(tmp_path / "jobs.db"))
+    # Không chạy startup: không nạp model, không chạy job nền
+    return TestClient(create_app("railway"))
+
+
+@pytest.mark.parametrize("path", ["/ocr/document", "/jobs"])
+@pytest.mark.parametrize("data", [b"%PDF-1.4 hong", _pdf()[:60], _tiff()[:20]])
+def test_routes_reject_corrupt_document(client, path, data):
+    response = client.post(path, files={"file": ("doc.pdf", data, "application/pdf")})
+    assert response.status_code == 415
+    assert response.json()["success"] is False
+
+
+def test_jobs_accepts_valid_document(client):
+    response = client.post("/jobs", files={"file": ("doc.pdf", _pdf(), "application/pdf")})
+    assert response.status_code == 202 and response.json()["status"] == "queued"
@@ -0,0 +1,65 @@
+﻿# tests/test_image_io.py - Lỗi giải mã / multipart đổi thành UploadError với status đúng
+import io
+import asyncio
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from services.image_io import UploadError, open_image, read_uploads
+
+
+def _png(size=(64, 64)) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class _Request:
+    def __init__(self, body: bytes, boundary: str = "xyz"):
+        self.headers = {"content-type": f"multipart/form-data; boundary={boundary}"}
+        self._body = body
+
+    async def stream(self):
+        yield self._body
+
+
+def _status(fn, *args, **kwargs) -> int:
+    with pytest.raises(UploadError) as error:
+        fn(*args, **kwargs)
+    return error.value.status_code
+
+
+def test_open_image_decodes():
+    assert open_image(_png()).size == (64, 64)
+
+
+@pytest.mark.parametrize("data", [b"khong phai anh", _png()[:200], _png()[:-40]])
+def test_unknown_or_truncated_image_is_415(data):
+    assert _status(open_image, data) == 415
+
+
+def test_decompression_bomb_is_413(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    assert _status(open_image, _png()) == 413
+
+
+def test_pixel_limit_is_413():
+    assert _status(open_image, _png(), max_pixels=1000) == 413
+
+
+@pytest.mark.parametrize("body", [
+    b"garbage",
+    b"--xyz\r\nbad header line\r\n\r\ndata\r\n--xyz--\r\n",
+    b"--xyzQ\r\n",
+])
+def test_malformed_multipart_is_400(body):
+    assert _status(asyncio.run, read_uploads(_Request(body))) == 400
+
+
+def test_multipart_round_trip():
+    body = (b"--xyz\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.png\"\r\n"
+            b"Content-Type: image/png\r\n\r\n" + _png() + b"\r\n--xyz--\r\n")
+    upload, = asyncio.run(read_uploads(_Request(body)))
+    assert upload.filename == "a.png"
+    assert upload.decode().shape == (64, 64, 3)
@@ -0,0 +1,213 @@
+﻿# tests/test_job_queue.py - JobStore: claim theo giới hạn client, lease/recover, owner, migrate schema cũ; kiểm tra webhook
+import json
+import time
+import socket
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from services import job_queue
+from services.job_queue import JobLimitError, JobStore, WebhookError, _post_webhook, validate_webhook_url
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "jobs.db")
+
+
+def _store(path, **kwargs):
+    return JobStore(path, max_queued_per_client=kwargs.pop("max_queued", 10), **kwargs)
+
+
+def test_enqueue_limit_per_client(db_path):
+    store = _store(db_path, max_queued=2)
+    store.enqueue("a", b"1")
+    store.enqueue("a", b"2")
+    with pytest.raises(JobLimitError):
+        store.enqueue("a", b"3")
+    store.enqueue("b", b"1")
+
+
+def test_claim_oldest_respecting_running_limit(db_path):
+    store = _store(db_path)
+    first = store.enqueue("a", b"1", filename="a1.png")
+    second = store.enqueue("a", b"2")
+    other = store.enqueue("b", b"3")
+
+    job = store.claim(per_client_limit=1)
+    assert job["id"] == first and job["payload"] == b"1" and job["attempts"] == 0
+    # Client "a" đã có 1 job chạy -> bỏ qua second, nhận job của "b"
+    assert store.claim(per_client_limit=1)["id"] == other
+    assert store.claim(per_client_limit=1) is None
+    assert store.claim(per_client_limit=2)["id"] == second
+    assert store.get(first)["status"] == "running"
+
+
+def test_complete_and_fail_require_ownership(db_path):
+    store, other = _store(db_path), _store(db_path)
+    job_id = store.enqueue("a", b"1")
+    failed_id = store.enqueue("a", b"2")
+    store.claim(per_client_limit=5)
+    store.claim(per_client_limit=5)
+
+    assert not other.complete(job_id, {"text": "x"})
+    assert store.complete(job_id, {"text": "Xin chào"})
+    assert not store.complete(job_id, {"text": "lần hai"})
+    assert store.fail(failed_id, "lỗi")
+
+    done = store.get(job_id)
+    assert done["status"] == "done" and done["result"] == {"text": "Xin chào"}
+    assert store.get(failed_id)["status"] == "failed"
+    assert store.stats() == {"done": 1, "failed": 1}
+
+
+def test_recover_only_takes_expired_leases(db_path):
+    owner = _store(db_path, lease_seconds=0.2)
+    other = _store(db_path, lease_seconds=0.2)
+    job_id = owner.enqueue("a", b"1")
+    owner.claim(per_client_limit=1)
+
+    # Lease còn hạn: replica khác không được lấy job đang chạy
+    assert other.recover() == 0
+    assert owner.renew([job_id]) == 1
+    assert other.renew([job_id]) == 0
+
+    time.sleep(0.3)
+    assert other.recover() == 1
+    assert other.claim(per_client_limit=1)["id"] == job_id
+    # Tiến trình cũ (lease hết hạn) không được ghi đè kết quả
+    assert not owner.complete(job_id, {"text": "cũ"})
+    assert other.complete(job_id, {"text": "mới"})
+    assert owner.get(job_id)["result"] == {"text": "mới"}
+
+
+def test_recover_fails_job_after_max_attempts(db_path):
+    store = _store(db_path, max_attempts=1, lease_seconds=0.05)
+    job_id = store.enqueue("a", b"1")
+    store.claim(per_client_limit=1)
+    time.sleep(0.1)
+
+    assert store.recover() == 0
+    job = store.get(job_id)
+    assert job["status"] == "failed" and job["attempts"] == 1
+
+
+def test_release_requeues_own_jobs(db_path):
+    store, other = _store(db_path), _store(db_path)
+    mine = store.enqueue("a", b"1")
+    theirs = store.enqueue("b", b"2")
+    store.claim(per_client_limit=1)
+    other.claim(per_client_limit=1)
+
+    assert store.release() == 1
+    assert store.get(mine)["status"] == "queued"
+    assert store.get(theirs)["status"] == "running"
+
+
+def test_migrates_database_without_lease_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, client_id TEXT NOT NULL, status TEXT NOT NULL, filename TEXT, "
+        "payload BLOB, webhook_url TEXT, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+        "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+    )
+    conn.execute("INSERT INTO jobs (id, client_id, status, payload, attempts, created_at) "
+                 "VALUES ('old', 'a', 'running', x'00', 1, 0)")
+    conn.commit()
+    conn.close()
+
+    store = _store(db_path)
+    # Job đang chạy từ phiên bản cũ không có lease -> coi như hết hạn
+    assert store.recover() == 1
+    assert store.claim(per_client_limit=1)["id"] == "old"
+    assert store.complete("old", {})
+
+
+@pytest.mark.parametrize("url", [
+    "ftp://93.184.216.34/hook",
+    "http:///hook",
+    "http://127.0.0.1:8000/hook",
+    "http://10.1.2.3/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]/hook",
+    "http://[::ffff:192.168.0.1]/hook",
+])
+def test_webhook_rejects_non_public_targets(url):
+    with pytest.raises(WebhookError):
+        validate_webhook_url(url)
+
+
+def test_webhook_accepts_public_address():
+    assert validate_webhook_url("https://93.184.216.34/hook") == "https://93.184.216.34/hook"
+
+
+def test_webhook_allowed_hosts(monkeypatch):
+    monkeypatch.setattr(job_queue, "WEBHOOK_ALLOWED_HOSTS", ("*.example.com",))
+    monkeypatch.setattr(job_queue, "WEBHOOK_ALLOW_PRIVATE", True)
+
+    assert validate_webhook_url("https://hooks.example.com/x")
+    assert validate_webhook_url("https://example.com/x")
+    with pytest.raises(WebhookError):
+        validate_webhook_url("https://example.com.evil.net/x")
+
+
+@pytest.fixture
+def webhook_server():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append({"path": self.path, "host": self.headers["Host"], "body": json.loads(body)})
+            if self.path.startswith("/redirect"):
+                self.send_response(302)
+                self.send_header("Location", "http://169.254.169.254/")
+            else:
+                self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1], received
+    server.shutdown()
+    server.server_close()
+
+
+def test_post_webhook_sends_to_resolved_address(monkeypatch, webhook_server):
+    port, received = webhook_server
+    monkeypatch.setattr(job_queue, "WEBHOOK_ALLOW_PRIVATE", True)
+
+    assert _post_webhook(f"http://localhost:{port}/hook?job=1", {"id": "1", "status": "done"}) == 204
+    assert received == [{"path": "/hook?job=1", "host": f"localhost:{port}", "body": {"id": "1", "status": "done"}}]
+
+    with pytest.raises(WebhookError):
+        _post_webhook(f"http://localhost:{port}/redirect", {"id": "2"})
+
+
+def test_post_webhook_connects_to_checked_address_only(monkeypatch):
+    # DNS rebinding: lần phân giải sau trả địa chỉ nội bộ; kết nối phải dùng địa chỉ đã kiểm tra
+    answers = iter(["93.184.216.34", "127.0.0.1", "127.0.0.1"])
+    lookups, connects = [], []
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (next(answers), port))]
+
+    def create_connection(address, *args, **kwargs):
+        connects.append(address)
+        raise ConnectionRefusedError("không có mạng trong test")
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(socket, "create_connection", create_connection)
+
+    with pytest.raises(OSError):
+        _post_webhook("http://hooks.example.com/x", {"id": "1"})
+    assert lookups == ["hooks.example.com"]
+    assert connects == [("93.184.216.34", 80)]
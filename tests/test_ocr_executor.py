@@ -0,0 +1,83 @@
+﻿# tests/test_ocr_executor.py - Việc nhận trước khi model sẵn sàng: chờ warm-up, nạp lỗi -> 503, không tự nạp model
+import time
+import asyncio
+import threading
+
+import pytest
+
+from services.ocr_executor import ExecutorError, ExecutorTimeout, OCRExecutor
+
+
+class _Factory:
+    def __init__(self, delay: float = 0.0, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.threads = []
+
+    def __call__(self):
+        self.threads.append(threading.current_thread().name)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return "reader"
+
+
+def _echo(reader, value):
+    return reader, value
+
+
+@pytest.fixture
+def make_executor():
+    executors = []
+
+    def make(factory, **kwargs):
+        executor = OCRExecutor(factory, workers=kwargs.pop("workers", 2), queue_size=8, backend="thread", **kwargs)
+        executor.queue_until_ready = True
+        executors.append(executor)
+        return executor
+
+    yield make
+    for executor in executors:
+        executor.shutdown(wait=False)
+
+
+def test_queued_work_runs_after_warm_up(make_executor):
+    factory = _Factory(delay=0.2)
+    executor = make_executor(factory)
+
+    async def main():
+        return await asyncio.gather(*(executor.run(_echo, i) for i in range(4)))
+
+    assert asyncio.run(main()) == [("reader", i) for i in range(4)]
+    assert executor.ready
+    # Mỗi worker nạp một lần trong warm-up, không request nào tự nạp
+    assert len(factory.threads) == 2
+    assert executor.stats()["queued"] == 0
+
+
+def test_load_failure_fails_queued_work_with_503(make_executor):
+    factory = _Factory(delay=0.1, error=ModuleNotFoundError("No module named 'easyocr'"))
+    executor = make_executor(factory, workers=1)
+
+    futures = [executor.submit(_echo, i) for i in range(3)]
+    for future in futures:
+        with pytest.raises(ExecutorError) as error:
+            future.result(timeout=5)
+        assert error.value.status_code == 503 and error.value.retry_after >= 1
+    assert len(factory.threads) == 1
+
+    # Trong thời gian backoff: trả 503 ngay, không nạp lại
+    with pytest.raises(ExecutorError) as error:
+        executor.submit(_echo, 0)
+    assert error.value.status_code == 503
+    assert len(factory.threads) == 1
+    assert executor.stats()["queued"] == 0
+
+
+def test_timeout_while_waiting_for_model(make_executor):
+    executor = make_executor(_Factory(delay=1.0), workers=1)
+
+    with pytest.raises(ExecutorTimeout):
+        asyncio.run(executor.run(_echo, 1, timeout=0.1))
+    # Việc đã bị huỷ trả slot ngay, không chạy khi model nạp xong
+    assert executor._pending == 0
@@ -0,0 +1,90 @@
+﻿# tests/test_phash_index.py - BK-tree khớp tìm vét cạn; PHashIndex tra ảnh gần trùng theo namespace, bỏ mục LRU
+import random
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from services.phash_index import BKTree, PHashIndex, hamming, image_hashes
+
+
+def _document(seed: int, size=(600, 800)) -> Image.Image:
+    rng = random.Random(seed)
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    y = 40
+    while y < size[1] - 40:
+        x = 40
+        while x < size[0] - 60:
+            width = rng.randint(15, 70)
+            draw.rectangle([x, y, x + width, y + 12], fill=rng.randint(0, 80))
+            x += width + rng.randint(8, 20)
+        y += rng.randint(24, 40)
+    return image
+
+
+def test_hamming():
+    assert hamming(0, 0) == 0
+    assert hamming(0b1011, 0b0001) == 2
+    assert hamming((1 << 64) - 1, 0) == 64
+
+
+@pytest.mark.parametrize("radius", [0, 3, 8, 20])
+def test_bktree_search_matches_brute_force(radius):
+    rng = random.Random(radius)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    # Thêm hash gần nhau và trùng nhau để có kết quả trong bán kính nhỏ
+    values += [values[0] ^ (1 << bit) for bit in range(0, 64, 7)] + [values[1]]
+    tree = BKTree()
+    for item_id, value in enumerate(values):
+        tree.add(value, item_id)
+    assert tree.size == len(values)
+
+    for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        expected = sorted((hamming(query, value), item_id) for item_id, value in enumerate(values)
+                          if hamming(query, value) <= radius)
+        assert sorted(tree.search(query, radius)) == expected
+
+
+def test_empty_tree():
+    assert BKTree().search(123, 64) == []
+
+
+def test_index_finds_rescaled_copy_within_namespace():
+    original = _document(1)
+    index = PHashIndex(similarity=0.9, max_entries=10)
+    index.add(image_hashes(original), {"text": "doc 1"}, seconds=2.0, namespace="vi")
+    index.add(image_hashes(_document(2)), {"text": "doc 2"}, seconds=1.0, namespace="vi")
+
+    copy = original.resize((450, 600), Image.BILINEAR)
+    hit = index.lookup(image_hashes(np.asarray(copy)), namespace="vi")
+    assert hit is not None and hit["result"] == {"text": "doc 1"}
+    assert hit["saved_s"] == 2.0 and hit["similarity"] >= 0.9
+
+    assert index.lookup(image_hashes(copy), namespace="en") is None
+    assert index.lookup(image_hashes(_document(3)), namespace="vi") is None
+    stats = index.stats()
+    assert stats["lookups"] == 3 and stats["hits"] == 1 and stats["seconds_saved"] == 2.0
+
+
+def test_index_evicts_least_recently_used():
+    index = PHashIndex(similarity=0.99, max_entries=2)
+    hashes = [image_hashes(_document(seed)) for seed in range(3)]
+    index.add(hashes[0], 0, seconds=0.0)
+    index.add(hashes[1], 1, seconds=0.0)
+    assert index.lookup(hashes[0])["result"] == 0  # mục 0 mới dùng -> mục 1 bị bỏ
+
+    index.add(hashes[2], 2, seconds=0.0)
+    assert index.lookup(hashes[1]) is None
+    assert index.lookup(hashes[0])["result"] == 0
+    assert index.lookup(hashes[2])["result"] == 2
+    assert index.stats()["entries"] == 2
+
+
+def test_index_rebuilds_tree_after_many_evictions():
+    index = PHashIndex(similarity=1.0, max_entries=3)
+    for item_id in range(20):
+        index.add((item_id, item_id), item_id, seconds=0.0)
+    assert index._tree.size <= 2 * 3
+    assert index.lookup((19, 19))["result"] == 19
+    assert index.lookup((0, 0)) is None
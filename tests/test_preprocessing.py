@@ -0,0 +1,121 @@
+﻿# tests/test_preprocessing.py - Chuẩn hoá mode (16-bit, trong suốt), profile mặc định giữ nguyên ảnh, thu nhỏ theo profile
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from services import preprocessing
+from services.image_io import UploadError, to_8bit
+from services.preprocessing import DEFAULT_PROFILE, PROFILES, Preprocessor, get_preprocessor
+
+
+def _ramp16() -> np.ndarray:
+    return np.tile(np.linspace(0, 65535, 256).astype(np.uint16), (8, 1))
+
+
+def test_16bit_is_rescaled_not_clipped():
+    pixels = _ramp16()
+    image = Image.fromarray(pixels)
+    assert image.mode.startswith("I;16")
+
+    grey = np.asarray(to_8bit(image))
+    assert grey.dtype == np.uint8
+    np.testing.assert_allclose(grey, pixels / 257.0, atol=1)
+    assert (grey == 255).mean() < 0.01
+
+
+def test_32bit_mode_keeps_8bit_range():
+    low = Image.fromarray(np.arange(256, dtype=np.int32).reshape(16, 16), mode="I")
+    np.testing.assert_array_equal(np.asarray(to_8bit(low)), np.arange(256).reshape(16, 16))
+
+    high = Image.fromarray(np.array([[0, 32768, 65535]], dtype=np.int32), mode="I")
+    assert np.asarray(to_8bit(high)).tolist() == [[0, 128, 255]]
+
+
+def test_8bit_modes_unchanged():
+    image = Image.new("RGB", (4, 4), (1, 2, 3))
+    assert to_8bit(image) is image
+
+
+@pytest.mark.parametrize("grayscale", [False, True])
+def test_16bit_png_through_preprocessor(grayscale):
+    buffer = io.BytesIO()
+    Image.fromarray(_ramp16()).save(buffer, format="PNG")
+
+    array, _ = Preprocessor(grayscale=grayscale).load(buffer.getvalue())
+    grey = array if array.ndim == 2 else array[..., 0]
+    assert grey.dtype == np.uint8
+    assert grey[0, 0] == 0 and grey[0, -1] == 255 and 120 <= grey[0, 128] <= 135
+
+
+def test_default_profile_keeps_image_as_is():
+    assert DEFAULT_PROFILE == "original"
+    pixels = np.random.default_rng(0).integers(0, 256, (300, 5000, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    image.info["dpi"] = (600, 600)
+
+    array, info = get_preprocessor().apply(image)
+    assert info["profile"] == "original" and info["scale"] == 1.0
+    np.testing.assert_array_equal(array, pixels)
+
+
+def test_default_preprocessor_matches_original_profile():
+    assert Preprocessor().params() == Preprocessor(**PROFILES["original"]).params()
+
+
+def test_grayscale_profile_downscales():
+    image = Image.new("RGB", (4000, 1000), (200, 100, 50))
+    array, info = get_preprocessor("fast").apply(image)
+
+    assert array.ndim == 2
+    assert max(array.shape) == PROFILES["fast"]["max_side"]
+    assert info["scale"] == pytest.approx(PROFILES["fast"]["max_side"] / 4000, abs=1e-4)
+
+
+def test_dpi_scaling_targets_text_height():
+    image = Image.new("RGB", (1000, 1000), "white")
+    image.info["dpi"] = (600, 600)
+    _, info = get_preprocessor("balanced").apply(image)
+    # Chữ 10pt ở 600 DPI cao ~83 px -> thu về ~24 px
+    assert info["scale"] == pytest.approx(24 / (600 * 10 / 72), abs=1e-3)
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+def test_dpi_scaling_accounts_for_decode_reduction(fmt):
+    buffer = io.BytesIO()
+    Image.new("RGB", (6000, 4000), "white").save(buffer, format=fmt, dpi=(600, 600))
+    # Giải mã đã thu nhỏ (draft / reduce về OCR_DECODE_MAX_SIDE); tổng hệ số vẫn phải đúng ~24 / 83.3
+    array, _ = get_preprocessor("balanced").load(buffer.getvalue())
+    assert max(array.shape) == pytest.approx(6000 * 24 / (600 * 10 / 72), abs=3)
+
+
+def test_transparent_background_becomes_white():
+    rgba = np.zeros((4, 4, 4), dtype=np.uint8)
+    rgba[0, 0] = (0, 0, 0, 255)
+    array, _ = Preprocessor().apply(Image.fromarray(rgba, mode="RGBA"))
+
+    assert array.shape == (4, 4, 3)
+    assert array[0, 0].tolist() == [0, 0, 0]
+    assert array[1, 1].tolist() == [255, 255, 255]
+
+
+def test_unknown_profile():
+    with pytest.raises(UploadError) as error:
+        get_preprocessor("khong-co")
+    assert error.value.status_code == 400
+
+
+def test_configured_profile_with_unknown_key_is_skipped(monkeypatch, caplog):
+    monkeypatch.setenv("OCR_PREPROCESS_PROFILES",
+                       '{"tenant_ok": {"max_side": 1000}, "tenant_bad": {"max_sid": 1000}, "fast": {"grayscale": 1, "x": 2}}')
+    monkeypatch.setattr(preprocessing, "_profiles", None)
+    monkeypatch.setattr(preprocessing, "_preprocessors", {})
+
+    assert get_preprocessor("tenant_ok").max_side == 1000
+    with pytest.raises(UploadError) as error:
+        get_preprocessor("tenant_bad")
+    assert error.value.status_code == 400
+    # Profile dựng sẵn giữ nguyên khi bản ghi đè không hợp lệ
+    assert get_preprocessor("fast").params() == Preprocessor(**PROFILES["fast"]).params()
+    assert "max_sid" in caplog.text and "'x'" not in caplog.text and "x (hỗ trợ" in caplog.text
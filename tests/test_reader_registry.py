@@ -0,0 +1,57 @@
+﻿# tests/test_reader_registry.py - Budget của ReaderRegistry: tính cả reader tầng nhanh của OCR hai tầng
+from services.reader_registry import ReaderRegistry
+from services.tiered_ocr import TieredOCR
+
+MB = 1024 * 1024
+
+
+class _Param:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+    def numel(self):
+        return self.nbytes
+
+    def element_size(self):
+        return 1
+
+
+class _Module:
+    def __init__(self, mb):
+        self._params = [_Param(int(mb * MB))]
+
+    def parameters(self):
+        return iter(self._params)
+
+
+class _Reader:
+    def __init__(self, recognizer_mb, detector_mb=0):
+        self.recognizer = _Module(recognizer_mb)
+        self.detector = _Module(detector_mb) if detector_mb else None
+
+
+def test_plain_reader_counts_recognizer():
+    registry = ReaderRegistry(builder=lambda languages, parts: _Reader(10), budget_mb=0)
+    registry.get(["vi"])
+    assert registry.stats()["readers"][0]["mb"] == 10
+
+
+def test_tiered_reader_counts_fast_tier():
+    def builder(languages, parts):
+        return TieredOCR(_Reader(10), fast_reader=_Reader(4, detector_mb=3))
+
+    registry = ReaderRegistry(builder=builder, budget_mb=0)
+    registry.get(["vi"])
+    assert registry.stats()["readers"][0]["mb"] == 17
+
+
+def test_fast_tier_weights_trigger_eviction():
+    def builder(languages, parts):
+        return TieredOCR(_Reader(10), fast_reader=_Reader(4, detector_mb=3))
+
+    # 2 reader x 10 MB vừa budget, nhưng 2 x 17 MB thì phải bỏ reader cũ
+    registry = ReaderRegistry(builder=builder, budget_mb=25)
+    registry.get(["vi"])
+    registry.get(["en"])
+    assert registry.evictions == 1
+    assert [entry["languages"] for entry in registry.stats()["readers"]] == [["en"]]
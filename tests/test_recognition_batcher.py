@@ -0,0 +1,61 @@
+﻿# tests/test_recognition_batcher.py - Tham số nhận dạng của batcher theo mặc định / kwargs của reader.recognize
+from concurrent.futures import Future
+
+from services.recognition_batcher import RecognitionBatcher, _Request, recognition_settings
+
+
+class _Reader:
+    """Chữ ký recognize giống easyocr.Reader (mặc định dùng chung với readtext)"""
+
+    character = "0123456789abc"
+    lang_char = "0123456789ab"
+
+    def recognize(self, img_cv_grey, horizontal_list=None, free_list=None, decoder='greedy', beamWidth=5,
+                  batch_size=1, workers=0, allowlist=None, blocklist=None, detail=1, rotation_info=None,
+                  paragraph=False, contrast_ths=0.1, adjust_contrast=0.5, filter_ths=0.003,
+                  y_ths=0.5, x_ths=1.0, reformat=True, output_format='standard'):
+        raise NotImplementedError
+
+
+def test_settings_default_to_recognize_signature():
+    assert recognition_settings(_Reader()) == {
+        "ignore_char": "c",
+        "decoder": "greedy",
+        "beamWidth": 5,
+        "contrast_ths": 0.1,
+        "adjust_contrast": 0.5,
+        "filter_ths": 0.003,
+        "workers": 0,
+    }
+
+
+def test_settings_follow_kwargs():
+    settings = recognition_settings(_Reader(), decoder="beamsearch", beamWidth=10, contrast_ths=0.3, allowlist="0123")
+    assert settings["decoder"] == "beamsearch"
+    assert settings["beamWidth"] == 10
+    assert settings["contrast_ths"] == 0.3
+    assert settings["ignore_char"] == "456789abc"
+    assert recognition_settings(_Reader(), blocklist="ba")["ignore_char"] == "ab"
+
+
+class _RecordingBatcher(RecognitionBatcher):
+    def __init__(self):
+        super().__init__(max_wait_ms=0)
+        self.runs = []
+
+    def _run_reader(self, reader, settings, requests):
+        self.runs.append((settings["decoder"], len(requests)))
+        for request in requests:
+            request.future.set_result([])
+
+
+def test_requests_with_different_settings_run_separately():
+    reader = _Reader()
+    batcher = _RecordingBatcher()
+    requests = [
+        _Request([None], Future(), reader, recognition_settings(reader)),
+        _Request([None], Future(), reader, recognition_settings(reader)),
+        _Request([None], Future(), reader, recognition_settings(reader, decoder="beamsearch")),
+    ]
+    batcher._run(requests)
+    assert sorted(batcher.runs) == [("beamsearch", 1), ("greedy", 2)]
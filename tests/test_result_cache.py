@@ -0,0 +1,110 @@
+﻿# tests/test_result_cache.py - Khoá cache theo pixel + ngôn ngữ + tham số, LRU theo byte, tầng đĩa
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from services.result_cache import OCRResultCache, to_jsonable
+
+
+def _png(pixels: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_key_depends_on_pixels_not_encoding():
+    pixels = np.arange(64 * 48 * 3, dtype=np.uint8).reshape(48, 64, 3)
+    key = OCRResultCache.make_key(pixels, ["vi", "en"], {"profile": "original"})
+
+    assert OCRResultCache.make_key(_png(pixels), ["vi", "en"], {"profile": "original"}) == key
+    assert OCRResultCache.make_key(Image.fromarray(pixels), ["vi", "en"], {"profile": "original"}) == key
+
+
+def test_key_changes_with_pixels_languages_and_params():
+    pixels = np.zeros((16, 16), dtype=np.uint8)
+    key = OCRResultCache.make_key(pixels, ["vi"], {"profile": "original"})
+
+    changed = pixels.copy()
+    changed[0, 0] = 1
+    assert OCRResultCache.make_key(changed, ["vi"], {"profile": "original"}) != key
+    assert OCRResultCache.make_key(pixels, ["en"], {"profile": "original"}) != key
+    assert OCRResultCache.make_key(pixels, ["vi"], {"profile": "fast"}) != key
+    # Cùng dữ liệu nhưng khác shape / dtype không được trùng khoá
+    assert OCRResultCache.make_key(pixels.reshape(8, 32), ["vi"], {"profile": "original"}) != key
+    assert OCRResultCache.make_key(pixels.astype(np.uint16), ["vi"], {"profile": "original"}) != key
+
+
+def test_key_ignores_param_order():
+    pixels = np.zeros((4, 4), dtype=np.uint8)
+    assert (OCRResultCache.make_key(pixels, ["vi"], {"a": 1, "b": 2})
+            == OCRResultCache.make_key(pixels, ["vi"], {"b": 2, "a": 1}))
+
+
+def test_lru_evicts_least_recently_used_by_bytes():
+    value = ["x" * 90]  # ~96 byte JSON
+    cache = OCRResultCache(max_bytes=250, disk_dir="")
+    cache.put("a", value)
+    cache.put("b", value)
+    assert cache.get("a") == value  # "a" mới dùng -> "b" bị bỏ trước
+
+    cache.put("c", value)
+    assert cache.get("b") is None
+    assert cache.get("a") == value
+    assert cache.get("c") == value
+    assert cache.stats()["bytes"] <= 250
+
+
+def test_oversized_value_is_not_cached():
+    cache = OCRResultCache(max_bytes=10, disk_dir="")
+    cache.put("big", "x" * 100)
+    assert cache.get("big") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = OCRResultCache(max_bytes=0, disk_dir="")
+    assert not cache.enabled
+    cache.put("a", [1])
+    assert cache.get("a") is None
+
+
+def test_disk_tier_survives_new_instance(tmp_path):
+    result = [[[[0, 0], [10, 0], [10, 5], [0, 5]], "Xin chào", np.float32(0.5)]]
+    OCRResultCache(max_bytes=1024, disk_dir=str(tmp_path)).put("k" * 64, result)
+
+    cache = OCRResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    assert cache.get("k" * 64) == to_jsonable(result)
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used_files(tmp_path):
+    value = ["x" * 90]  # ~96 byte mỗi file
+    cache = OCRResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=350)
+    keys = [f"{index:02d}" + "k" * 62 for index in range(3)]
+    for index, key in enumerate(keys):
+        cache.put(key, value)
+        path = cache._disk_path(key)
+        os.utime(path, (time.time() - 100 + index, time.time() - 100 + index))
+    assert cache.get(keys[0]) == value  # hit cập nhật mtime -> keys[1] cũ nhất
+
+    cache.put("03" + "k" * 62, value)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == value
+    stats = cache.stats()
+    assert stats["disk_evictions"] >= 1 and stats["disk_bytes"] <= 350 * 0.9
+
+
+def test_disk_tier_counts_existing_files(tmp_path):
+    OCRResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=0).put("a" * 64, ["x" * 90])
+    cache = OCRResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    assert cache.stats()["disk_bytes"] == os.path.getsize(cache._disk_path("a" * 64))
+
+
+def test_disk_tier_skips_value_over_budget(tmp_path):
+    cache = OCRResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=10)
+    cache.put("a" * 64, ["x" * 90])
+    assert cache.get("a" * 64) is None
+    assert cache.stats()["disk_bytes"] == 0
@@ -0,0 +1,52 @@
+﻿# tests/test_roi_ocr.py - Nhận dạng theo vùng: một lời gọi recognize cho cả trang, kết quả về đúng box
+import numpy as np
+
+from services import roi_ocr
+
+
+class _FakeReader:
+    """Giả lập reader.recognize của easyocr: một kết quả mỗi vùng, sắp theo y như easyocr"""
+
+    def __init__(self, skip=()):
+        self.calls = []
+        self.skip = set(skip)
+
+    def recognize(self, gray, horizontal_list, free_list):
+        self.calls.append([list(region) for region in horizontal_list])
+        results = []
+        for x0, x1, y0, y1 in horizontal_list:
+            if (x0, y0) in self.skip:
+                continue
+            box = [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+            results.append((box, f"{x0},{y0}", 0.9))
+        return sorted(results, key=lambda result: result[0][0][1])
+
+
+def test_regions_recognized_in_one_call_and_split_by_box():
+    gray = np.zeros((400, 600), dtype=np.uint8)
+    boxes = [(300, 200, 500, 220), (50, 20, 200, 40), (60, 100, 250, 130)]
+    reader = _FakeReader()
+
+    recognized = roi_ocr._recognize_regions(reader, gray, boxes)
+
+    assert len(reader.calls) == 1 and len(reader.calls[0]) == 3
+    # Thứ tự kết quả theo boxes, không theo thứ tự y easyocr trả về
+    expected = [f"{region[0]},{region[2]}" for region in reader.calls[0]]
+    assert [text for text, _ in recognized] == expected
+    assert recognized[0][0] == "295,195"
+
+
+def test_missing_region_result_is_none():
+    gray = np.zeros((400, 600), dtype=np.uint8)
+    reader = _FakeReader(skip={(45, 15)})
+
+    recognized = roi_ocr._recognize_regions(reader, gray, [(300, 200, 500, 220), (50, 20, 200, 40)])
+
+    assert recognized[0] == ("295,195", 0.9)
+    assert recognized[1] is None
+
+
+def test_no_regions_skips_recognize():
+    reader = _FakeReader()
+    assert roi_ocr._recognize_regions(reader, np.zeros((10, 10), dtype=np.uint8), []) == []
+    assert reader.calls == []
@@ -0,0 +1,95 @@
+﻿# tests/test_worker_farm.py - Farm tiến trình: trả kết quả, báo lỗi, dừng + fork lại worker chạy quá hạn
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+from services.worker_farm import OCRWorkerFarm, WorkerCrashed, WorkerError, WorkerTimeout
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Farm cần fork")
+
+
+def _reader():
+    return {"name": "fake-reader"}
+
+
+def _echo(reader, value):
+    return reader["name"], value, os.getpid()
+
+
+def _boom(reader):
+    raise ValueError("hỏng")
+
+
+_LOCK = threading.Lock()
+
+
+def _parent_pid(reader):
+    return os.getppid()
+
+
+def _exit(reader):
+    os._exit(3)
+
+
+def _try_lock(reader):
+    acquired = _LOCK.acquire(timeout=2)
+    if acquired:
+        _LOCK.release()
+    return acquired
+
+
+def _sleep(reader, seconds):
+    time.sleep(seconds)
+    return "xong"
+
+
+@pytest.fixture
+def farm():
+    farm = OCRWorkerFarm(_reader, processes=1, threads_per_worker=1)
+    yield farm
+    farm.shutdown(wait_workers=False)
+
+
+def test_runs_jobs_in_worker(farm):
+    name, value, pid = farm.submit(_echo, 42).result(timeout=10)
+    assert (name, value) == ("fake-reader", 42) and pid != os.getpid()
+
+    with pytest.raises(WorkerError, match="hỏng"):
+        farm.submit(_boom).result(timeout=10)
+
+
+def test_expired_job_kills_and_respawns_worker(farm):
+    _, _, first_pid = farm.submit(_echo, 1).result(timeout=10)
+
+    start = time.monotonic()
+    with pytest.raises(WorkerTimeout):
+        farm.submit_job(_sleep, (30,), timeout=0.5).result(timeout=10)
+    assert time.monotonic() - start < 5
+
+    _, _, pid = farm.submit(_echo, 2).result(timeout=10)
+    assert pid != first_pid
+    assert farm.stats()["restarts"] == 1
+
+
+def test_workers_fork_from_zygote(farm):
+    farm.start()
+    assert farm.submit(_parent_pid).result(timeout=10) == farm._zygote.pid
+
+
+def test_crashed_worker_is_detected_and_respawned(farm):
+    with pytest.raises(WorkerCrashed):
+        farm.submit(_exit).result(timeout=10)
+    assert farm.submit(_echo, 3).result(timeout=10)[1] == 3
+    assert farm.stats()["restarts"] == 1
+
+
+def test_respawn_does_not_inherit_parent_locks(farm):
+    farm.start()
+    # Khoá bị giữ trong tiến trình cha lúc fork lại: worker fork thẳng từ cha sẽ kẹt khoá này
+    with _LOCK:
+        with pytest.raises(WorkerTimeout):
+            farm.submit_job(_sleep, (30,), timeout=0.3).result(timeout=10)
+        assert farm.submit(_try_lock).result(timeout=10) is True